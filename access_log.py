@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""Structured access log written off the request path.
+
+Handlers put one dict per request into a bounded queue; a background
+thread serializes them to JSON lines and writes them in batches, either
+to a file or, without one, to the "access" logger. When the queue is
+full records are dropped and counted instead of blocking the request.
+
+    access_log = AccessLog("access.log", sample_rate=0.1)
+    access_log.log({"request_id": ..., "code": 200, "latency_ms": 1.2})
+    ...
+    access_log.close()
+"""
+
+import atexit
+import json
+import logging
+import os
+import Queue
+import random
+
+from background import BackgroundThreads
+
+BATCH_SIZE = 100
+FLUSH_INTERVAL = 1.0
+QUEUE_SIZE = 10000
+
+logger = logging.getLogger("access")
+
+
+class JsonLinesWriter(BackgroundThreads):
+    """Queue-backed JSON lines writer."""
+
+    def __init__(self, path=None, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL, queue_size=QUEUE_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+
+    def log(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def starting(self):
+        # flush what is queued when the process exits normally
+        atexit.register(self.close)
+
+    def run(self):
+        stream = open(self.path, "a") if self.path else None
+        try:
+            while True:
+                batch = self.next_batch()
+                if batch is None:
+                    return
+                self.write(stream, batch)
+        finally:
+            if stream is not None:
+                stream.close()
+
+    def next_batch(self):
+        """Wait for records and return up to batch_size of them, None once
+        close() was called and the queue is drained."""
+        batch = []
+        try:
+            record = self.queue.get(timeout=self.flush_interval)
+            while record is not None:
+                batch.append(record)
+                if len(batch) >= self.batch_size:
+                    break
+                record = self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+        else:
+            if record is None and not batch:
+                return None
+            if record is None:
+                # write what we have, stop on the next call
+                self.queue.put(None)
+        return batch
+
+    def write(self, stream, batch):
+        if not batch:
+            return
+        lines = [json.dumps(record, default=str) for record in batch]
+        if stream is None:
+            for line in lines:
+                logger.info(line)
+        else:
+            stream.write("\n".join(lines) + "\n")
+            stream.flush()
+
+    def close(self):
+        """Write out the queued records and stop the writer thread."""
+        if self.pid != os.getpid():
+            return
+        self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.pid = None
+
+
+class AccessLog(JsonLinesWriter):
+    """Only ``sample_rate`` of the successful requests are kept, error
+    responses (code >= 400) are always logged."""
+
+    def __init__(self, path=None, sample_rate=1.0, batch_size=BATCH_SIZE, **options):
+        super(AccessLog, self).__init__(path, batch_size, **options)
+        self.sample_rate = sample_rate
+
+    def log(self, record):
+        if self.sample_rate < 1 and record.get("code", 0) < 400 and random.random() >= self.sample_rate:
+            return
+        super(AccessLog, self).log(record)
@@ -6,12 +6,25 @@ import json
 import datetime
 import logging
 import hashlib
+import hmac
+import os
+import select
+import signal
+import socket
+import threading
+import time
 import uuid
+import Queue
 from optparse import OptionParser
 from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 import re
-from scoring import get_score, get_interests
-from store import Store
+from metrics import registry, REQUESTS, PHASE_SECONDS
+from access_log import AccessLog, BATCH_SIZE as ACCESS_LOG_BATCH_SIZE
+from tracing import Tracer, span
+from profiling import profiler, DEFAULT_REQUESTS as PROFILE_REQUESTS, DEFAULT_SECONDS as PROFILE_SECONDS
+from scoring import get_score, get_scores, get_interests_many
+from store import Store, LocalCache, RetryPolicy, LOCAL_CACHE_TTL, POOL_MIN_SIZE, POOL_IDLE_TIMEOUT, RETRY_DEADLINE
+from store import REFRESH_BETA, REFRESH_WORKERS, STALE_TTL, WRITE_BEHIND_POLICIES
 
 PORT = 8081
 SALT = "Otus"
@@ -23,6 +36,7 @@ FORBIDDEN = 403
 NOT_FOUND = 404
 INVALID_REQUEST = 422
 INTERNAL_ERROR = 500
+MAX_BATCH_SIZE = 1000
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
@@ -40,36 +54,43 @@ GENDERS = {
 }
 DEFAULT_CACHE_CLIENT = 'memcache'
 DEFAULT_CACHE_ADDRESS = '127.0.0.1'
+POLL_INTERVAL = 0.5
+KEEPALIVE_TIMEOUT = 15.0
+KEEPALIVE_REQUESTS = 100
+# an idle keep-alive connection gives up its worker to waiting clients only
+# after this long, a busy client sends its next request well before; then it
+# checks for them every poll interval
+KEEPALIVE_GRACE = 0.1
+KEEPALIVE_POLL_INTERVAL = 0.02
+
+
+class ValidationError(ValueError):
+    pass
 
 
 class BaseField(object):
     __metaclass__ = abc.ABCMeta
     require_error = "is require"
     nullable_error = "is not nullable"
+    creation_counter = 0
     value = None
     errors = []
 
     def __init__(self, required, nullable=False):
         self.required = required
         self.nullable = nullable
-        return
-
-    def __cmp__(self, other):
-        if self.value == other:
-            return 0
-        elif self.value > other:
-            return 1
-        else:
-            return -1
+        self.name = None
+        self.index = None
+        self.creation_counter = BaseField.creation_counter
+        BaseField.creation_counter += 1
 
-    def __add__(self, other):
-        return self.__str__() + str(other)
-
-    def __str__(self):
-        return self.value
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.values[self.index]
 
     def __set__(self, instance, value):
-        self.value = value
+        instance.values[self.index] = value
 
     def validate(self):
         self._restore_errors()
@@ -80,6 +101,17 @@ class BaseField(object):
         else:
             self.clean()
 
+    def run_validation(self, value):
+        """Validate value without touching field state, return (value, error)."""
+        if value is None:
+            return value, self.require_error if self.required else None
+        if not value and type(value) is not int:
+            return value, None if self.nullable else self.nullable_error
+        try:
+            return self.clean_value(value), None
+        except ValidationError as e:
+            return value, str(e)
+
     def _restore_errors(self):
         self.errors = []
 
@@ -91,119 +123,200 @@ class BaseField(object):
         if not self.nullable:
             self.errors.append(self.nullable_error)
 
-    @abc.abstractmethod
     def clean(self):
-        pass
+        try:
+            self.value = self.clean_value(self.value)
+        except ValidationError as e:
+            self.errors.append(str(e))
+
+    def clean_value(self, value):
+        return value
 
 
 class CharField(BaseField):
     char_error = "Is not a string"
 
-    def clean(self):
-        if not isinstance(self.value, basestring):
-            self.errors.append(self.char_error)
-        else:
-            self.value = self.value.encode()
+    def clean_value(self, value):
+        if not isinstance(value, basestring):
+            raise ValidationError(self.char_error)
+        return value.encode()
 
 
 class ArgumentsField(BaseField):
     arguments_error = 'Is not dict with arguments'
 
-    def clean(self):
-        if not isinstance(self.value, dict):
-            self.errors.append(self.arguments_error)
+    def clean_value(self, value):
+        if not isinstance(value, dict):
+            raise ValidationError(self.arguments_error)
+        return value
+
+
+class ArgumentsListField(BaseField):
+    arguments_list_error = 'Is not list of dicts with arguments'
+    batch_size_error = 'Too many items, at most %d allowed' % MAX_BATCH_SIZE
+
+    def clean_value(self, value):
+        if not isinstance(value, list) or not all(isinstance(item, dict) for item in value):
+            raise ValidationError(self.arguments_list_error)
+        if len(value) > MAX_BATCH_SIZE:
+            raise ValidationError(self.batch_size_error)
+        return value
 
 
 class EmailField(CharField):
     email_error = "Is not email"
 
-    def clean(self):
-        super(EmailField, self).clean()
-        if isinstance(self.value, basestring):
-            if '@' not in self.value:
-                self.errors.append(self.email_error)
+    def clean_value(self, value):
+        value = super(EmailField, self).clean_value(value)
+        if '@' not in value:
+            raise ValidationError(self.email_error)
+        return value
 
 
 class PhoneField(BaseField):
     phone_error = 'Is not phone number'
-    phone_template = r"7\d{10}"
-
-    def clean(self):
-        value = self.value
-        if isinstance(value, int):
-            value = str(value)
-        if isinstance(value, basestring):
-            if not re.match(self.phone_template, value):
-                self.errors.append(self.phone_error)
-        else:
-            self.errors.append(self.phone_error)
+    phone_template = re.compile(r"7\d{10}")
+
+    def clean_value(self, value):
+        phone = value
+        if isinstance(phone, int):
+            phone = str(phone)
+        if not isinstance(phone, basestring) or not self.phone_template.match(phone):
+            raise ValidationError(self.phone_error)
+        return value
+
+
+# what strptime accepts for '%d.%m.%Y'
+DATE_TEMPLATE = re.compile(r"(3[01]|[12]\d|0[1-9]|[1-9]| [1-9])\.(1[0-2]|0[1-9]|[1-9])\.(\d\d\d\d)\Z")
+DATE_CACHE_SIZE = 4096
+date_cache = {}
+
+
+def parse_date(value):
+    """Parse DD.MM.YYYY exactly like strptime(value, '%d.%m.%Y').date(),
+    remembering the recently parsed strings."""
+    date = date_cache.get(value)
+    if date is not None:
+        return date
+    if not isinstance(value, basestring):
+        raise TypeError("date must be a string")
+    match = DATE_TEMPLATE.match(value)
+    if match is None:
+        raise ValueError("time data %r does not match format '%%d.%%m.%%Y'" % value)
+    day, month, year = match.groups()
+    date = datetime.date(int(year), int(month), int(day))
+    if len(date_cache) >= DATE_CACHE_SIZE:
+        date_cache.clear()
+    date_cache[value] = date
+    return date
 
 
 class DateField(BaseField):
     data_error = 'Is note date'
 
-    def clean(self):
+    def clean_value(self, value):
         try:
-            date_string = self.value
-            self.value = datetime.datetime.strptime(date_string, '%d.%m.%Y').date()
+            return parse_date(value)
         except (ValueError, TypeError):
-            self.errors.append(self.data_error)
+            raise ValidationError(self.data_error)
 
 
 class BirthDayField(DateField):
     birthday_error = 'Not a birthday'
-
-    def clean(self):
-        super(BirthDayField, self).clean()
-        try:
-            # birthday = datetime.datetime.strptime(self.value, '%d.%m.%Y')
-            if self.value < datetime.datetime.now().date() - datetime.timedelta(days=365*70):
-                self.errors.append(self.birthday_error)
-        except (ValueError, TypeError):
-            pass
+    max_age = datetime.timedelta(days=365*70)
+    # (timestamp of the next midnight, oldest allowed birthday)
+    cutoff = (0, None)
+
+    @classmethod
+    def get_cutoff(cls):
+        expires_at, cutoff = cls.cutoff
+        if time.time() >= expires_at:
+            today = datetime.date.today()
+            tomorrow = today + datetime.timedelta(days=1)
+            cutoff = today - cls.max_age
+            cls.cutoff = (time.mktime(tomorrow.timetuple()), cutoff)
+        return cutoff
+
+    def clean_value(self, value):
+        value = super(BirthDayField, self).clean_value(value)
+        if value < self.get_cutoff():
+            raise ValidationError(self.birthday_error)
+        return value
 
 
 class GenderField(BaseField):
     gender_error = 'is not a gender number'
 
-    def clean(self):
-        if not isinstance(self.value, int) or self.value not in (UNKNOWN, MALE, FEMALE):
-                self.errors.append(self.gender_error)
+    def clean_value(self, value):
+        if not isinstance(value, int) or value not in (UNKNOWN, MALE, FEMALE):
+            raise ValidationError(self.gender_error)
+        return value
 
 
 class ClientIDsField(BaseField):
     client_id_error = 'Is not list of client ids'
 
-    def clean(self):
-        if not isinstance(self.value, list):
-            self.errors.append(self.client_id_error)
-        else:
-            for element in self.value:
-                if not isinstance(element, int):
-                    self.errors.append(self.client_id_error)
-                    break
+    def clean_value(self, value):
+        if not isinstance(value, list):
+            raise ValidationError(self.client_id_error)
+        for element in value:
+            if not isinstance(element, int):
+                raise ValidationError(self.client_id_error)
+        return value
+
+
+class RequestMeta(abc.ABCMeta):
+    """Compiles a validation plan once per request class.
+
+    The plan is the ordered tuple of field names with the bound validation
+    function of every field; ``validate_groups`` are compiled to pairs of
+    positions in that plan. Field values live in the per-instance ``values``
+    list in plan order, so the field objects themselves are never written
+    to while serving requests.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = [(field_name, field) for field_name, field in attrs.items() if isinstance(field, BaseField)]
+        fields.sort(key=lambda item: item[1].creation_counter)
+        inherited = []
+        for base in bases:
+            inherited.extend(getattr(base, 'fields_with_validation', ()))
+        for index, (field_name, field) in enumerate(fields, len(inherited)):
+            field.name = field_name
+            field.index = index
+        attrs['fields_with_validation'] = tuple(inherited) + tuple(field_name for field_name, _ in fields)
+        attrs.setdefault('__slots__', ())
+        cls = super(RequestMeta, mcs).__new__(mcs, name, bases, attrs)
+        positions = dict((field_name, index) for index, field_name in enumerate(cls.fields_with_validation))
+        cls.validation_plan = tuple(
+            (field_name, getattr(cls, field_name).run_validation) for field_name in cls.fields_with_validation
+        )
+        cls.validate_group_indexes = tuple(
+            (positions[first], positions[second]) for first, second in getattr(cls, 'validate_groups', ())
+        )
+        return cls
 
 
 class BaseRequest(object):
-    __metaclass__ = abc.ABCMeta
-    fields_with_validation = []
+    __metaclass__ = RequestMeta
+    __slots__ = ('values', 'errors')
 
-    def __init__(self):
+    def __init__(self, kwargs):
+        get = kwargs.get
+        self.values = [get(field_name) for field_name in self.fields_with_validation]
         self.errors = {}
 
     def validate_fields(self):
-        for field_name in self.fields_with_validation:
-            field = getattr(self, field_name)
-            field.validate()
-            if field.errors:
-                self.errors[field_name] = field.errors
+        values = self.values
+        for index, (field_name, run_validation) in enumerate(self.validation_plan):
+            value, error = run_validation(values[index])
+            values[index] = value
+            if error:
+                self.errors[field_name] = [error]
+        return not self.errors
 
     def get_data(self):
-        fields = {}
-        for field_name in self.fields_with_validation:
-            field = getattr(self, field_name)
-            fields[field_name] = field.value
-        return fields
+        return dict(zip(self.fields_with_validation, self.values))
 
     def get_errors(self):
         errors_list = []
@@ -221,21 +334,13 @@ class BaseRequest(object):
 class ClientsInterestsRequest(BaseRequest):
     client_ids = ClientIDsField(required=True)
     date = DateField(required=False, nullable=True)
-    fields_with_validation = ['client_ids', 'date']
-
-    def __init__(self, kwargs):
-        super(ClientsInterestsRequest, self).__init__()
-        self.client_ids = kwargs.get('client_ids', None)
-        self.date = kwargs.get('date', None)
 
     def is_valid(self):
-        self.validate_fields()
-        if self.errors:
-            return False
-        return True
+        return self.validate_fields()
 
 
 class OnlineScoreRequest(BaseRequest):
+    __slots__ = ('not_null_fields',)
     first_name = CharField(required=False, nullable=True)
     last_name = CharField(required=False, nullable=True)
     email = EmailField(required=False, nullable=True)
@@ -247,34 +352,29 @@ class OnlineScoreRequest(BaseRequest):
         ('phone', 'email'),
         ('gender', 'birthday'),
     )
-    fields_with_validation = ['first_name', 'last_name', 'email', 'phone', 'birthday', 'gender']
 
     def __init__(self, kwargs):
-        super(OnlineScoreRequest, self).__init__()
-        self.first_name = kwargs.get('first_name', None)
-        self.last_name = kwargs.get('last_name', None)
-        self.email = kwargs.get('email', None)
-        self.phone = kwargs.get('phone', None)
-        self.birthday = kwargs.get('birthday', None)
-        self.gender = kwargs.get('gender', None)
+        super(OnlineScoreRequest, self).__init__(kwargs)
         self.not_null_fields = []
 
     def is_valid(self):
-        self.validate_fields()
-        if self.errors:
+        if not self.validate_fields():
             return False
-        self.find_not_null_fields_name()
-        for validate_group in self.validate_groups:
-            if validate_group[0] in self.not_null_fields and validate_group[1] in self.not_null_fields:
+        values = self.values
+        self.not_null_fields = [
+            field_name for field_name, value in zip(self.fields_with_validation, values) if value is not None
+        ]
+        for first, second in self.validate_group_indexes:
+            if values[first] is not None and values[second] is not None:
                 return True
         return False
 
-    def find_not_null_fields_name(self):
-        for attr_name in dir(self):
-            attr = getattr(self, attr_name)
-            if isinstance(attr, BaseField):
-                if attr.value is not None:
-                    self.not_null_fields.append(attr_name)
+
+class OnlineScoreBatchRequest(BaseRequest):
+    items = ArgumentsListField(required=True)
+
+    def is_valid(self):
+        return self.validate_fields()
 
 
 class MethodRequest(BaseRequest):
@@ -283,35 +383,55 @@ class MethodRequest(BaseRequest):
     token = CharField(required=True, nullable=True)
     arguments = ArgumentsField(required=True, nullable=True)
     method = CharField(required=True, nullable=False)
-    fields_with_validation = ['account', 'login', 'token', 'arguments', 'method']
-
-    def __init__(self, kwargs):
-        super(MethodRequest, self).__init__()
-        self.account = kwargs.get('account', None)
-        self.login = kwargs.get('login', None)
-        self.token = kwargs.get('token', None)
-        self.arguments = kwargs.get('arguments', None)
-        self.method = kwargs.get('method', None)
 
     def is_valid(self):
-        self.validate_fields()
-        if self.errors:
-            return False
-        return True
+        return self.validate_fields()
 
     @property
     def is_admin(self):
         return self.login == ADMIN_LOGIN
 
 
+AUTH_CACHE_SIZE = 10000
+# (account, login) -> digest, only for credentials that passed the check
+user_digests = {}
+# (timestamp of the next hour, digest of the current hour)
+admin_digest = (0, None)
+
+
+def get_admin_digest():
+    global admin_digest
+    expires_at, digest = admin_digest
+    if time.time() >= expires_at:
+        now = datetime.datetime.now()
+        hour = now.replace(minute=0, second=0, microsecond=0)
+        digest = hashlib.sha512(now.strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
+        admin_digest = (time.mktime((hour + datetime.timedelta(hours=1)).timetuple()), digest)
+    return digest
+
+
+def compare_token(digest, token):
+    # empty and null tokens skip CharField.clean_value and may come as unicode
+    # or None, which compare_digest does not take along with a byte string
+    if isinstance(token, unicode):
+        token = token.encode("utf-8")
+    return isinstance(token, str) and hmac.compare_digest(digest, token)
+
+
 def check_auth(request):
     if request.login == ADMIN_LOGIN:
-        digest = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT).hexdigest()
-    else:
-        digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
-    if digest == request.token:
-        return True
-    return False
+        return compare_token(get_admin_digest(), request.token)
+    key = (request.account, request.login)
+    digest = user_digests.get(key)
+    if digest is not None:
+        return compare_token(digest, request.token)
+    digest = hashlib.sha512(request.account + request.login + SALT).hexdigest()
+    if not compare_token(digest, request.token):
+        return False
+    if len(user_digests) >= AUTH_CACHE_SIZE:
+        user_digests.clear()
+    user_digests[key] = digest
+    return True
 
 
 def online_score_handler(arguments, is_admin, ctx, store):
@@ -331,17 +451,47 @@ def online_score_handler(arguments, is_admin, ctx, store):
     return response, code
 
 
+def online_score_batch_handler(arguments, is_admin, ctx, store):
+    batch_request = OnlineScoreBatchRequest(arguments)
+    if not batch_request.is_valid():
+        ctx['nitems'] = 0
+        return batch_request.get_errors(), INVALID_REQUEST
+    results = []
+    valid = []
+    for item in batch_request.items:
+        if is_admin:
+            results.append({'code': OK, 'response': {'score': 42}})
+            continue
+        online_score_request = OnlineScoreRequest(item)
+        try:
+            attrs = online_score_request.get_data() if online_score_request.is_valid() else None
+        except (TypeError, ValueError) as e:
+            # a bad item, e.g. a non-ASCII name CharField can not encode, fails alone
+            results.append({'code': INVALID_REQUEST, 'error': 'Invalid item: %s' % e})
+            continue
+        if attrs is None:
+            result = {'code': INVALID_REQUEST, 'error': online_score_request.get_errors()}
+        else:
+            result = {'code': OK, 'response': {}}
+            valid.append((result, attrs))
+        results.append(result)
+    if valid:
+        scores = get_scores(store, [attrs for _, attrs in valid])
+        for (result, _), score in zip(valid, scores):
+            result['response']['score'] = score
+    ctx['nitems'] = len(results)
+    return {'items': results}, OK
+
+
 def clients_interests_handler(arguments, is_admin, ctx, store):
     clients_interests_request = ClientsInterestsRequest(arguments)
     if clients_interests_request.is_valid():
         code = OK
-        response = {}
-        for client_id in clients_interests_request.client_ids.value:
-            response[client_id] = get_interests(store, client_id)
+        response = get_interests_many(store, clients_interests_request.client_ids)
     else:
         response, code = clients_interests_request.get_errors(), INVALID_REQUEST
     try:
-        ctx['nclients'] = len(clients_interests_request.client_ids.value)
+        ctx['nclients'] = len(clients_interests_request.client_ids)
     except TypeError:
         ctx['nclients'] = 0
     return response, code
@@ -350,19 +500,32 @@ def clients_interests_handler(arguments, is_admin, ctx, store):
 def method_handler(request, ctx, store):
     handler_router = {
         'online_score': online_score_handler,
-        'clients_interests': clients_interests_handler
+        'clients_interests': clients_interests_handler,
+        'online_score_batch': online_score_batch_handler,
     }
     body = request['body']
-    method_request = MethodRequest(body)
-    if method_request.is_valid():
-        if check_auth(method_request):
-            if method_request.method.value in handler_router:
-                response, code = handler_router[method_request.method.value](
-                    method_request.arguments.value,
-                    method_request.is_admin,
-                    ctx,
-                    store
-                )
+    start = time.time()
+    with span("validate"):
+        method_request = MethodRequest(body)
+        is_valid = method_request.is_valid()
+    validated = time.time()
+    PHASE_SECONDS.observe(("validate",), validated - start)
+    if is_valid:
+        ctx['method'] = method_request.method
+        with span("check_auth"):
+            is_authorized = check_auth(method_request)
+        authorized = time.time()
+        PHASE_SECONDS.observe(("auth",), authorized - validated)
+        if is_authorized:
+            if method_request.method in handler_router:
+                with span(method_request.method):
+                    response, code = handler_router[method_request.method](
+                        method_request.arguments,
+                        method_request.is_admin,
+                        ctx,
+                        store
+                    )
+                PHASE_SECONDS.observe(("handler",), time.time() - authorized)
             else:
                 response, code = 'method not found', NOT_FOUND
         else:
@@ -372,68 +535,439 @@ def method_handler(request, ctx, store):
     return response, code
 
 
+def profile_handler(request, ctx, store):
+    """Admin route starting and stopping the runtime profiler, the body is
+    a /method request with "start", "stop" or "status" as the method."""
+    actions = {
+        'start': lambda arguments: profiler.start(arguments.get('mode'), arguments.get('requests'),
+                                                  arguments.get('seconds')),
+        'stop': lambda arguments: {'path': profiler.stop()},
+        'status': lambda arguments: profiler.status(),
+    }
+    profile_request = MethodRequest(request['body'])
+    if not profile_request.is_valid():
+        return profile_request.get_errors(), INVALID_REQUEST
+    ctx['method'] = 'profile.%s' % profile_request.method
+    if not profile_request.is_admin or not check_auth(profile_request):
+        return 'invalid token', FORBIDDEN
+    if profile_request.method not in actions:
+        return 'method not found', NOT_FOUND
+    try:
+        return actions[profile_request.method](profile_request.arguments or {}), OK
+    except ValueError as e:
+        return str(e), INVALID_REQUEST
+
+
+def build_response(response, code):
+    if code not in ERRORS:
+        return {"response": response, "code": code}
+    return {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
+
+
+def make_local_cache(opts):
+    if not getattr(opts, 'local_cache_size', 0):
+        return None
+    return LocalCache(opts.local_cache_size, opts.local_cache_ttl)
+
+
+def pool_size(opts):
+    """Default pool maximum: a connection for every request thread and
+    every background thread borrowing one (refreshes, write-behind)."""
+    size = getattr(opts, 'threads', 1) + getattr(opts, 'cache_refresh_workers', REFRESH_WORKERS)
+    if getattr(opts, 'cache_write_behind', 0):
+        size += 1
+    return size
+
+
+def make_store(opts, local_cache=None):
+    retry_policy = RetryPolicy(deadline=getattr(opts, 'cache_deadline', RETRY_DEADLINE))
+    nodes = getattr(opts, 'cache_nodes', None)
+    return Store(opts.cache_type, opts.cache_address, opts.cache_port, local_cache=local_cache,
+                 retry_policy=retry_policy, nodes=nodes.split(',') if nodes else None,
+                 replicas=getattr(opts, 'cache_replicas', 1),
+                 lock_timeout=getattr(opts, 'cache_lock_timeout', None),
+                 refresh_beta=getattr(opts, 'cache_refresh_beta', REFRESH_BETA),
+                 stale_ttl=getattr(opts, 'cache_stale_ttl', STALE_TTL),
+                 refresh_workers=getattr(opts, 'cache_refresh_workers', REFRESH_WORKERS),
+                 write_behind=getattr(opts, 'cache_write_behind', 0),
+                 write_behind_policy=getattr(opts, 'cache_write_behind_policy', 'drop_new'),
+                 min_size=getattr(opts, 'pool_min_size', POOL_MIN_SIZE),
+                 max_size=getattr(opts, 'pool_max_size', None) or pool_size(opts),
+                 idle_timeout=getattr(opts, 'pool_idle_timeout', POOL_IDLE_TIMEOUT))
+
+
+def make_access_log(opts):
+    return AccessLog(getattr(opts, 'access_log', None), getattr(opts, 'access_log_sample', 1.0),
+                     getattr(opts, 'access_log_batch', ACCESS_LOG_BATCH_SIZE))
+
+
+def make_tracer(opts):
+    slow_ms = getattr(opts, 'trace_slow_ms', None)
+    return Tracer(getattr(opts, 'trace_file', None), getattr(opts, 'trace_sample', 0.0),
+                  slow_ms / 1000.0 if slow_ms is not None else None)
+
+
+def configure_profiler(opts):
+    profiler.configure(getattr(opts, 'profile_dir', None), getattr(opts, 'profile_mode', None),
+                       getattr(opts, 'profile_requests', None), getattr(opts, 'profile_seconds', None))
+
+
 def make_handler_class(opts):
+    local_cache = make_local_cache(opts)
+    configure_profiler(opts)
+
     class MainHTTPHandler(BaseHTTPRequestHandler):
         router = {
             "method": method_handler,
+            "profile": profile_handler,
         }
-        store = Store(opts.cache_type, opts.cache_address, opts.cache_port)
+        # persistent connections: every response is framed by Content-Length,
+        # pipelined requests are read one by one from the buffered rfile
+        protocol_version = "HTTP/1.1"
+        # idle time after which a keep-alive connection is closed, also the
+        # socket timeout of a request that is being read
+        timeout = getattr(opts, 'keepalive_timeout', KEEPALIVE_TIMEOUT)
+        keepalive_requests = getattr(opts, 'keepalive_requests', KEEPALIVE_REQUESTS)
+        requests_served = 0
+        # the whole response goes out in one write, see handle_one_request
+        wbufsize = -1
+        disable_nagle_algorithm = True
+        access_log = make_access_log(opts)
+        tracer = make_tracer(opts)
+        stores = {}
+        stores_lock = threading.Lock()
+
+        @property
+        def store(self):
+            # every forked process builds its own store after the fork,
+            # threads of a process share it through its connection pool
+            pid = os.getpid()
+            store = self.stores.get(pid)
+            if store is None:
+                with self.stores_lock:
+                    store = self.stores.get(pid)
+                    if store is None:
+                        store = self.stores[pid] = make_store(opts, local_cache)
+            return store
 
         def get_request_id(self, headers):
-            return headers.get('HTTP_X_REQUEST_ID', uuid.uuid4().hex)
+            return headers.get('X-Request-ID') or uuid.uuid4().hex
+
+        def connections_waiting(self):
+            """True if accepted connections wait for a free worker thread."""
+            queue = getattr(self.server, 'requests', None)
+            if queue is not None:
+                return not queue.empty()
+            return bool(select.select([self.server.socket], [], [], 0)[0])
+
+        def handle(self):
+            self.close_connection = 1
+            self.handle_one_request()
+            while not self.close_connection and self.wait_for_request():
+                self.handle_one_request()
+
+        def wait_for_request(self):
+            """Wait for the next request of a keep-alive connection. False
+            when it idled for ``timeout``, the server is closing or other
+            clients wait for the worker thread: an idle connection does not
+            hold the thread, or the only thread without a pool."""
+            # socket._fileobject keeps what it read past the last request
+            if self.rfile._rbuf.tell():
+                return True
+            start = time.time()
+            deadline = start + self.timeout
+            while not getattr(self.server, 'closing', False):
+                now = time.time()
+                if now >= deadline:
+                    return False
+                if now - start < KEEPALIVE_GRACE:
+                    wait = start + KEEPALIVE_GRACE - now
+                elif self.connections_waiting():
+                    return False
+                else:
+                    wait = KEEPALIVE_POLL_INTERVAL
+                try:
+                    if select.select([self.connection], [], [], min(wait, deadline - now))[0]:
+                        return True
+                except select.error:
+                    # interrupted by a signal, SIGTERM sets server.closing
+                    pass
+            return False
+
+        def send_connection_header(self):
+            # a connection holds its worker thread, give it up when the
+            # request limit is reached or other clients are waiting
+            self.requests_served += 1
+            if (self.requests_served >= self.keepalive_requests or getattr(self.server, 'closing', False)
+                    or self.connections_waiting()):
+                self.close_connection = 1
+            if self.close_connection:
+                self.send_header("Connection", "close")
+
+        def log_request(self, code='-', size='-'):
+            # requests go to the structured access log
+            pass
+
+        def log_access(self, context, code, start):
+            record = dict(context, path=self.path, code=code, time=start,
+                          latency_ms=round((time.time() - start) * 1000, 3))
+            self.access_log.log(record)
+
+        def do_GET(self):
+            if self.path.strip("/") != "metrics":
+                self.send_error(NOT_FOUND)
+                return
+            gauges = {}
+            if local_cache is not None:
+                gauges.update(("local_cache_%s" % name, value) for name, value in local_cache.stats().items())
+            body = registry.render(gauges)
+            self.send_response(OK)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_connection_header()
+            self.end_headers()
+            self.wfile.write(body)
 
         def do_POST(self):
-            response, code = {}, OK
+            start = time.time()
             context = {"request_id": self.get_request_id(self.headers)}
-            request = None
+            trace = self.tracer.start(context["request_id"])
+            profiled = profiler.begin()
             try:
-                data_string = self.rfile.read(int(self.headers['Content-Length']))
-                request = json.loads(data_string)
-            except Exception as e:
-                print e
-                code = BAD_REQUEST
+                code = self.handle_method_request(context)
+            finally:
+                profiler.end(profiled)
+                self.tracer.finish(trace)
+            REQUESTS.inc((context.get("method", ""), code))
+            PHASE_SECONDS.observe(("request",), time.time() - start)
+            self.log_access(context, code, start)
+
+        def handle_method_request(self, context):
+            response, code = {}, OK
+            request = None
+            start = time.time()
+            with span("parse"):
+                try:
+                    data_string = self.rfile.read(int(self.headers['Content-Length']))
+                    request = json.loads(data_string)
+                except Exception as e:
+                    print e
+                    code = BAD_REQUEST
+                    # the body was not read as framed, the next request can not be found
+                    self.close_connection = 1
+            PHASE_SECONDS.observe(("parse",), time.time() - start)
 
             if request:
                 path = self.path.strip("/")
-                logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
+                logging.debug("%s: %s %s", self.path, data_string, context["request_id"])
                 if path in self.router:
                     try:
-                        response, code = self.router[path]({"body": request, "headers": self.headers}, context, self.store)
+                        with span("route", path=path):
+                            response, code = self.router[path]({"body": request, "headers": self.headers},
+                                                               context, self.store)
                     except Exception, e:
                         logging.exception("Unexpected error: %s" % e)
                         code = INTERNAL_ERROR
                 else:
                     code = NOT_FOUND
 
-            self.send_response(code)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            if code not in ERRORS:
-                r = {"response": response, "code": code}
-            else:
-                r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
-            context.update(r)
-            logging.info(context)
-            self.wfile.write(json.dumps(r))
-            return
+            with span("write", code=code):
+                r = build_response(response, code)
+                logging.debug("%s: %s", context["request_id"], r)
+                body = json.dumps(r)
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.send_connection_header()
+                self.end_headers()
+                self.wfile.write(body)
+            return code
     return MainHTTPHandler
 
 
+class ThreadPoolHTTPServer(HTTPServer):
+    """HTTPServer that hands accepted connections to a fixed pool of threads."""
+
+    def __init__(self, server_address, handler_class, threads):
+        HTTPServer.__init__(self, server_address, handler_class)
+        self.threads = threads
+        self.requests = Queue.Queue()
+        self.workers = []
+        # connections being served, to wake up idle keep-alive readers on close
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        self.closing = False
+
+    def start_workers(self):
+        # started lazily, so that forked processes run their own pool
+        for _ in range(self.threads):
+            worker = threading.Thread(target=self.process_requests)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def process_requests(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            with self.connections_lock:
+                self.connections.add(request)
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                with self.connections_lock:
+                    self.connections.discard(request)
+            self.shutdown_request(request)
+
+    def process_request(self, request, client_address):
+        if not self.workers:
+            self.start_workers()
+        self.requests.put((request, client_address))
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.closing = True
+        # a request in progress is answered, a connection waiting for the
+        # next request reads EOF instead of waiting for the idle timeout
+        with self.connections_lock:
+            for connection in self.connections:
+                try:
+                    connection.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+        # let workers finish queued requests before they exit
+        for _ in self.workers:
+            self.requests.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def make_server(opts):
+    MainHTTPHandler = make_handler_class(opts)
+    if opts.threads > 1:
+        return ThreadPoolHTTPServer(("localhost", opts.port), MainHTTPHandler, opts.threads)
+    return HTTPServer(("localhost", opts.port), MainHTTPHandler)
+
+
+def serve(server):
+    stopped = threading.Event()
+
+    def stop(signum, frame):
+        stopped.set()
+        # idle keep-alive connections are closed instead of waiting out their timeout
+        server.closing = True
+
+    def toggle_profiler(signum, frame):
+        # not in the handler itself, it may interrupt a request holding the profiler lock
+        threading.Thread(target=profiler.toggle).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, toggle_profiler)
+    server.timeout = POLL_INTERVAL
+    while not stopped.is_set():
+        server.handle_request()
+    server.server_close()
+    store = server.RequestHandlerClass.stores.get(os.getpid())
+    if store is not None:
+        store.close()
+    server.RequestHandlerClass.access_log.close()
+    server.RequestHandlerClass.tracer.close()
+    profiler.stop()
+
+
+def serve_forked(server, workers):
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                serve(server)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def forward(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signum)
+            except OSError:
+                pass
+
+    def stop(signum, frame):
+        forward(signal.SIGTERM, frame)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGUSR1, forward)
+    server.socket.close()
+    while children:
+        try:
+            pid, _ = os.wait()
+        except OSError:
+            continue
+        children.remove(pid)
+        logging.info("Worker %s stopped" % pid)
+
+
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=PORT)
     op.add_option("-c", "--cache_address", action="store", default=DEFAULT_CACHE_ADDRESS)
     op.add_option("-k", "--cache_type", action="store", default=DEFAULT_CACHE_CLIENT)
     op.add_option("--cache_port", action="store", default=11211)
+    op.add_option("--cache_nodes", action="store", default=None, help="host:port,host:port,...")
+    op.add_option("--cache_replicas", action="store", type=int, default=1)
+    op.add_option("--cache_deadline", action="store", type=float, default=RETRY_DEADLINE)
+    op.add_option("--cache_lock_timeout", action="store", type=float, default=None,
+                  help="seconds a score miss waits for another server computing it")
+    op.add_option("--cache_refresh_beta", action="store", type=float, default=REFRESH_BETA,
+                  help="how early scores are refreshed before they expire, 0 to wait for the expiry")
+    op.add_option("--cache_stale_ttl", action="store", type=int, default=STALE_TTL,
+                  help="seconds an expired score is still served while it is refreshed")
+    op.add_option("--cache_refresh_workers", action="store", type=int, default=REFRESH_WORKERS,
+                  help="threads refreshing scores in the background")
+    op.add_option("--cache_write_behind", action="store", type=int, default=0,
+                  help="queue up to this many cache writes and store them in the background")
+    op.add_option("--cache_write_behind_policy", action="store", default="drop_new",
+                  choices=list(WRITE_BEHIND_POLICIES), help="which write to drop when the queue is full")
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option("--access_log", action="store", default=None,
+                  help="JSON lines access log, the main log when not set")
+    op.add_option("--access_log_sample", action="store", type=float, default=1.0,
+                  help="share of successful requests to log")
+    op.add_option("--access_log_batch", action="store", type=int, default=ACCESS_LOG_BATCH_SIZE)
+    op.add_option("--trace_file", action="store", default=None, help="JSON lines file for request traces")
+    op.add_option("--trace_sample", action="store", type=float, default=0.01, help="share of requests to trace")
+    op.add_option("--trace_slow_ms", action="store", type=float, default=None,
+                  help="also trace every request slower than this")
+    op.add_option("--profile_dir", action="store", default=".", help="where profiles are written")
+    op.add_option("--profile_mode", action="store", default="cprofile", choices=["cprofile", "sample"],
+                  help="profiler started by SIGUSR1")
+    op.add_option("--profile_requests", action="store", type=int, default=PROFILE_REQUESTS)
+    op.add_option("--profile_seconds", action="store", type=float, default=PROFILE_SECONDS)
+    op.add_option("--debug", action="store_true", default=False, help="also log request and response bodies")
+    op.add_option("--keepalive_timeout", action="store", type=float, default=KEEPALIVE_TIMEOUT,
+                  help="seconds an idle keep-alive connection is kept open")
+    op.add_option("--keepalive_requests", action="store", type=int, default=KEEPALIVE_REQUESTS,
+                  help="requests served on one connection before it is closed")
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("-t", "--threads", action="store", type=int, default=1)
+    op.add_option("--local_cache_size", action="store", type=int, default=0)
+    op.add_option("--local_cache_ttl", action="store", type=float, default=LOCAL_CACHE_TTL)
+    op.add_option("--pool_min_size", action="store", type=int, default=POOL_MIN_SIZE)
+    op.add_option("--pool_max_size", action="store", type=int, default=None)
+    op.add_option("--pool_idle_timeout", action="store", type=float, default=POOL_IDLE_TIMEOUT)
     (opts, args) = op.parse_args()
-    logging.basicConfig(filename=opts.log, level=logging.INFO,
+    logging.basicConfig(filename=opts.log, level=logging.DEBUG if opts.debug else logging.INFO,
                         format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
-    MainHTTPHandler = make_handler_class(opts)
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
-    logging.info("Starting server at %s" % opts.port)
-    try:
-        server.serve_forever()
-    except KeyboardInterrupt:
-        pass
-    server.server_close()
+    server = make_server(opts)
+    logging.info("Starting server at %s (workers: %s, threads: %s)" % (opts.port, opts.workers, opts.threads))
+    if opts.workers > 1:
+        serve_forked(server, opts.workers)
+    else:
+        serve(server)
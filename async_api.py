@@ -0,0 +1,516 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Event driven front end for the scoring api.
+
+Serves the same ``/method`` route with the same request validation,
+auth and responses as api.py, but runs every connection in one process on
+an asyncore event loop. Memcache and redis are reached through pipelined
+non-blocking clients, so a slow store call never blocks other clients.
+Handlers are written in callback style: instead of returning
+``(response, code)`` they call ``done(response, code)``.
+
+    python async_api.py -p 8081 -k memcache
+"""
+
+import asynchat
+import asyncore
+import collections
+import cPickle
+import datetime
+import json
+import logging
+import signal
+import socket
+import sys
+import time
+import uuid
+from BaseHTTPServer import BaseHTTPRequestHandler
+from optparse import OptionParser
+
+import api
+from scoring import SCORE_TTL, get_score_key, compute_score, get_interests_key, decode_interests
+from store import MEMCACHE_PORT, REDIS_PORT, RETRY_COUNT, wrap_fresh, unwrap_fresh
+
+CRLF = "\r\n"
+STORE_TIMEOUT = 3
+POLL_INTERVAL = 0.1
+MEMCACHE_FLAG_PICKLE = 1
+MEMCACHE_FLAG_INTEGER = 2
+MEMCACHE_FLAG_LONG = 4
+MEMCACHE_FLAG_TEXT = 16
+
+
+class Reply(object):
+    """Final value produced by a reply parser."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def memcache_encode(value):
+    # same flags as python-memcached, so both front ends share the cache
+    if type(value) is str:
+        return 0, value
+    if type(value) is unicode:
+        return MEMCACHE_FLAG_TEXT, value.encode('utf-8')
+    if type(value) is int:
+        return MEMCACHE_FLAG_INTEGER, '%d' % value
+    if type(value) is long:
+        return MEMCACHE_FLAG_LONG, str(value)
+    return MEMCACHE_FLAG_PICKLE, cPickle.dumps(value, 0)
+
+
+def memcache_decode(flags, data):
+    if flags & MEMCACHE_FLAG_TEXT:
+        return data.decode('utf-8')
+    if flags & MEMCACHE_FLAG_INTEGER:
+        return int(data)
+    if flags & MEMCACHE_FLAG_LONG:
+        return long(data)
+    if flags & MEMCACHE_FLAG_PICKLE:
+        return cPickle.loads(data)
+    return data
+
+
+def memcache_get_reply():
+    line = yield CRLF
+    if line.startswith('VALUE'):
+        _, _, flags, length = line.split()[:4]
+        data = yield int(length) + 2
+        yield CRLF
+        yield Reply(memcache_decode(int(flags), data[:-2]))
+    else:
+        yield Reply(None)
+
+
+def memcache_set_reply():
+    line = yield CRLF
+    yield Reply(True if line == 'STORED' else 0)
+
+
+def redis_command(*args):
+    parts = ["*%d\r\n" % len(args)]
+    for arg in args:
+        arg = repr(arg) if isinstance(arg, float) else str(arg)
+        parts.append("$%d\r\n%s\r\n" % (len(arg), arg))
+    return "".join(parts)
+
+
+def redis_bulk_reply():
+    line = yield CRLF
+    if line.startswith('$') and line != '$-1':
+        data = yield int(line[1:]) + 2
+        yield Reply(data[:-2])
+    else:
+        yield Reply(None)
+
+
+def redis_status_reply():
+    line = yield CRLF
+    yield Reply(True if line.startswith('+') else 0)
+
+
+class StoreConnection(asynchat.async_chat):
+    """Pipelined connection to a cache server.
+
+    Commands are written as soon as they are issued and replies are matched
+    to callbacks in order. Every reply is read by a parser generator that
+    yields the next terminator (a delimiter or a byte count), receives the
+    data read up to it and finally yields a Reply.
+    """
+
+    def __init__(self, address, socket_map):
+        asynchat.async_chat.__init__(self, map=socket_map)
+        self.address = address
+        self.buffer = []
+        self.pending = collections.deque()
+        self.closed = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect(address)
+
+    def send_command(self, data, parser, callback, deadline):
+        self.pending.append((parser, callback, deadline))
+        if len(self.pending) == 1:
+            self.set_terminator(next(parser))
+        self.push(data)
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data, self.buffer = "".join(self.buffer), []
+        if not self.pending:
+            return
+        parser, callback, _ = self.pending[0]
+        step = parser.send(data)
+        if not isinstance(step, Reply):
+            self.set_terminator(step)
+            return
+        self.pending.popleft()
+        self.set_terminator(next(self.pending[0][0]) if self.pending else CRLF)
+        self.run_callback(callback, step.value)
+
+    def run_callback(self, callback, value):
+        try:
+            callback(value)
+        except Exception as e:
+            logging.exception("Unexpected error in store callback: %s" % e)
+
+    def check_timeout(self, now):
+        if self.pending and self.pending[0][2] < now:
+            logging.error("Store reply timed out: %s:%s" % self.address)
+            self.handle_close()
+
+    def handle_connect(self):
+        pass
+
+    def handle_error(self):
+        logging.error("Store connection error %s:%s: %s" % (self.address + (sys.exc_info()[1],)))
+        self.handle_close()
+
+    def handle_close(self):
+        self.closed = True
+        self.close()
+        pending, self.pending = self.pending, collections.deque()
+        for _, callback, _ in pending:
+            self.run_callback(callback, None)
+
+
+class AsyncCacheClient(object):
+    default_port = None
+
+    def __init__(self, address, port, timeout, socket_map):
+        self.address = (address, int(port or self.default_port))
+        self.timeout = timeout
+        self.socket_map = socket_map
+        self.connection = None
+
+    def command(self, data, parser, callback):
+        if self.connection is None or self.connection.closed:
+            self.connection = StoreConnection(self.address, self.socket_map)
+        self.connection.send_command(data, parser, callback, time.time() + self.timeout)
+
+    def check_timeouts(self, now):
+        if self.connection is not None and not self.connection.closed:
+            self.connection.check_timeout(now)
+
+
+class AsyncMemCacheClient(AsyncCacheClient):
+    default_port = MEMCACHE_PORT
+
+    def get(self, key, callback):
+        self.command("get %s\r\n" % key, memcache_get_reply(), callback)
+
+    def set(self, key, value, time, callback):
+        flags, data = memcache_encode(value)
+        self.command("set %s %d %d %d\r\n%s\r\n" % (key, flags, time, len(data), data), memcache_set_reply(), callback)
+
+
+class AsyncRedisClient(AsyncCacheClient):
+    default_port = REDIS_PORT
+
+    def get(self, key, callback):
+        self.command(redis_command("GET", key), redis_bulk_reply(), callback)
+
+    def set(self, key, value, time, callback):
+        self.command(redis_command("SET", key, value, "EX", time), redis_status_reply(), callback)
+
+
+class AsyncStore(object):
+    """Callback based counterpart of store.Store with the same retry rules."""
+
+    def __init__(self, client_type, address='127.0.0.1', port=None, timeout=STORE_TIMEOUT, socket_map=None):
+        clients = {
+            'redis': AsyncRedisClient,
+            'memcache': AsyncMemCacheClient,
+        }
+        self.client = clients.get(client_type, AsyncMemCacheClient)(address, port, timeout, socket_map)
+        self.retry_count = RETRY_COUNT
+
+    def _get(self, key, callback, retries):
+        def on_value(value):
+            if value is None and retries > 0:
+                self._get(key, callback, retries - 1)
+            else:
+                callback(value)
+        self.client.get(key, on_value)
+
+    def get(self, key, callback):
+        """Pass the value to callback, or None if it can not be read."""
+        self._get(key, callback, self.retry_count)
+
+    def cache_get(self, key, callback):
+        # a cache miss is not retried, the caller recomputes the value
+        self.client.get(key, callback)
+
+    def cache_set(self, key, value, time, callback=None):
+        self.client.set(key, value, time, callback or (lambda result: None))
+
+    def check_timeouts(self, now):
+        self.client.check_timeouts(now)
+
+
+def guarded(callback, done):
+    """Turn an exception in a store callback into an internal error response."""
+    def wrapper(*args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            done(None, api.INTERNAL_ERROR)
+    return wrapper
+
+
+def get_score(store, callback, done, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    """Pass the score to callback; any error answers the request with done()."""
+    if birthday is None:
+        birthday = datetime.datetime.now()
+    key = get_score_key(first_name, last_name, birthday)
+
+    def on_cached(raw):
+        # scores are cached in the envelope of Store.cache_fetch, shared with api.py
+        score, _, expires_at = unwrap_fresh(raw)
+        if score and (expires_at is None or expires_at > time.time()):
+            callback(float(score))
+            return
+        start = time.time()
+        score = compute_score(phone, email, birthday, gender, first_name, last_name)
+        finished = time.time()
+        store.cache_set(key, wrap_fresh(score, finished - start, finished + SCORE_TTL), SCORE_TTL)
+        callback(score)
+    store.cache_get(key, guarded(on_cached, done))
+
+
+def online_score_handler(arguments, is_admin, ctx, store, done):
+    online_score_request = api.OnlineScoreRequest(arguments)
+    if is_admin:
+        response, code = {'score': 42}, api.OK
+    elif online_score_request.is_valid():
+        ctx['has'] = online_score_request.not_null_fields
+        attrs = online_score_request.get_data()
+        get_score(store, lambda score: done({'score': score}, api.OK), done, **attrs)
+        return
+    else:
+        response, code = online_score_request.get_errors(), api.INVALID_REQUEST
+    ctx['has'] = online_score_request.not_null_fields
+    done(response, code)
+
+
+def clients_interests_handler(arguments, is_admin, ctx, store, done):
+    clients_interests_request = api.ClientsInterestsRequest(arguments)
+    is_valid = clients_interests_request.is_valid()
+    try:
+        ctx['nclients'] = len(clients_interests_request.client_ids)
+    except TypeError:
+        ctx['nclients'] = 0
+    if not is_valid:
+        done(clients_interests_request.get_errors(), api.INVALID_REQUEST)
+        return
+    client_ids = clients_interests_request.client_ids
+    response = {}
+    state = {'pending': len(client_ids), 'failed': False}
+
+    def on_interests(client_id, value):
+        if state['failed']:
+            return
+        if value is None:
+            state['failed'] = True
+            logging.error("Unexpected error: Cache Reading Error")
+            done(None, api.INTERNAL_ERROR)
+            return
+        response[client_id] = decode_interests(value)
+        state['pending'] -= 1
+        if not state['pending']:
+            done(response, api.OK)
+
+    for client_id in client_ids:
+        callback = guarded(lambda value, client_id=client_id: on_interests(client_id, value), done)
+        store.get(get_interests_key(client_id), callback)
+
+
+def method_handler(request, ctx, store, done):
+    handler_router = {
+        'online_score': online_score_handler,
+        'clients_interests': clients_interests_handler
+    }
+    method_request = api.MethodRequest(request['body'])
+    if not method_request.is_valid():
+        done(method_request.get_errors(), api.INVALID_REQUEST)
+    elif not api.check_auth(method_request):
+        done('invalid token', api.FORBIDDEN)
+    elif method_request.method not in handler_router:
+        done('method not found', api.NOT_FOUND)
+    else:
+        handler_router[method_request.method](method_request.arguments, method_request.is_admin, ctx, store, done)
+
+
+class HTTPChannel(asynchat.async_chat):
+    """One client connection; keep-alive and pipelined requests are
+    answered strictly in order."""
+
+    def __init__(self, sock, server):
+        asynchat.async_chat.__init__(self, sock, map=server.socket_map)
+        self.server = server
+        self.buffer = []
+        self.head = None
+        self.requests = collections.deque()
+        self.busy = False
+        self.set_terminator("\r\n\r\n")
+
+    def collect_incoming_data(self, data):
+        self.buffer.append(data)
+
+    def found_terminator(self):
+        data, self.buffer = "".join(self.buffer), []
+        if self.head is None:
+            try:
+                self.head = self.parse_head(data)
+            except ValueError:
+                self.requests.append(("", {}, False, ""))
+                self.process_next()
+                return
+            length = int(self.head[1].get('content-length') or 0)
+            if length > 0:
+                self.set_terminator(length)
+                return
+            data = ""
+        path, headers, keep_alive = self.head
+        self.requests.append((path, headers, keep_alive, data))
+        self.head = None
+        self.set_terminator("\r\n\r\n")
+        self.process_next()
+
+    def parse_head(self, data):
+        lines = data.lstrip(CRLF).split(CRLF)
+        command, path, version = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+        return path, headers, keep_alive
+
+    def process_next(self):
+        if self.busy or not self.requests:
+            return
+        self.busy = True
+        path, headers, keep_alive, data = self.requests.popleft()
+        context = {"request_id": headers.get('x-request-id') or uuid.uuid4().hex}
+        state = {'sent': False}
+
+        def done(response, code):
+            if state['sent']:
+                return
+            state['sent'] = True
+            self.send_result(response, code, context, keep_alive)
+
+        request, code = None, api.OK
+        try:
+            request = json.loads(data)
+        except Exception as e:
+            logging.error("Bad request: %s" % e)
+            code = api.BAD_REQUEST
+        if not request:
+            done({}, code)
+            return
+        logging.info("%s: %s %s" % (path, data, context["request_id"]))
+        route = self.server.router.get(path.strip("/"))
+        if route is None:
+            done({}, api.NOT_FOUND)
+            return
+        try:
+            route({"body": request, "headers": headers}, context, self.server.store, done)
+        except Exception as e:
+            logging.exception("Unexpected error: %s" % e)
+            done(None, api.INTERNAL_ERROR)
+
+    def send_result(self, response, code, context, keep_alive):
+        if code not in api.ERRORS:
+            r = {"response": response, "code": code}
+        else:
+            r = {"error": response or api.ERRORS.get(code, "Unknown Error"), "code": code}
+        context.update(r)
+        logging.info(context)
+        body = json.dumps(r)
+        reason = BaseHTTPRequestHandler.responses.get(code, ('',))[0]
+        head = [
+            "HTTP/1.1 %d %s" % (code, reason),
+            "Content-Type: application/json",
+            "Content-Length: %d" % len(body),
+        ]
+        if not keep_alive:
+            head.append("Connection: close")
+        self.push(CRLF.join(head) + CRLF + CRLF + body)
+        self.busy = False
+        if keep_alive:
+            self.process_next()
+        else:
+            self.close_when_done()
+
+    def handle_error(self):
+        logging.exception("HTTP connection error")
+        self.close()
+
+
+class AsyncHTTPServer(asyncore.dispatcher):
+    router = {
+        "method": method_handler,
+    }
+
+    def __init__(self, address, store, socket_map):
+        asyncore.dispatcher.__init__(self, map=socket_map)
+        self.socket_map = socket_map
+        self.store = store
+        self.running = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+        self.server_address = self.socket.getsockname()
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            HTTPChannel(pair[0], self)
+
+    def serve_forever(self, poll_interval=POLL_INTERVAL):
+        self.running = True
+        while self.running:
+            asyncore.loop(timeout=poll_interval, map=self.socket_map, count=1)
+            self.store.check_timeouts(time.time())
+        asyncore.close_all(map=self.socket_map)
+
+    def stop(self):
+        self.running = False
+
+
+def make_server(opts):
+    socket_map = {}
+    store = AsyncStore(opts.cache_type, opts.cache_address, opts.cache_port,
+                       timeout=opts.cache_timeout, socket_map=socket_map)
+    return AsyncHTTPServer(("localhost", opts.port), store, socket_map)
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-p", "--port", action="store", type=int, default=api.PORT)
+    op.add_option("-c", "--cache_address", action="store", default=api.DEFAULT_CACHE_ADDRESS)
+    op.add_option("-k", "--cache_type", action="store", default=api.DEFAULT_CACHE_CLIENT)
+    op.add_option("--cache_port", action="store", default=None)
+    op.add_option("--cache_timeout", action="store", type=float, default=STORE_TIMEOUT)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    server = make_server(opts)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    logging.info("Starting async server at %s" % opts.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
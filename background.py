@@ -0,0 +1,38 @@
+"""Daemon threads started lazily, once per process."""
+
+import os
+import threading
+
+# starting is rare, one lock serves every object
+start_lock = threading.Lock()
+
+
+class BackgroundThreads(object):
+    """Mixin for objects served by ``workers`` daemon threads running
+    ``self.run``.
+
+    start() starts the threads on first use in every process: forked
+    workers inherit the object but not its threads. starting() runs just
+    before the threads are started.
+    """
+    workers = 1
+    threads = ()
+    pid = None
+
+    def start(self):
+        if self.pid == os.getpid():
+            return
+        with start_lock:
+            if self.pid != os.getpid():
+                self.starting()
+                self.threads = [threading.Thread(target=self.run) for _ in range(self.workers)]
+                for thread in self.threads:
+                    thread.daemon = True
+                    thread.start()
+                self.pid = os.getpid()
+
+    def starting(self):
+        pass
+
+    def run(self):
+        raise NotImplementedError
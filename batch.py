@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Offline batch mode: run a JSONL file of ``method`` request bodies
+through method_handler without HTTP.
+
+Input is read line by line, so memory does not grow with the file.
+Responses are written as JSONL in input order, one per request, in the
+same format as the HTTP API.
+
+    python batch.py -i requests.jsonl -o responses.jsonl -w 4
+    cat requests.jsonl | python batch.py > responses.jsonl
+"""
+
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from optparse import OptionParser
+
+import api
+
+CHUNK_SIZE = 100
+WINDOW_CHUNKS = 8
+REPORT_EVERY = 100000
+
+store = None
+
+
+def init_worker(opts):
+    global store
+    store = api.make_store(opts)
+
+
+def process_line(line):
+    """Handle one request body, return the response as a JSON line."""
+    context = {}
+    try:
+        request = json.loads(line)
+    except ValueError:
+        request = None
+    if not isinstance(request, dict):
+        return json.dumps(api.build_response(None, api.BAD_REQUEST))
+    try:
+        response, code = api.method_handler({"body": request, "headers": {}}, context, store)
+    except Exception as e:
+        logging.exception("Unexpected error: %s" % e)
+        response, code = None, api.INTERNAL_ERROR
+    return json.dumps(api.build_response(response, code))
+
+
+def read_lines(lines):
+    for line in lines:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def process_lines(lines, pool=None, workers=1, chunksize=CHUNK_SIZE):
+    """Yield the responses in input order. The pool gets a bounded window
+    of lines at a time, Pool.imap alone would queue the whole input."""
+    lines = read_lines(lines)
+    if pool is None:
+        for line in lines:
+            yield process_line(line)
+        return
+    window_size = workers * chunksize * WINDOW_CHUNKS
+    while True:
+        window = list(itertools.islice(lines, window_size))
+        if not window:
+            return
+        for response in pool.imap(process_line, window, chunksize):
+            yield response
+
+
+def run(lines, output, opts):
+    """Write the response to every request line, return the count."""
+    workers = getattr(opts, 'workers', 1)
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker, (opts,))
+    else:
+        pool = None
+        init_worker(opts)
+    responses = process_lines(lines, pool, workers, getattr(opts, 'chunksize', CHUNK_SIZE))
+    count = 0
+    start = time.time()
+    try:
+        for count, response in enumerate(responses, 1):
+            output.write(response + "\n")
+            if count % REPORT_EVERY == 0:
+                logging.info("%d requests, %.0f requests/s" % (count, count / (time.time() - start)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        else:
+            store.close()
+    elapsed = time.time() - start
+    logging.info("Done: %d requests in %.1fs, %.0f requests/s" % (count, elapsed, count / elapsed if elapsed else 0))
+    return count
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-i", "--input", action="store", default="-")
+    op.add_option("-o", "--output", action="store", default="-")
+    op.add_option("-w", "--workers", action="store", type=int, default=1)
+    op.add_option("--chunksize", action="store", type=int, default=CHUNK_SIZE)
+    op.add_option("-c", "--cache_address", action="store", default=api.DEFAULT_CACHE_ADDRESS)
+    op.add_option("-k", "--cache_type", action="store", default=api.DEFAULT_CACHE_CLIENT)
+    op.add_option("--cache_port", action="store", default=11211)
+    op.add_option("--cache_nodes", action="store", default=None, help="host:port,host:port,...")
+    op.add_option("--cache_replicas", action="store", type=int, default=1)
+    op.add_option("--cache_deadline", action="store", type=float, default=api.RETRY_DEADLINE)
+    op.add_option("-l", "--log", action="store", default=None)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(filename=opts.log, level=logging.INFO,
+                        format='[%(asctime)s] %(levelname).1s %(message)s', datefmt='%Y.%m.%d %H:%M:%S')
+    input_file = sys.stdin if opts.input == "-" else open(opts.input)
+    output_file = sys.stdout if opts.output == "-" else open(opts.output, "w")
+    try:
+        run(input_file, output_file, opts)
+    finally:
+        input_file.close()
+        output_file.close()
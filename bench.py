@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for the request validation hot path.
+
+Every field validator and check_auth is measured on a valid and an
+invalid corpus, next to whole request validation, and the store codecs
+encode and decode typical interest lists. Rates are values (or
+requests) per second, best of ``--repeat`` runs.
+
+    python bench.py
+    python bench.py -n 20000 -r 5 online_score 'field.phone.*'
+    python bench.py 'codec.*' --sizes
+    python bench.py --json > results.json
+    python bench.py --compare HEAD~3 HEAD
+"""
+
+import collections
+import fnmatch
+import functools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+from optparse import OptionParser
+import api
+import store
+
+USER_TOKEN = "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"
+ONLINE_SCORE_ARGUMENTS = {"phone": "79175002040", "email": "test@otus.ru", "first_name": "TestName",
+                          "last_name": "TestSurname", "birthday": "01.01.1990", "gender": 1}
+INVALID_ONLINE_SCORE_ARGUMENTS = {"phone": "89175002040", "email": "test.otus.ru", "first_name": 1,
+                                  "last_name": "TestSurname", "birthday": "01.01.1890", "gender": 5}
+CLIENTS_INTERESTS_ARGUMENTS = {"client_ids": range(10), "date": "20.07.2017"}
+METHOD_BODY = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+               "token": USER_TOKEN, "arguments": ONLINE_SCORE_ARGUMENTS}
+
+# field name -> (field, valid corpus, invalid corpus)
+FIELD_CORPORA = collections.OrderedDict([
+    ("char", (api.CharField(required=False, nullable=True),
+              ["TestName", u"TestName", "horns&hoofs"], [120, ["TestName"], {"name": 1}])),
+    ("email", (api.EmailField(required=False, nullable=True),
+               ["test@otus.ru", u"test@otus.ru"], ["test.otus.ru", 120, "test"])),
+    ("phone", (api.PhoneField(required=False, nullable=True),
+               ["79175002040", 79175002040], ["89175002040", "7917500", 1.5])),
+    ("date", (api.DateField(required=False, nullable=True),
+              ["20.07.2017", "01.01.1990"], ["2017-07-20", "32.01.2017", 20072017])),
+    ("birthday", (api.BirthDayField(required=False, nullable=True),
+                  ["01.01.1990", "31.12.2000"], ["01.01.1890", "1990", "31.02.1990"])),
+    ("gender", (api.GenderField(required=False, nullable=True), [0, 1, 2], [3, "1", -1])),
+    ("client_ids", (api.ClientIDsField(required=True),
+                    [range(10), [1]], [10, ["1", "2"], range(9) + ["9"]])),
+])
+
+INTERESTS = ["cars", "pets", "travel", "hi-tech", "sport", "music", "books", "tv", "cinema", "geek", "otus"]
+# one to four interests per client, as get_interests_many reads them
+INTEREST_LISTS = [[INTERESTS[(i + j) % len(INTERESTS)] for j in range(i % 4 + 1)] for i in range(20)]
+
+AuthRequest = collections.namedtuple("AuthRequest", "account login token")
+
+
+def admin_token():
+    return api.hashlib.sha512(api.datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+
+
+def auth_corpora():
+    valid = [AuthRequest("horns&hoofs", "h&f", USER_TOKEN), AuthRequest("horns&hoofs", "admin", admin_token())]
+    invalid = [AuthRequest("horns&hoofs", "h&f", "bad"), AuthRequest("horns&hoofs", "admin", USER_TOKEN)]
+    return valid, invalid
+
+
+def field_validator(field):
+    """Validate one value with the field; older revisions keep the value
+    on the field and have no run_validation."""
+    if hasattr(field, "run_validation"):
+        return field.run_validation
+
+    def validate(value):
+        field.value = value
+        field.validate()
+    return validate
+
+
+def corpus_benchmark(func, corpus):
+    def bench():
+        for value in corpus:
+            func(value)
+    bench.size = len(corpus)
+    return bench
+
+
+def codec_corpora():
+    """Return codec name -> the encoded interest lists, "legacy" is the
+    plain JSON written before the format prefix."""
+    corpora = collections.OrderedDict([("legacy", [json.dumps(value) for value in INTEREST_LISTS])])
+    if hasattr(store, "dumps"):
+        for codec in ("json", "msgpack"):
+            corpora[codec] = [store.dumps(value, codec) for value in INTEREST_LISTS]
+    return corpora
+
+
+def codec_sizes():
+    return collections.OrderedDict((name, sum(map(len, corpus))) for name, corpus in codec_corpora().items())
+
+
+def bench_method_request():
+    api.MethodRequest(METHOD_BODY).is_valid()
+
+
+def bench_online_score():
+    api.OnlineScoreRequest(ONLINE_SCORE_ARGUMENTS).is_valid()
+
+
+def bench_online_score_invalid():
+    api.OnlineScoreRequest(INVALID_ONLINE_SCORE_ARGUMENTS).is_valid()
+
+
+def bench_clients_interests():
+    api.ClientsInterestsRequest(CLIENTS_INTERESTS_ARGUMENTS).is_valid()
+
+
+def get_benchmarks():
+    benchmarks = [
+        ("method_request", bench_method_request),
+        ("online_score", bench_online_score),
+        ("online_score.invalid", bench_online_score_invalid),
+        ("clients_interests", bench_clients_interests),
+    ]
+    for name, (field, valid, invalid) in FIELD_CORPORA.items():
+        validate = field_validator(field)
+        benchmarks.append(("field.%s.valid" % name, corpus_benchmark(validate, valid)))
+        benchmarks.append(("field.%s.invalid" % name, corpus_benchmark(validate, invalid)))
+    valid, invalid = auth_corpora()
+    benchmarks.append(("check_auth.valid", corpus_benchmark(api.check_auth, valid)))
+    benchmarks.append(("check_auth.invalid", corpus_benchmark(api.check_auth, invalid)))
+    loads = getattr(store, "loads", json.loads)
+    for name, corpus in codec_corpora().items():
+        benchmarks.append(("codec.%s.decode" % name, corpus_benchmark(loads, corpus)))
+        if name != "legacy":
+            encode = functools.partial(store.dumps, codec=name)
+            benchmarks.append(("codec.%s.encode" % name, corpus_benchmark(encode, INTEREST_LISTS)))
+    return benchmarks
+
+
+def run_benchmark(func, number, repeat):
+    """Return the best rate in calls (corpus values) per second."""
+    best = min(timeit.repeat(func, number=number, repeat=repeat))
+    return number * getattr(func, "size", 1) / best
+
+
+def run_benchmarks(patterns, number, repeat):
+    """Return name -> rate, None for benchmarks this revision can not run."""
+    results = collections.OrderedDict()
+    for name, func in get_benchmarks():
+        if patterns and not any(fnmatch.fnmatch(name, pattern) for pattern in patterns):
+            continue
+        try:
+            results[name] = run_benchmark(func, number, repeat)
+        except Exception as e:
+            sys.stderr.write("%s skipped: %r\n" % (name, e))
+            results[name] = None
+    return results
+
+
+def git_revision(revision="HEAD", cwd=None):
+    return subprocess.check_output(["git", "rev-parse", "--short", revision], cwd=cwd).strip()
+
+
+def run_revision(revision, args):
+    """Run this bench.py against the code of a git revision, return its JSON results."""
+    root = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp()
+    try:
+        archive = subprocess.Popen(["git", "archive", revision], cwd=root, stdout=subprocess.PIPE)
+        subprocess.check_call(["tar", "-x", "-C", workdir], stdin=archive.stdout)
+        archive.wait()
+        shutil.copy(os.path.join(root, "bench.py"), workdir)
+        output = subprocess.check_output([sys.executable, "bench.py", "--json"] + args, cwd=workdir)
+    finally:
+        shutil.rmtree(workdir)
+    results = json.loads(output, object_pairs_hook=collections.OrderedDict)
+    results["revision"] = git_revision(revision, cwd=root)
+    return results
+
+
+def format_rate(rate):
+    return "%12.0f" % rate if rate is not None else "%12s" % "n/a"
+
+
+def format_comparison(base, head):
+    lines = ["%-28s %12s %12s %8s" % ("benchmark", base["revision"], head["revision"], "change")]
+    for name, head_rate in head["results"].items():
+        base_rate = base["results"].get(name)
+        change = "%+7.1f%%" % ((head_rate / base_rate - 1) * 100) if base_rate and head_rate else "%8s" % ""
+        lines.append("%-28s %s %s %s" % (name, format_rate(base_rate), format_rate(head_rate), change))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] [benchmark pattern ...]")
+    op.add_option("-n", "--number", action="store", type=int, default=10000)
+    op.add_option("-r", "--repeat", action="store", type=int, default=3)
+    op.add_option("--json", action="store_true", default=False, help="print machine-readable results")
+    op.add_option("--sizes", action="store_true", default=False,
+                  help="also print the stored bytes of the interest lists per codec")
+    op.add_option("--compare", action="store", nargs=2, metavar="BASE HEAD", default=None,
+                  help="run the benchmarks on two git revisions and compare them")
+    (opts, args) = op.parse_args()
+    if opts.compare:
+        bench_args = ["-n", str(opts.number), "-r", str(opts.repeat)] + args
+        base, head = [run_revision(revision, bench_args) for revision in opts.compare]
+        if opts.json:
+            print json.dumps({"base": base, "head": head}, indent=2)
+        else:
+            print format_comparison(base, head)
+        sys.exit(0)
+    results = run_benchmarks(args, opts.number, opts.repeat)
+    if opts.json:
+        print json.dumps({"python": platform.python_version(), "number": opts.number, "repeat": opts.repeat,
+                          "results": results}, indent=2)
+    else:
+        for name, rate in results.items():
+            print "%-28s %s /s" % (name, format_rate(rate))
+    if opts.sizes:
+        for name, size in codec_sizes().items():
+            print "%-28s %12d bytes for %d interest lists" % ("size." + name, size, len(INTEREST_LISTS))
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""In-process stand-ins for memcached and redis.
+
+Both servers keep data in a dict and speak just enough of the wire
+protocol for the store clients: memcache text protocol ``get``, ``set``,
+``add``, ``delete`` and redis ``GET``, ``MGET``, ``SET`` (with ``EX`` and
+``NX``), ``DEL``, ``PING``. They are meant
+for tests and benchmarks, not for production.
+
+    server = FakeMemcacheServer()
+    server.start()
+    store = Store('memcache', *server.server_address)
+    ...
+    server.stop()
+"""
+
+import socket
+import threading
+import time
+import SocketServer
+
+
+class FakeCacheServer(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=("127.0.0.1", 0)):
+        SocketServer.ThreadingTCPServer.__init__(self, address, self.handler_class)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.connections = set()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+        # clients keep their sockets open, unblock the handler threads
+        for connection in list(self.connections):
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def process_request(self, request, client_address):
+        self.connections.add(request)
+        SocketServer.ThreadingTCPServer.process_request(self, request, client_address)
+
+    def shutdown_request(self, request):
+        self.connections.discard(request)
+        SocketServer.ThreadingTCPServer.shutdown_request(self, request)
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            value, expire_at = item
+            if expire_at and expire_at < time.time():
+                del self.data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.data[key] = (value, time.time() + ttl if ttl else 0)
+
+    def add(self, key, value, ttl):
+        """Set the key unless it holds a live value, return whether it was set."""
+        with self.lock:
+            item = self.data.get(key)
+            if item is not None and not (item[1] and item[1] < time.time()):
+                return False
+            self.data[key] = (value, time.time() + ttl if ttl else 0)
+            return True
+
+    def delete(self, key):
+        with self.lock:
+            return self.data.pop(key, None) is not None
+
+
+class FakeCacheHandler(SocketServer.StreamRequestHandler):
+    # one segment per reply, small writes would wait for delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+
+class MemcacheHandler(FakeCacheHandler):
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command = getattr(self, "do_%s" % parts[0].lower(), None)
+            if command is None:
+                self.wfile.write("ERROR\r\n")
+            else:
+                command(parts[1:])
+            self.wfile.flush()
+
+    def do_get(self, keys):
+        for key in keys:
+            item = self.server.get(key)
+            if item is not None:
+                flags, data = item
+                self.wfile.write("VALUE %s %s %d\r\n%s\r\n" % (key, flags, len(data), data))
+        self.wfile.write("END\r\n")
+
+    def do_set(self, args):
+        key, flags, ttl, length = args[:4]
+        data = self.rfile.read(int(length) + 2)[:-2]
+        self.server.set(key, (flags, data), int(ttl))
+        if "noreply" not in args:
+            self.wfile.write("STORED\r\n")
+
+    def do_add(self, args):
+        key, flags, ttl, length = args[:4]
+        data = self.rfile.read(int(length) + 2)[:-2]
+        added = self.server.add(key, (flags, data), int(ttl))
+        if "noreply" not in args:
+            self.wfile.write("STORED\r\n" if added else "NOT_STORED\r\n")
+
+    def do_delete(self, args):
+        deleted = self.server.delete(args[0])
+        self.wfile.write("DELETED\r\n" if deleted else "NOT_FOUND\r\n")
+
+    def do_version(self, args):
+        self.wfile.write("VERSION fake\r\n")
+
+
+class RedisHandler(FakeCacheHandler):
+    def handle(self):
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            method = getattr(self, "do_%s" % command[0].lower(), None)
+            if method is None:
+                self.wfile.write("-ERR unknown command '%s'\r\n" % command[0])
+            else:
+                method(command[1:])
+            self.wfile.flush()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith("*"):
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def write_bulk(self, value):
+        if value is None:
+            self.wfile.write("$-1\r\n")
+        else:
+            self.wfile.write("$%d\r\n%s\r\n" % (len(value), value))
+
+    def do_ping(self, args):
+        self.wfile.write("+PONG\r\n")
+
+    def do_get(self, args):
+        self.write_bulk(self.server.get(args[0]))
+
+    def do_mget(self, args):
+        self.wfile.write("*%d\r\n" % len(args))
+        for key in args:
+            self.write_bulk(self.server.get(key))
+
+    def do_set(self, args):
+        key, value, options = args[0], args[1], [arg.lower() for arg in args[2:]]
+        ttl = int(options[options.index("ex") + 1]) if "ex" in options else 0
+        if "nx" in options:
+            if not self.server.add(key, value, ttl):
+                self.write_bulk(None)
+                return
+        else:
+            self.server.set(key, value, ttl)
+        self.wfile.write("+OK\r\n")
+
+    def do_del(self, args):
+        deleted = sum(1 for key in args if self.server.delete(key))
+        self.wfile.write(":%d\r\n" % deleted)
+
+
+class FakeMemcacheServer(FakeCacheServer):
+    handler_class = MemcacheHandler
+
+    def put(self, key, value, ttl=0):
+        """Store a plain string the way python-memcached does."""
+        self.set(key, (0, value), ttl)
+
+
+class FakeRedisServer(FakeCacheServer):
+    handler_class = RedisHandler
+
+    def put(self, key, value, ttl=0):
+        self.set(key, value, ttl)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Load test of the HTTP API against in-process fake memcache/redis.
+
+Starts a make_server() server on a random port, drives it from
+``--concurrency`` client threads with a weighted mix of scenarios and
+prints RPS and p50/p95/p99 latency per scenario. Clients keep their
+connections open, can open one per request or pipeline several requests
+on a connection. Results can be saved as a baseline, later runs are
+compared against it and fail on regressions.
+
+    python loadtest.py -c 8 -n 5000
+    python loadtest.py --connection close --mix online_score_hit=1
+    python loadtest.py --pipeline 8 --mix online_score_hit=1
+    python loadtest.py -k redis --mix online_score_hit=1,clients_interests=1 --ids 50
+    python loadtest.py --codec msgpack --mix clients_interests=1 --ids 50
+    python loadtest.py --baseline loadtest_baseline.json --save
+    python loadtest.py --baseline loadtest_baseline.json
+"""
+
+import collections
+import datetime
+import hashlib
+import itertools
+import json
+import socket
+import sys
+import threading
+import time
+from optparse import OptionParser, Values
+
+import api
+import fake_cache
+import store
+
+USER_TOKEN = "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"
+HIT_ARGUMENTS = {"phone": "79175002040", "email": "test@otus.ru", "first_name": "TestName",
+                 "last_name": "TestSurname", "birthday": "01.01.1990", "gender": 1}
+DEFAULT_MIX = "online_score_hit=4,online_score_miss=2,admin=1,clients_interests=3"
+DEFAULT_TOLERANCE = 0.2
+REQUEST = "POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: %d\r\n%s\r\n%s"
+FAKE_SERVERS = {
+    "memcache": fake_cache.FakeMemcacheServer,
+    "redis": fake_cache.FakeRedisServer,
+}
+
+
+def method_body(method, arguments, login="h&f", token=USER_TOKEN):
+    return json.dumps({"account": "horns&hoofs", "login": login, "method": method,
+                       "token": token, "arguments": arguments})
+
+
+def make_scenarios(client_ids):
+    """Return scenario name -> function(n) giving (request body, expected code)."""
+    ids = range(client_ids)
+
+    def online_score_hit(n):
+        return method_body("online_score", HIT_ARGUMENTS), api.OK
+
+    def online_score_miss(n):
+        arguments = dict(HIT_ARGUMENTS, first_name="name%d" % n)
+        return method_body("online_score", arguments), api.OK
+
+    def admin(n):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        return method_body("online_score", {}, login=api.ADMIN_LOGIN, token=token), api.OK
+
+    def clients_interests(n):
+        return method_body("clients_interests", {"client_ids": ids}), api.OK
+
+    return collections.OrderedDict([
+        ("online_score_hit", online_score_hit),
+        ("online_score_miss", online_score_miss),
+        ("admin", admin),
+        ("clients_interests", clients_interests),
+    ])
+
+
+def parse_mix(mix):
+    """Parse "name=weight,..." into a list of (name, weight)."""
+    weights = []
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        weights.append((name.strip(), int(weight or 1)))
+    return weights
+
+
+def prepare_cache(cache, client_ids, codec=None):
+    """Fill the interests, as plain JSON without a codec."""
+    for cid in range(client_ids):
+        interests = ["books", "music"]
+        cache.put("i:%s" % cid, store.dumps(interests, codec) if codec else json.dumps(interests))
+
+
+class Connection(object):
+    """Client connection sending a batch of requests at once (pipelined)
+    and reading their responses in order. With ``keepalive`` off every
+    request asks the server to close the connection."""
+
+    def __init__(self, port, keepalive=True):
+        self.port = port
+        self.keepalive = keepalive
+        self.sock = None
+        self.fp = None
+
+    def connect(self):
+        self.sock = socket.create_connection(("localhost", self.port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fp = self.sock.makefile("rb")
+
+    def close(self):
+        if self.sock is not None:
+            self.fp.close()
+            self.sock.close()
+            self.sock = self.fp = None
+
+    def read_response(self):
+        """Return (response code, whether the server closes the connection)."""
+        if not self.fp.readline():
+            raise IOError("Connection closed by the server")
+        length, close = 0, False
+        while True:
+            line = self.fp.readline()
+            if line in ("\r\n", "\n", ""):
+                break
+            name, _, value = line.partition(":")
+            name = name.strip().lower()
+            if name == "content-length":
+                length = int(value)
+            elif name == "connection":
+                close = value.strip().lower() == "close"
+        return json.loads(self.fp.read(length))["code"], close
+
+    def exchange(self, bodies):
+        """Return [(code, latency)] for the requests, code is None for the
+        failed ones. Requests the server did not answer before closing the
+        connection are sent again on a new one."""
+        results = []
+        start = time.time()
+        headers = "" if self.keepalive else "Connection: close\r\n"
+        try:
+            while len(results) < len(bodies):
+                pending = bodies[len(results):] if self.keepalive else bodies[len(results):len(results) + 1]
+                if self.sock is None:
+                    self.connect()
+                self.sock.sendall("".join(REQUEST % (len(body), headers, body) for body in pending))
+                for _ in pending:
+                    code, close = self.read_response()
+                    results.append((code, time.time() - start))
+                    if close:
+                        self.close()
+                        break
+        except (IOError, ValueError):
+            self.close()
+            results.extend((None, time.time() - start) for _ in bodies[len(results):])
+        return results
+
+
+def run_load(port, scenarios, mix, concurrency, requests=None, duration=None, keepalive=True, pipeline=1):
+    """Fire requests until ``requests`` were sent or ``duration`` seconds
+    passed, every client sends ``pipeline`` requests at a time. Return
+    (latencies per scenario, errors per scenario, elapsed)."""
+    schedule = [name for name, weight in mix for _ in range(weight)]
+    counter = itertools.count()
+    deadline = time.time() + duration if duration else None
+    results = []
+
+    def worker():
+        latencies = collections.defaultdict(list)
+        errors = collections.Counter()
+        connection = Connection(port, keepalive)
+        while True:
+            batch = []
+            for _ in range(pipeline):
+                n = next(counter)
+                if requests is not None and n >= requests or deadline is not None and time.time() >= deadline:
+                    break
+                name = schedule[n % len(schedule)]
+                batch.append((name,) + scenarios[name](n))
+            if not batch:
+                break
+            for (name, _, expected_code), (code, latency) in zip(
+                    batch, connection.exchange([body for _, body, _ in batch])):
+                latencies[name].append(latency)
+                if code != expected_code:
+                    errors[name] += 1
+            if len(batch) < pipeline:
+                break
+        connection.close()
+        results.append((latencies, errors))
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    latencies = collections.defaultdict(list)
+    errors = collections.Counter()
+    for thread_latencies, thread_errors in results:
+        for name, values in thread_latencies.items():
+            latencies[name].extend(values)
+        errors.update(thread_errors)
+    return latencies, errors, elapsed
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0
+    rank = max(int(round(percent / 100.0 * len(values))) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    """Return {scenario: {requests, errors, rps, p50, p95, p99}}, latencies
+    in milliseconds, with the "total" row over all scenarios."""
+    rows = collections.OrderedDict()
+    everything = []
+    for name in sorted(latencies):
+        values = sorted(latencies[name])
+        everything.extend(values)
+        rows[name] = summarize_row(values, errors[name], elapsed)
+    rows["total"] = summarize_row(sorted(everything), sum(errors.values()), elapsed)
+    return rows
+
+
+def summarize_row(values, errors, elapsed):
+    return {
+        "requests": len(values),
+        "errors": errors,
+        "rps": len(values) / elapsed if elapsed else 0,
+        "p50": percentile(values, 50) * 1000,
+        "p95": percentile(values, 95) * 1000,
+        "p99": percentile(values, 99) * 1000,
+    }
+
+
+def compare(baseline, summary, tolerance=DEFAULT_TOLERANCE):
+    """Return the regressions of summary against baseline: RPS lower or
+    p95/p99 higher than the tolerance allows, or new errors."""
+    regressions = []
+    for name, row in summary.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if row["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append("%s: rps %.0f < %.0f" % (name, row["rps"], base["rps"]))
+        for key in ("p95", "p99"):
+            if row[key] > base[key] * (1 + tolerance):
+                regressions.append("%s: %s %.2f ms > %.2f ms" % (name, key, row[key], base[key]))
+        if row["errors"] > base["errors"]:
+            regressions.append("%s: %d errors" % (name, row["errors"]))
+    return regressions
+
+
+def format_summary(summary):
+    lines = ["%-20s %9s %7s %9s %9s %9s %9s" % ("scenario", "requests", "errors", "rps", "p50 ms", "p95 ms",
+                                                "p99 ms")]
+    for name, row in summary.items():
+        lines.append("%-20s %9d %7d %9.0f %9.2f %9.2f %9.2f" % (
+            name, row["requests"], row["errors"], row["rps"], row["p50"], row["p95"], row["p99"]))
+    return "\n".join(lines)
+
+
+def main(opts):
+    cache = FAKE_SERVERS[opts.cache_type]().start()
+    prepare_cache(cache, opts.ids, opts.codec)
+    host, port = cache.server_address
+    server_opts = Values({"port": 0, "threads": opts.threads, "cache_type": opts.cache_type,
+                          "cache_address": host, "cache_port": port, "local_cache_size": opts.local_cache_size,
+                          "local_cache_ttl": api.LOCAL_CACHE_TTL, "cache_write_behind": opts.write_behind})
+    server = api.make_server(server_opts)
+    # BaseHTTPRequestHandler writes every request to stderr
+    server.RequestHandlerClass.log_message = lambda self, format, *args: None
+    thread = threading.Thread(target=server.serve_forever, kwargs={"poll_interval": 0.05})
+    thread.start()
+    try:
+        scenarios = make_scenarios(opts.ids)
+        mix = parse_mix(opts.mix)
+        unknown = [name for name, _ in mix if name not in scenarios]
+        if unknown:
+            raise ValueError("Unknown scenarios: %s" % ", ".join(unknown))
+        latencies, errors, elapsed = run_load(server.server_address[1], scenarios, mix, opts.concurrency,
+                                              opts.requests if not opts.duration else None, opts.duration,
+                                              opts.connection == "keepalive", opts.pipeline)
+    finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+        cache.stop()
+    summary = summarize(latencies, errors, elapsed)
+    print format_summary(summary)
+    if not opts.baseline:
+        return 0
+    if opts.save:
+        with open(opts.baseline, "w") as f:
+            json.dump(summary, f, indent=2)
+        print "Baseline saved to %s" % opts.baseline
+        return 0
+    with open(opts.baseline) as f:
+        regressions = compare(json.load(f), summary, opts.tolerance)
+    for regression in regressions:
+        print "REGRESSION %s" % regression
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-k", "--cache_type", action="store", default=api.DEFAULT_CACHE_CLIENT,
+                  choices=sorted(FAKE_SERVERS))
+    op.add_option("-c", "--concurrency", action="store", type=int, default=8)
+    op.add_option("-n", "--requests", action="store", type=int, default=5000)
+    op.add_option("-d", "--duration", action="store", type=float, default=None,
+                  help="run for this many seconds instead of a request count")
+    op.add_option("-t", "--threads", action="store", type=int, default=8, help="server threads")
+    op.add_option("--local_cache_size", action="store", type=int, default=0)
+    op.add_option("--write_behind", action="store", type=int, default=0, help="server write-behind queue size")
+    op.add_option("--connection", action="store", default="keepalive", choices=["keepalive", "close"],
+                  help="keep client connections open or open one per request")
+    op.add_option("--pipeline", action="store", type=int, default=1,
+                  help="requests a client sends before reading the responses")
+    op.add_option("--mix", action="store", default=DEFAULT_MIX)
+    op.add_option("--codec", action="store", default=None, choices=sorted(store.FORMAT_VERSIONS),
+                  help="format of the interests in the cache, plain JSON by default")
+    op.add_option("--ids", action="store", type=int, default=10, help="client_ids per clients_interests")
+    op.add_option("--baseline", action="store", default=None)
+    op.add_option("--save", action="store_true", default=False, help="save the results as the baseline")
+    op.add_option("--tolerance", action="store", type=float, default=DEFAULT_TOLERANCE)
+    (opts, args) = op.parse_args()
+    sys.exit(main(opts))
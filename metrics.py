@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""In-process counters and histograms in the Prometheus text format.
+
+Metrics are module level objects, cheap enough for the hot path: an
+update is a dict lookup and a few additions under a per-metric lock.
+Every process keeps its own values, a forked worker reports what it
+has served.
+
+    REQUESTS.inc(("online_score", 200))
+    PHASE_SECONDS.observe(("parse",), 0.0002)
+    print registry.render()
+"""
+
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, value) for name, value in zip(names, values))
+
+
+class Counter(object):
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket and +Inf, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def get_count(self, labels=()):
+        state = self.values.get(labels)
+        return sum(state[0]) if state else 0
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        names = self.labelnames + ("le",)
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                yield self.name + "_bucket", format_labels(names, labels + (bound,)), cumulative
+            yield self.name + "_sum", format_labels(self.labelnames, labels), total
+            yield self.name + "_count", format_labels(self.labelnames, labels), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self, gauges=None):
+        """Return the text exposition of all metrics, plus ``gauges``, a
+        dict of name -> value read at render time."""
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, labels, value))
+        for name, value in sorted((gauges or {}).items()):
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUESTS = registry.register(Counter(
+    "api_requests_total", "Requests by method and response code.", ("method", "code")))
+PHASE_SECONDS = registry.register(Histogram(
+    "api_phase_seconds", "Time spent in each phase of a request.", ("phase",)))
+STORE_CALLS = registry.register(Counter(
+    "store_calls_total", "Calls to cache nodes by operation and result.", ("operation", "result")))
+STORE_CALL_SECONDS = registry.register(Histogram(
+    "store_call_seconds", "Latency of calls to cache nodes.", ("operation",)))
+STORE_KEYS = registry.register(Counter(
+    "store_keys_total", "Keys read from the cache by result.", ("result",)))
+STORE_RETRIES = registry.register(Counter(
+    "store_retries_total", "Store calls repeated by the retry policy."))
+STORE_FETCHES = registry.register(Counter(
+    "store_fetches_total", "Cache misses of cache_fetch by how the value was obtained.", ("result",)))
+STORE_WRITE_BEHIND = registry.register(Counter(
+    "store_write_behind_total", "Cache writes through the write-behind queue by result.", ("result",)))
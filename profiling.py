@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""Profiling of a running server, switched on and off at runtime.
+
+A session covers the next ``requests`` requests or the next ``seconds``
+seconds, whichever ends first, and then dumps one aggregated profile:
+
+* ``cprofile`` - deterministic, every request runs under its own
+  cProfile.Profile, merged into a pstats file (``python -m pstats``,
+  snakeviz, gprof2dot);
+* ``sample`` - a background thread samples the stacks of the threads
+  serving requests every ``interval`` seconds and writes the counts in
+  the collapsed format of flamegraph.pl / speedscope.
+
+The profiler is process-wide, like the metrics registry: every forked
+worker profiles its own requests and writes its own file.
+
+    profiler.start("cprofile", requests=1000)
+    token = profiler.begin()
+    ...  # serve a request
+    profiler.end(token)
+"""
+
+import collections
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+
+MODES = ("cprofile", "sample")
+DEFAULT_REQUESTS = 1000
+DEFAULT_SECONDS = 60.0
+SAMPLE_INTERVAL = 0.005
+
+
+class Session(object):
+    """Counts the requests taken into a profile and knows when it is over."""
+
+    extension = None
+
+    def __init__(self, requests, seconds):
+        self.requests = requests
+        self.deadline = time.time() + seconds if seconds else None
+        self.started = time.time()
+        self.begun = 0
+        self.ended = 0
+        self.lock = threading.Lock()
+
+    def claim(self):
+        """Take the request into the profile, False when the session is full."""
+        with self.lock:
+            if self.requests is not None and self.begun >= self.requests:
+                return False
+            if self.deadline is not None and time.time() >= self.deadline:
+                return False
+            self.begun += 1
+            return True
+
+    def release(self):
+        """Return True once the last request of the session has ended."""
+        with self.lock:
+            self.ended += 1
+            return self.requests is not None and self.ended >= self.requests
+
+    def status(self):
+        return {"mode": self.mode, "requests": self.ended, "seconds": round(time.time() - self.started, 3)}
+
+    def stop(self):
+        pass
+
+
+class CProfileSession(Session):
+    mode = "cprofile"
+    extension = "prof"
+
+    def __init__(self, requests, seconds):
+        super(CProfileSession, self).__init__(requests, seconds)
+        self.stats = None
+
+    def begin(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def end(self, profile):
+        profile.disable()
+        with self.lock:
+            if self.stats is None:
+                self.stats = pstats.Stats(profile)
+            else:
+                self.stats.add(profile)
+
+    def dump(self, path):
+        with self.lock:
+            if self.stats is None:
+                return False
+            self.stats.dump_stats(path)
+        return True
+
+
+class SampleSession(Session):
+    mode = "sample"
+    extension = "collapsed"
+
+    def __init__(self, requests, seconds, interval=SAMPLE_INTERVAL):
+        super(SampleSession, self).__init__(requests, seconds)
+        self.interval = interval
+        # thread ident -> number of its requests in progress
+        self.threads = collections.Counter()
+        self.stacks = collections.Counter()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def begin(self):
+        ident = threading.current_thread().ident
+        with self.lock:
+            self.threads[ident] += 1
+        return ident
+
+    def end(self, ident):
+        with self.lock:
+            self.threads[ident] -= 1
+            if not self.threads[ident]:
+                del self.threads[ident]
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        with self.lock:
+            threads = list(self.threads)
+        frames = sys._current_frames()
+        for ident in threads:
+            frame = frames.get(ident)
+            if frame is not None:
+                self.stacks[collapse(frame)] += 1
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def dump(self, path):
+        if not self.stacks:
+            return False
+        with open(path, "w") as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write("%s %d\n" % (stack, count))
+        return True
+
+
+def collapse(frame):
+    """Return the stack as "outer;...;inner" of file:function frames."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+SESSIONS = {
+    "cprofile": CProfileSession,
+    "sample": SampleSession,
+}
+
+
+class Profiler(object):
+    def __init__(self, directory=".", mode="cprofile", requests=DEFAULT_REQUESTS, seconds=DEFAULT_SECONDS):
+        self.directory = directory
+        self.mode = mode
+        self.requests = requests
+        self.seconds = seconds
+        self.session = None
+        self.timer = None
+        self.lock = threading.Lock()
+
+    def configure(self, directory=None, mode=None, requests=None, seconds=None):
+        """Set the defaults of the sessions started without arguments."""
+        self.directory = directory or self.directory
+        self.mode = mode or self.mode
+        self.requests = requests or self.requests
+        self.seconds = seconds or self.seconds
+
+    def start(self, mode=None, requests=None, seconds=None):
+        """Start a session, return its status; a running session is kept.
+
+        Without ``requests`` and ``seconds`` the configured limits apply,
+        with only one of them the session is limited by it alone."""
+        mode = mode or self.mode
+        if mode not in SESSIONS:
+            raise ValueError("Unknown profiling mode %r, expected one of %s" % (mode, ", ".join(MODES)))
+        if requests is None and seconds is None:
+            requests, seconds = self.requests, self.seconds
+        for name, value in (("requests", requests), ("seconds", seconds)):
+            if value is not None and (not isinstance(value, (int, long, float)) or value <= 0):
+                raise ValueError("%s must be a positive number" % name)
+        with self.lock:
+            if self.session is None:
+                self.session = SESSIONS[mode](int(requests) if requests else None, seconds)
+                if seconds:
+                    # end the window even when no request comes in
+                    self.timer = threading.Timer(seconds, self.stop)
+                    self.timer.daemon = True
+                    self.timer.start()
+                logging.info("Profiling started: %s", self.session.status())
+            return self.session.status()
+
+    def stop(self):
+        """Stop the session and dump its profile, return the file path or
+        None when nothing was profiled."""
+        with self.lock:
+            session, self.session = self.session, None
+            timer, self.timer = self.timer, None
+        if session is None:
+            return None
+        if timer is not None and timer is not threading.current_thread():
+            timer.cancel()
+        session.stop()
+        path = os.path.join(self.directory, "profile-%s-%d.%s" % (
+            time.strftime("%Y%m%d-%H%M%S"), os.getpid(), session.extension))
+        if not session.dump(path):
+            logging.info("Profiling stopped, no requests profiled")
+            return None
+        logging.info("Profiling stopped: %s, profile written to %s", session.status(), path)
+        return path
+
+    def toggle(self):
+        if self.session is None:
+            self.start()
+        else:
+            self.stop()
+
+    def status(self):
+        session = self.session
+        return session.status() if session is not None else None
+
+    def begin(self):
+        """Called at the start of every request: (session, token) when the
+        request is profiled, None otherwise."""
+        session = self.session
+        if session is None or not session.claim():
+            return None
+        return session, session.begin()
+
+    def end(self, profiled):
+        if profiled is None:
+            return
+        session, token = profiled
+        session.end(token)
+        if session.release() and session is self.session:
+            self.stop()
+
+
+profiler = Profiler()
@@ -1,22 +1,25 @@
 import hashlib
-import json
+import functools
+import itertools
 import datetime
 
+from store import loads
 
-def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
-    if birthday is None:
-        birthday = datetime.datetime.now()
+SCORE_TTL = 60 * 60
+SCORE_FIELDS = ('phone', 'email', 'birthday', 'gender', 'first_name', 'last_name')
+
+
+def get_score_key(first_name, last_name, birthday):
     key_parts = [
         first_name or "",
         last_name or "",
         birthday.strftime("%Y%m%d"),
     ]
-    key = "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return score
+    return "uid:" + hashlib.md5("".join(key_parts)).hexdigest()
+
+
+def compute_score(phone, email, birthday, gender, first_name, last_name):
+    score = 0
     if phone:
         score += 1.5
     if email:
@@ -25,11 +28,96 @@ def get_score(store, phone, email, birthday=None, gender=None, first_name=None,
         score += 1.5
     if first_name and last_name:
         score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score,  60 * 60)
     return score
 
 
+def get_score(store, phone, email, birthday=None, gender=None, first_name=None, last_name=None):
+    if birthday is None:
+        birthday = datetime.datetime.now()
+    key = get_score_key(first_name, last_name, birthday)
+    # try get from cache, fallback to heavy calculation in case of cache
+    # miss, done once for all the requests missing the key at the same time
+    score = store.cache_fetch(key, lambda: compute_score(phone, email, birthday, gender, first_name, last_name),
+                              SCORE_TTL)
+    # redis hands the cached score back as a string
+    return float(score) if score else score
+
+
+def compute_scores(phones, emails, birthdays, genders, first_names, last_names):
+    """Columnar compute_score: one score per row of the equally long columns."""
+    return [
+        (1.5 if phone else 0) + (1.5 if email else 0) + (1.5 if birthday and gender else 0) +
+        (0.5 if first_name and last_name else 0)
+        for phone, email, birthday, gender, first_name, last_name
+        in itertools.izip(phones, emails, birthdays, genders, first_names, last_names)
+    ]
+
+
+def get_score_keys(first_names, last_names, birthdays):
+    """Columnar get_score_key, every distinct birthday is formatted once."""
+    md5 = hashlib.md5
+    dates = {}
+    keys = []
+    for first_name, last_name, birthday in itertools.izip(first_names, last_names, birthdays):
+        date = dates.get(birthday)
+        if date is None:
+            date = dates[birthday] = birthday.strftime("%Y%m%d")
+        keys.append("uid:" + md5((first_name or "") + (last_name or "") + date).hexdigest())
+    return keys
+
+
+def get_column_scores(store, columns):
+    """Score a batch given as a dict of columns keyed by SCORE_FIELDS, with
+    the same results as get_score row by row. The cache is read and the
+    misses are written back with store.cache_fetch_many."""
+    size = max(len(column) for column in columns.values()) if columns else 0
+    columns = dict((field, columns.get(field) or [None] * size) for field in SCORE_FIELDS)
+    now = datetime.datetime.now()
+    birthdays = [birthday or now for birthday in columns['birthday']]
+    keys = get_score_keys(columns['first_name'], columns['last_name'], birthdays)
+    scores = compute_scores(columns['phone'], columns['email'], birthdays, columns['gender'],
+                            columns['first_name'], columns['last_name'])
+    # as with get_score called row by row, a falsy score is not cached: on
+    # a miss rows sharing a key keep their own score up to the first truthy
+    # one, which the later rows then get
+    first = {}
+    for key, score in itertools.izip(keys, scores):
+        if not first.get(key):
+            first[key] = score
+    cached = store.cache_fetch_many(dict((key, functools.partial(first.get, key)) for key in first), SCORE_TTL)
+    # a miss computed here hands back the very score object, a hit or a
+    # refresh in the background a value read from the cache
+    pending = set(key for key, score in cached.items() if score is first[key])
+    for i, key in enumerate(keys):
+        if key in pending:
+            if scores[i]:
+                pending.discard(key)
+            continue
+        score = cached.get(key)
+        if score:
+            scores[i] = float(score)
+    return scores
+
+
+def get_scores(store, items):
+    """Score a batch of argument dicts, see get_column_scores."""
+    columns = dict((field, [item.get(field) for item in items]) for field in SCORE_FIELDS)
+    return get_column_scores(store, columns)
+
+
+def get_interests_key(cid):
+    return "i:%s" % cid
+
+
+def decode_interests(value):
+    return loads(value) if value else []
+
+
 def get_interests(store, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+    return decode_interests(store.get(get_interests_key(cid)))
+
+
+def get_interests_many(store, cids):
+    keys = dict((get_interests_key(cid), cid) for cid in cids)
+    values = store.get_many(list(keys))
+    return dict((cid, decode_interests(values[key])) for key, cid in keys.items())
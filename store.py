@@ -1,100 +1,1283 @@
+import bisect
+import collections
+import contextlib
+import atexit
+import hashlib
+import json
+import logging
+import os
+import math
+import random
+import threading
+import time as timer
+import weakref
+
 import memcache
+import msgpack
 import redis
 
+from background import BackgroundThreads
+from tracing import span, traced
+from metrics import STORE_CALLS, STORE_CALL_SECONDS, STORE_KEYS, STORE_RETRIES, STORE_FETCHES, STORE_WRITE_BEHIND
+
 
 MEMCACHE_PORT = 11211
 REDIS_PORT = 6379
 RETRY_COUNT = 4
+RETRY_BACKOFF = 0.005
+RETRY_MAX_BACKOFF = 0.05
+RETRY_DEADLINE = 1.0
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 5
+LOCAL_CACHE_SIZE = 10000
+LOCAL_CACHE_TTL = 10
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 10
+POOL_IDLE_TIMEOUT = 300
+POOL_CHECK_INTERVAL = 30
+POOL_MAINTENANCE_TICK = 1
+VIRTUAL_NODES = 160
+LOCK_TTL = 5
+LOCK_POLL_INTERVAL = 0.01
+REFRESH_BETA = 1.0
+STALE_TTL = 60
+REFRESH_WORKERS = 2
+REFRESH_QUEUE_SIZE = 1000
+FRESHNESS_PREFIX = "xf1:"
+WRITE_BEHIND_BATCH_SIZE = 100
+WRITE_BEHIND_FLUSH_INTERVAL = 0.005
+WRITE_BEHIND_POLICIES = ("drop_new", "drop_old")
+# starts an encoded value, followed by the format version byte; values
+# without it are plain JSON written before the formats were introduced
+FORMAT_MARKER = "\x00"
+
+
+class JsonCodec(object):
+    name = "json"
+
+    def dumps(self, value):
+        return json.dumps(value, separators=(",", ":"))
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    name = "msgpack"
+
+    def dumps(self, value):
+        return msgpack.packb(value)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+
+# format version -> codec; a version is never reused for another encoding
+FORMATS = {
+    1: JsonCodec(),
+    2: MsgpackCodec(),
+}
+FORMAT_VERSIONS = dict((codec.name, version) for version, codec in FORMATS.items())
+DEFAULT_CODEC = "json"
+
+
+def dumps(value, codec=DEFAULT_CODEC):
+    """Encode a value for the store, prefixed with its format version."""
+    version = FORMAT_VERSIONS.get(codec)
+    if version is None:
+        raise ValueError("Unknown codec %r" % codec)
+    return FORMAT_MARKER + chr(version) + FORMATS[version].dumps(value)
+
+
+def loads(raw):
+    """Decode a value written by dumps() in any format, or plain JSON."""
+    if raw[:1] != FORMAT_MARKER:
+        return json.loads(raw)
+    codec = FORMATS.get(ord(raw[1:2] or "\x00"))
+    if codec is None:
+        raise ValueError("Unknown format version of the stored value")
+    return codec.loads(raw[2:])
+
+
+class LocalCache(object):
+    """Bounded in-process LRU cache with per-entry TTL.
+
+    Sits in front of the remote cache in Store, so hot keys are served
+    without a network round-trip. May be shared by the stores of all
+    threads of a process.
+    """
+
+    def __init__(self, max_size=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires_at = entry
+            if expires_at < timer.time():
+                self.expirations += 1
+                self.misses += 1
+                return None
+            # move the key to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, timer.time() + ttl)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+class StoreUnavailable(IOError):
+    pass
+
+
+class RetryPolicy(object):
+    """How a Store retries a call: at most ``retries`` extra attempts with
+    full-jitter exponential backoff, all within ``deadline`` seconds."""
+
+    def __init__(self, retries=RETRY_COUNT, backoff=RETRY_BACKOFF, max_backoff=RETRY_MAX_BACKOFF,
+                 deadline=RETRY_DEADLINE):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def attempts(self):
+        """Yield before every attempt that fits into the deadline, sleeping
+        with backoff in between."""
+        deadline = timer.time() + self.deadline
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = self.delay(attempt)
+                if timer.time() + delay >= deadline:
+                    return
+                timer.sleep(delay)
+            yield attempt
+
+
+class CircuitBreaker(object):
+    """Fails fast while the backend is down.
+
+    Opens after ``failure_threshold`` consecutive failed calls. After
+    ``reset_timeout`` seconds one trial call is let through (half-open):
+    success closes the breaker, any failure of it opens it again.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        with self.lock:
+            if self.state == self.OPEN and timer.time() >= self.opened_at + self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state == self.CLOSED and not self.failures:
+            return
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = timer.time()
+
+    def record_error(self):
+        """A call failed with an unexpected error: it does not count
+        towards opening the breaker, but ends a trial call, which would
+        otherwise keep the breaker half-open for good."""
+        if self.state != self.HALF_OPEN:
+            return
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = timer.time()
+
+    def record_skipped(self):
+        """A call did not reach the backend (no free pooled connection): it
+        says nothing about the backend, a trial call passes its turn on to
+        the next one."""
+        if self.state != self.HALF_OPEN:
+            return
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+class HashRing(object):
+    """Consistent hashing of keys onto nodes.
+
+    Every node is placed on the ring at ``vnodes`` points, a key belongs to
+    the first node clockwise from its hash. Adding or removing one of N
+    nodes moves only about 1/N of the keys, the rest keep their node.
+    """
+
+    def __init__(self, nodes=(), vnodes=VIRTUAL_NODES):
+        self.vnodes = vnodes
+        self.nodes = []
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def add(self, node):
+        self.nodes.append(node)
+        self.build()
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self.build()
+
+    def build(self):
+        ring = sorted((self.hash("%s#%d" % (node.name, i)), index)
+                      for index, node in enumerate(self.nodes) for i in range(self.vnodes))
+        self.points = [point for point, _ in ring]
+        self.owners = [index for _, index in ring]
+
+    def get_nodes(self, key, count=1):
+        """Return up to ``count`` distinct nodes for the key, owner first."""
+        if len(self.nodes) <= 1:
+            return list(self.nodes)
+        position = bisect.bisect(self.points, self.hash(key))
+        count = min(count, len(self.nodes))
+        nodes = []
+        for i in range(len(self.owners)):
+            node = self.nodes[self.owners[(position + i) % len(self.owners)]]
+            if node not in nodes:
+                nodes.append(node)
+                if len(nodes) == count:
+                    break
+        return nodes
+
+    def get_node(self, key):
+        return self.get_nodes(key)[0]
+
+
+class StoreNode(object):
+    """One cache server of a Store with its own circuit breaker."""
+
+    def __init__(self, name, client, breaker):
+        self.name = name
+        self.client = client
+        self.breaker = breaker
+
+    def execute(self, operation, *args):
+        """Call a client operation and record its outcome on the breaker."""
+        start = timer.time()
+        try:
+            with span(operation, node=self.name):
+                result = getattr(self.client, operation)(*args)
+        except PoolExhausted:
+            self.breaker.record_skipped()
+            STORE_CALLS.inc((operation, "error"))
+            raise
+        except StoreUnavailable:
+            self.breaker.record_failure()
+            STORE_CALLS.inc((operation, "error"))
+            raise
+        except Exception:
+            self.breaker.record_error()
+            STORE_CALLS.inc((operation, "error"))
+            raise
+        finally:
+            STORE_CALL_SECONDS.observe((operation,), timer.time() - start)
+        self.breaker.record_success()
+        STORE_CALLS.inc((operation, "ok"))
+        return result
+
+    def __repr__(self):
+        return "<StoreNode %s>" % self.name
+
+
+class Flight(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Runs one call per key at a time: callers that come while it is in
+    flight wait for it and get its result, or its exception."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.flights = {}
+
+    def do(self, key, func):
+        """Return (result, whether this caller ran func)."""
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Flight()
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, False
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+        return flight.result, True
+
+    def do_many(self, keys, func):
+        """do() for many keys: func is called once with the keys not in
+        flight and returns their results as a dict, the other keys wait
+        for their flights. Return (results, the keys this caller ran)."""
+        led, followed = {}, {}
+        with self.lock:
+            for key in keys:
+                flight = self.flights.get(key)
+                if flight is None:
+                    led[key] = self.flights[key] = Flight()
+                else:
+                    followed[key] = flight
+        results = {}
+        if led:
+            # run before waiting, so that callers leading each other's keys can not deadlock
+            try:
+                results.update(func(list(led)))
+            except Exception as e:
+                for flight in led.values():
+                    flight.error = e
+                raise
+            finally:
+                with self.lock:
+                    for key, flight in led.items():
+                        del self.flights[key]
+                        flight.result = results.get(key)
+                for flight in led.values():
+                    flight.event.set()
+        for key, flight in followed.items():
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            results[key] = flight.result
+        return results, list(led)
+
+
+class WriteBehind(BackgroundThreads):
+    """Bounded buffer of cache writes stored by a background thread.
+
+    Writes of a key not yet stored replace each other. A batch is written
+    with one set_many per TTL and node; the thread waits up to
+    ``flush_interval`` for a batch to fill. When ``max_size`` writes are
+    pending, ``drop_new`` rejects the incoming write and ``drop_old``
+    evicts the oldest pending one. close() stores what is pending.
+    """
+
+    def __init__(self, write_many, max_size, batch_size=WRITE_BEHIND_BATCH_SIZE,
+                 flush_interval=WRITE_BEHIND_FLUSH_INTERVAL, policy="drop_new"):
+        if policy not in WRITE_BEHIND_POLICIES:
+            raise ValueError("Unknown write-behind policy %r" % policy)
+        self.write_many = write_many
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        # key -> (value, time)
+        self.pending = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def put(self, key, value, time):
+        """Queue the write, False if it was dropped."""
+        self.start()
+        with self.condition:
+            if key in self.pending:
+                del self.pending[key]
+            elif len(self.pending) >= self.max_size:
+                if self.policy == "drop_new":
+                    STORE_WRITE_BEHIND.inc(("dropped",))
+                    return False
+                self.pending.popitem(last=False)
+                STORE_WRITE_BEHIND.inc(("dropped",))
+            self.pending[key] = (value, time)
+            self.condition.notify()
+        STORE_WRITE_BEHIND.inc(("queued",))
+        return True
+
+    def starting(self):
+        self.closed = False
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                return
+            self.write(batch)
+
+    def next_batch(self):
+        """Wait for writes and take up to batch_size of them, None once
+        closed and drained."""
+        with self.condition:
+            while not self.pending and not self.closed:
+                self.condition.wait()
+            if not self.pending:
+                return None
+            deadline = timer.time() + self.flush_interval
+            while len(self.pending) < self.batch_size and not self.closed:
+                remaining = deadline - timer.time()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+            return [self.pending.popitem(last=False) for _ in range(min(self.batch_size, len(self.pending)))]
+
+    def write(self, batch):
+        by_time = collections.defaultdict(dict)
+        for key, (value, time) in batch:
+            by_time[time][key] = value
+        for time, mapping in by_time.items():
+            try:
+                stored = self.write_many(mapping, time)
+            except Exception:
+                logging.exception("Write-behind of %d keys failed", len(mapping))
+                stored = False
+            STORE_WRITE_BEHIND.inc(("written" if stored else "failed",), len(mapping))
+
+    def close(self):
+        """Store the pending writes and stop the thread."""
+        if self.pid != os.getpid():
+            return
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        for thread in self.threads:
+            thread.join()
+        self.pid = None
+
+
+class Refresher(BackgroundThreads):
+    """Fixed pool of threads running the background refreshes of keys.
+
+    A key is queued once while it waits or is being refreshed. When
+    ``max_size`` refreshes wait, new ones are dropped: the current value
+    keeps being served and a later request queues the key again.
+    """
+
+    def __init__(self, workers=REFRESH_WORKERS, max_size=REFRESH_QUEUE_SIZE):
+        self.workers = workers
+        self.max_size = max_size
+        # key -> refresh function
+        self.pending = collections.OrderedDict()
+        self.running = set()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def submit(self, key, refresh):
+        """Queue the refresh of the key, False if it is already queued or
+        running, or was dropped."""
+        self.start()
+        with self.condition:
+            if key in self.pending or key in self.running:
+                return False
+            if len(self.pending) >= self.max_size:
+                STORE_FETCHES.inc(("refresh_dropped",))
+                return False
+            self.pending[key] = refresh
+            self.condition.notify()
+        return True
+
+    def starting(self):
+        self.closed = False
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed:
+                    return
+                key, refresh = self.pending.popitem(last=False)
+                self.running.add(key)
+            try:
+                refresh()
+            except Exception:
+                logging.exception("Refresh of %s failed", key)
+            finally:
+                with self.condition:
+                    self.running.discard(key)
+                    self.condition.notify_all()
+
+    def join(self, timeout):
+        """Wait up to timeout seconds for the queued refreshes, True if all are done."""
+        deadline = timer.time() + timeout
+        with self.condition:
+            while self.pending or self.running:
+                remaining = deadline - timer.time()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def close(self):
+        """Stop the threads, the queued refreshes are dropped."""
+        if self.pid != os.getpid():
+            return
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.pid = None
+
+
+def wrap_fresh(value, delta, expires_at):
+    """Envelope of a cache_fetch value: when it expires and how long it
+    took to compute."""
+    return "%s%.3f:%.6f:%s" % (FRESHNESS_PREFIX, expires_at, delta, value)
+
+
+def unwrap_fresh(raw):
+    """Return (value, delta, expires_at); plain values have no metadata."""
+    if not isinstance(raw, str) or not raw.startswith(FRESHNESS_PREFIX):
+        return raw, None, None
+    expires_at, delta, value = raw[len(FRESHNESS_PREFIX):].split(":", 2)
+    return value, float(delta), float(expires_at)
+
+
+def parse_node(node):
+    """Accept an (address, port) pair or an "address[:port]" string."""
+    if not isinstance(node, basestring):
+        return node
+    address, _, port = node.partition(':')
+    return address, int(port) if port else None
 
 
 class Store(object):
-    def __init__(self, client_type, address='127.0.0.1', port=None, timeout=20):
+    """Cache/store facade used by the handlers.
+
+    Keys are spread over the ``nodes`` with consistent hashing, a value is
+    written to ``replicas`` nodes and read from the first of them that has
+    it. Every client call runs under the retry policy and the circuit
+    breaker of its node. The socket timeout is capped by the policy
+    deadline, so a dead node costs a request at most about two deadlines,
+    whatever the retry count.
+
+    ``cache_fetch`` computes a missing value once per key however many
+    threads miss it at the same time; with ``lock_timeout`` the processes
+    sharing the cache also coalesce, through a lock key set with memcache
+    ``add`` / redis ``SET NX``. Its values carry their expiry and compute
+    time and are refreshed before they expire, with a probability rising
+    toward the expiry (XFetch, scaled by ``refresh_beta``); they stay in
+    the cache ``stale_ttl`` seconds longer and are served stale meanwhile.
+    Refreshes run on ``refresh_workers`` background threads, see Refresher,
+    unless ``background_refresh`` is off.
+
+    With ``write_behind`` (the queue size) cache_set and cache_set_many
+    only queue the writes, see WriteBehind.
+    """
+
+    def __init__(self, client_type, address='127.0.0.1', port=None, timeout=20, local_cache=None,
+                 retry_policy=None, breaker_factory=CircuitBreaker, nodes=None, replicas=1,
+                 vnodes=VIRTUAL_NODES, lock_timeout=None, refresh_beta=REFRESH_BETA, stale_ttl=STALE_TTL,
+                 background_refresh=True, refresh_workers=REFRESH_WORKERS, refresh_queue_size=REFRESH_QUEUE_SIZE,
+                 write_behind=0, write_behind_policy="drop_new", **pool_options):
         clients = {
             'redis': RedisClient,
             'memcache': MemCacheClient,
         }
-        self.client = clients.get(client_type, MemCacheClient)(address, port, timeout)
-        self.retry_count = RETRY_COUNT
+        client_class = clients.get(client_type, MemCacheClient)
+        self.retry_policy = retry_policy or RetryPolicy()
+        timeout = min(timeout, self.retry_policy.deadline)
+        self.ring = HashRing(vnodes=vnodes)
+        for address, port in map(parse_node, nodes or [(address, port)]):
+            client = client_class(address, port, timeout, **pool_options)
+            name = "{0}:{1}".format(client.ip_address, client.port)
+            self.ring.add(StoreNode(name, client, breaker_factory()))
+        self.replicas = replicas
+        self.local_cache = local_cache
+        self.lock_timeout = lock_timeout
+        self.flights = SingleFlight()
+        self.refresh_beta = refresh_beta
+        self.stale_ttl = stale_ttl
+        self.background_refresh = background_refresh
+        self.refresher = Refresher(refresh_workers, refresh_queue_size)
+        self.write_behind = None
+        if write_behind:
+            self.write_behind = WriteBehind(self._set_many_now, write_behind, policy=write_behind_policy)
 
-    def _get(self, key):
-        value = self.client.get(key)
-        if value is None:
-            for _ in range(self.retry_count):
-                value = self.client.get(key)
+    @property
+    def nodes(self):
+        return self.ring.nodes
+
+    @property
+    def client(self):
+        """Client of the first node, handy for single node stores."""
+        return self.nodes[0].client
+
+    def _get(self, key, retry_miss):
+        nodes = self.ring.get_nodes(key, self.replicas)
+        for attempt in self.retry_policy.attempts():
+            tried = failed = False
+            for node in nodes:
+                if not node.breaker.allow():
+                    continue
+                tried = True
+                try:
+                    value = node.execute('get', key)
+                except StoreUnavailable:
+                    failed = True
+                    continue
                 if value is not None:
-                    break
-        return value
+                    STORE_KEYS.inc(("hit",))
+                    return value
+            if attempt and tried:
+                STORE_RETRIES.inc()
+            if not tried or not (failed or retry_miss):
+                break
+        STORE_KEYS.inc(("miss",))
+        return None
 
+    @traced("store.get")
     def get(self, key):
-        value = self._get(key)
+        value = self._get(key, retry_miss=True)
         if value is None:
             raise IOError('Cache Reading Error')
         return value
 
+    def group_by_node(self, keys, replica=0):
+        """Map every node to the keys it holds as the ``replica``-th copy."""
+        groups = collections.OrderedDict()
+        for key in keys:
+            nodes = self.ring.get_nodes(key, replica + 1)
+            if len(nodes) > replica:
+                groups.setdefault(nodes[replica], []).append(key)
+        return groups
+
+    def _get_many(self, keys, retry_miss):
+        values = {}
+        missing = list(keys)
+        if not missing:
+            return values
+        for attempt in self.retry_policy.attempts():
+            tried = failed = False
+            for replica in range(self.replicas):
+                for node, node_keys in self.group_by_node(missing, replica).items():
+                    if not node.breaker.allow():
+                        continue
+                    tried = True
+                    try:
+                        values.update(node.execute('get_many', node_keys))
+                    except StoreUnavailable:
+                        failed = True
+                missing = [key for key in missing if key not in values]
+                if not missing:
+                    break
+            if attempt and tried:
+                STORE_RETRIES.inc()
+            if not missing or not tried or not (failed or retry_miss):
+                break
+        STORE_KEYS.inc(("hit",), len(values))
+        STORE_KEYS.inc(("miss",), len(missing))
+        return values
+
+    @traced("store.get_many")
+    def get_many(self, keys):
+        """Read all keys with one round-trip per node, retrying only the missing ones."""
+        values = self._get_many(keys, retry_miss=True)
+        if len(values) < len(set(keys)):
+            raise IOError('Cache Reading Error')
+        return values
+
+    @traced("store.cache_get_many")
+    def cache_get_many(self, keys):
+        values = self._cache_get_many(keys)
+        for key, value in values.items():
+            values[key] = unwrap_fresh(value)[0]
+        return values
+
+    def _cache_get_many(self, keys):
+        if self.local_cache is None:
+            return self._get_many(keys, retry_miss=False)
+        values = {}
+        for key in keys:
+            value = self.local_cache.get(key)
+            if value is not None:
+                values[key] = value
+        remote_values = self._get_many([key for key in keys if key not in values], retry_miss=False)
+        for key, value in remote_values.items():
+            self.local_cache.set(key, value)
+        values.update(remote_values)
+        return values
+
+    @traced("store.cache_get")
     def cache_get(self, key):
-        return self._get(key)
+        """Return the cached value, or None on a miss or when the cache is
+        unavailable; a miss is not retried, the caller recomputes."""
+        return unwrap_fresh(self._cache_get(key))[0]
+
+    def _cache_get(self, key):
+        if self.local_cache is None:
+            return self._get(key, retry_miss=False)
+        value = self.local_cache.get(key)
+        if value is None:
+            value = self._get(key, retry_miss=False)
+            if value is not None:
+                self.local_cache.set(key, value)
+        return value
 
+    def _execute(self, node, operation, *args):
+        """Run a write operation on the node under the retry policy, return
+        its result or None when the node is unavailable."""
+        for attempt in self.retry_policy.attempts():
+            if not node.breaker.allow():
+                break
+            if attempt:
+                STORE_RETRIES.inc()
+            try:
+                return node.execute(operation, *args)
+            except StoreUnavailable:
+                continue
+        return None
+
+    def _set(self, node, key, value, time):
+        return self._execute(node, 'set', key, value, time) is not None
+
+    @traced("store.cache_set")
     def cache_set(self, key, value, time):
-        result = self.client.set(key, value, time)
-        if result == 0:
-            for _ in range(self.retry_count):
-                value = self.client.get(key)
+        """Write the value to all its replicas; True if any of them stored it,
+        or in write-behind mode if the write was queued."""
+        if self.local_cache is not None:
+            self.local_cache.set(key, value, time)
+        if self.write_behind is not None:
+            return self.write_behind.put(key, value, time) or 0
+        return self._set_now(key, value, time)
+
+    def _set_now(self, key, value, time):
+        stored = False
+        for node in self.ring.get_nodes(key, self.replicas):
+            stored = self._set(node, key, value, time) or stored
+        return stored or 0
+
+    def _set_many(self, node, mapping, time):
+        return self._execute(node, 'set_many', mapping, time) is not None
+
+    @traced("store.cache_set_many")
+    def cache_set_many(self, mapping, time):
+        """Write all values with one round-trip per node; True if every key
+        was stored on at least one of its replicas, or was queued."""
+        if self.local_cache is not None:
+            for key, value in mapping.items():
+                self.local_cache.set(key, value, time)
+        if self.write_behind is not None:
+            queued = [self.write_behind.put(key, value, time) for key, value in mapping.items()]
+            return all(queued) or 0
+        return self._set_many_now(mapping, time)
+
+    def _set_many_now(self, mapping, time):
+        stored = set()
+        for replica in range(self.replicas):
+            for node, keys in self.group_by_node(mapping, replica).items():
+                if self._set_many(node, dict((key, mapping[key]) for key in keys), time):
+                    stored.update(keys)
+        return len(stored) == len(mapping) or 0
+
+    def cache_add(self, key, value, time):
+        """Store the value only if the key is not set, on its first node;
+        True if stored, False if the key exists, None when unavailable."""
+        return self._execute(self.ring.get_node(key), 'add', key, value, time)
+
+    def cache_delete(self, key):
+        return self._execute(self.ring.get_node(key), 'delete', key)
+
+    @traced("store.cache_fetch")
+    def cache_fetch(self, key, compute, time):
+        """Return the cached value or compute it and cache it for ``time``
+        seconds. Concurrent misses of a key share one computation. An empty
+        cached value (None, 0, "") counts as a miss, like in the scoring code.
+        Values are cached as strings, the caller converts them back."""
+        value, delta, expires_at = unwrap_fresh(self._cache_get(key))
+        if value:
+            if expires_at is not None and self.should_refresh(delta, expires_at):
+                return self._refresh(key, compute, time, value, expires_at)
+            return value
+        value, leader = self.flights.do(key, lambda: self._fill(key, compute, time))
+        if not leader:
+            STORE_FETCHES.inc(("shared",))
+        return value
+
+    @traced("store.cache_fetch_many")
+    def cache_fetch_many(self, computes, time):
+        """cache_fetch for the keys of ``computes``, a dict key -> compute
+        function, with one multi-get and one multi-set for the misses. Hits
+        are refreshed early like in cache_fetch, misses of keys in flight
+        wait for them. Return a dict key -> value."""
+        raws = self._cache_get_many(list(computes))
+        values, missed = {}, {}
+        for key, compute in computes.items():
+            value, delta, expires_at = unwrap_fresh(raws.get(key))
+            if not value:
+                missed[key] = compute
+            elif expires_at is not None and self.should_refresh(delta, expires_at):
+                values[key] = self._refresh(key, compute, time, value, expires_at)
+            else:
+                values[key] = value
+        if missed:
+            computed, led = self.flights.do_many(list(missed), lambda keys: self._compute_many(
+                dict((key, missed[key]) for key in keys), time))
+            if len(led) < len(missed):
+                STORE_FETCHES.inc(("shared",), len(missed) - len(led))
+            values.update(computed)
+        return values
+
+    def _fill(self, key, compute, time):
+        if self.lock_timeout:
+            lock_key = "lock:" + key
+            locked = self.cache_add(lock_key, 1, LOCK_TTL)
+            if locked is False:
+                # another process computes it, wait for its value
+                value = self._wait_for(key)
                 if value:
-                    return True
+                    STORE_FETCHES.inc(("locked",))
+                    return value
+                STORE_FETCHES.inc(("lock_timeout",))
+            elif locked:
+                try:
+                    # the waiting processes poll the cache, do not queue the write
+                    return self._compute(key, compute, time, now=True)
+                finally:
+                    self.cache_delete(lock_key)
+        return self._compute(key, compute, time)
+
+    def should_refresh(self, delta, expires_at):
+        """XFetch: true once expired, before that with a probability that
+        grows with the compute time and the closeness of the expiry."""
+        return timer.time() - delta * self.refresh_beta * math.log(1.0 - random.random()) >= expires_at
+
+    def _refresh(self, key, compute, time, value, expires_at):
+        """Recompute the value, return the one to serve: the fresh one, or
+        the current one while the refresher recomputes it."""
+        if not self.background_refresh:
+            STORE_FETCHES.inc(("refreshed",))
+            return self.flights.do(key, lambda: self._compute(key, compute, time))[0]
+        if timer.time() >= expires_at:
+            STORE_FETCHES.inc(("stale",))
+        if self.refresher.submit(key, lambda: self.flights.do(key, lambda: self._compute(key, compute, time))):
+            STORE_FETCHES.inc(("refreshed",))
+        return value
+
+    def _wait_for(self, key):
+        deadline = timer.time() + self.lock_timeout
+        while timer.time() < deadline:
+            timer.sleep(LOCK_POLL_INTERVAL)
+            value = self.cache_get(key)
+            if value:
+                return value
+        return None
+
+    def _compute(self, key, compute, time, now=False):
+        start = timer.time()
+        value = compute()
+        finished = timer.time()
+        STORE_FETCHES.inc(("computed",))
+        raw = wrap_fresh(value, finished - start, finished + time)
+        if now and self.write_behind is not None:
+            if self.local_cache is not None:
+                self.local_cache.set(key, raw, time + self.stale_ttl)
+            self._set_now(key, raw, time + self.stale_ttl)
+        else:
+            self.cache_set(key, raw, time + self.stale_ttl)
+        return value
+
+    def _compute_many(self, computes, time):
+        values, raws = {}, {}
+        for key, compute in computes.items():
+            start = timer.time()
+            value = values[key] = compute()
+            finished = timer.time()
+            raws[key] = wrap_fresh(value, finished - start, finished + time)
+        STORE_FETCHES.inc(("computed",), len(computes))
+        self.cache_set_many(raws, time + self.stale_ttl)
+        return values
+
+    def close(self):
+        self.refresher.close()
+        if self.write_behind is not None:
+            self.write_behind.close()
+        for node in self.nodes:
+            node.client.close()
+
+
+class PoolExhausted(StoreUnavailable):
+    """No pooled connection freed up in time: local contention, not a
+    failure of the backend."""
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of store connections.
+
+    Keeps between min_size and max_size connections. Borrowing takes the
+    most recently returned connection, or opens a new one while the pool
+    is below max_size, otherwise waits up to wait_timeout. Health checks,
+    idle eviction and refilling to min_size run in a background thread
+    every check_interval seconds, so they never delay a request. A
+    connection returned as broken is closed and dropped from the pool.
+    """
+
+    def __init__(self, factory, check=None, close=None, min_size=POOL_MIN_SIZE, max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT, check_interval=POOL_CHECK_INTERVAL, wait_timeout=None):
+        self.factory = factory
+        self.check = check
+        self.close_connection = close
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size, 1)
+        self.idle_timeout = idle_timeout
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+        self.idle = collections.deque()
+        self.size = 0
+        self.condition = threading.Condition(threading.Lock())
+        self.next_check = timer.time() + check_interval
+        self.refill()
+        if check_interval:
+            pool_maintainer.register(self)
+
+    def acquire(self):
+        with self.condition:
+            deadline = None if self.wait_timeout is None else timer.time() + self.wait_timeout
+            while not self.idle and self.size >= self.max_size:
+                remaining = None if deadline is None else deadline - timer.time()
+                if remaining is not None and remaining <= 0:
+                    raise PoolExhausted('No free store connection')
+                self.condition.wait(remaining)
+            if self.idle:
+                return self.idle.pop()[0]
+            self.size += 1
+        return self.create()
+
+    def release(self, connection, broken=False):
+        with self.condition:
+            if broken:
+                self.size -= 1
+            else:
+                self.idle.append((connection, timer.time()))
+            self.condition.notify()
+        if broken:
+            self.discard(connection)
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        except Exception:
+            self.release(connection, broken=True)
+            raise
+        self.release(connection)
+
+    def peek(self):
+        """Return the connection the next acquire() would get, if any."""
+        with self.condition:
+            return self.idle[-1][0] if self.idle else None
+
+    def create(self):
+        try:
+            return self.factory()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.condition.notify()
+            raise
+
+    def discard(self, connection):
+        if self.close_connection is not None:
+            try:
+                self.close_connection(connection)
+            except Exception:
+                pass
+
+    def refill(self):
+        while True:
+            with self.condition:
+                if self.size >= self.min_size:
+                    return
+                self.size += 1
+            self.release(self.create())
+
+    def maintain(self):
+        """Evict long idle connections, replace unhealthy ones, refill to min_size."""
+        now = timer.time()
+        stale, evicted = [], []
+        with self.condition:
+            while self.idle and self.idle[0][1] < now - self.check_interval:
+                connection, last_used = self.idle.popleft()
+                if last_used < now - self.idle_timeout and self.size > self.min_size:
+                    self.size -= 1
+                    evicted.append(connection)
                 else:
-                    return 0
-        return True
+                    stale.append((connection, last_used))
+        for connection in evicted:
+            self.discard(connection)
+        for connection, last_used in stale:
+            healthy = True
+            if self.check is not None:
+                try:
+                    healthy = self.check(connection)
+                except Exception:
+                    healthy = False
+            with self.condition:
+                if healthy:
+                    self.idle.appendleft((connection, last_used))
+                else:
+                    self.size -= 1
+                self.condition.notify()
+            if not healthy:
+                self.discard(connection)
+        self.refill()
+
+    def maintain_if_due(self, now):
+        if now >= self.next_check:
+            self.next_check = now + self.check_interval
+            self.maintain()
+
+    def close(self):
+        pool_maintainer.unregister(self)
+        with self.condition:
+            idle, self.idle = self.idle, collections.deque()
+            self.size -= len(idle)
+        for connection, _ in idle:
+            self.discard(connection)
+
+
+class PoolMaintainer(BackgroundThreads):
+    """Runs the maintenance of all live pools from one daemon thread."""
+
+    def __init__(self, tick=POOL_MAINTENANCE_TICK):
+        self.tick = tick
+        self.pools = weakref.WeakSet()
+        self.lock = threading.Lock()
+
+    def register(self, pool):
+        with self.lock:
+            self.pools.add(pool)
+        self.start()
+
+    def unregister(self, pool):
+        with self.lock:
+            self.pools.discard(pool)
+
+    def run(self, sleep=timer.sleep, now=timer.time):
+        while True:
+            sleep(self.tick)
+            with self.lock:
+                pools = list(self.pools)
+            for pool in pools:
+                try:
+                    pool.maintain_if_due(now())
+                except Exception:
+                    logging.exception("Connection pool maintenance failed")
+
+
+pool_maintainer = PoolMaintainer()
+
+
+class PooledClient(object):
+    """Base for store clients that borrow connections from a ConnectionPool.
+
+    Client calls raise StoreUnavailable when the backend can not be reached.
+    """
+    default_port = None
+
+    def __init__(self, ip_address, port, timeout, **pool_options):
+        self.ip_address = ip_address
+        self.port = port or self.default_port
+        self.timeout = timeout
+        pool_options.setdefault('wait_timeout', timeout)
+        self.pool = ConnectionPool(self.get_connection, self.check_connection, self.close_connection,
+                                   **pool_options)
+
+    @property
+    def connection(self):
+        return self.pool.peek()
+
+    def close(self):
+        self.pool.close()
 
 
 class MemCacheClient(object):
-    def __init__(self, ip_address, port, timeout):
-        self.port = port or MEMCACHE_PORT
-        self.connection = self.get_connection(ip_address, timeout)
+    """Memcache is not pooled: memcache.Client is a threading.local and
+    keeps one socket per thread, so every request thread already has its
+    own connection, and a Client shared through a pool would open one
+    more socket for every thread borrowing it. Checks and eviction of a
+    pool would run in the maintainer thread and only see its own sockets.
+    The Client reconnects a failed socket by itself on the next call, a
+    failed call only reports StoreUnavailable. The pool options are
+    accepted for the common Store interface and ignored.
+    """
+    default_port = MEMCACHE_PORT
 
-    def get_connection(self, ip_address, timeout):
-        address = "{0}:{1}".format(ip_address, self.port)
-        return memcache.Client([address], socket_timeout=timeout)
+    def __init__(self, ip_address, port, timeout, **pool_options):
+        self.ip_address = ip_address
+        self.port = port or self.default_port
+        self.timeout = timeout
+        address = "{0}:{1}".format(self.ip_address, self.port)
+        self.connection = memcache.Client([address], socket_timeout=timeout)
+
+    def close(self):
+        # closes the sockets of the calling thread, the others close with their threads
+        self.connection.disconnect_all()
+
+    def is_available(self):
+        now = timer.time()
+        return any(host.deaduntil <= now for host in self.connection.buckets)
 
     def get(self, key):
-        return self.connection.get(key)
+        value = self.connection.get(key)
+        available = value is not None or self.is_available()
+        if not available:
+            raise StoreUnavailable('memcache is unavailable')
+        return value
+
+    def get_many(self, keys):
+        values = self.connection.get_multi(keys)
+        available = len(values) == len(keys) or self.is_available()
+        if not available:
+            raise StoreUnavailable('memcache is unavailable')
+        return values
 
     def set(self, key, value, time):
-        return self.connection.set(key, value, time)
+        result = self.connection.set(key, value, time)
+        if not result:
+            raise StoreUnavailable('memcache did not store the value')
+        return result
 
+    def set_many(self, mapping, time):
+        failed = self.connection.set_multi(mapping, time)
+        if failed:
+            raise StoreUnavailable('memcache did not store %d values' % len(failed))
+        return True
 
-def test_connection(func):
-    def deco(self, *args):
-        if self.connection is None:
-            self.connection = self.get_connection()
-            if self.connection is None:
-                return None
-        return func(self, *args)
-    return deco
+    def add(self, key, value, time):
+        added = self.connection.add(key, value, time)
+        available = added or self.is_available()
+        if not available:
+            raise StoreUnavailable('memcache is unavailable')
+        return bool(added)
 
+    def delete(self, key):
+        deleted = self.connection.delete(key)
+        if not deleted:
+            raise StoreUnavailable('memcache did not delete the key')
+        return True
 
-class RedisClient(object):
-    def __init__(self, ip_address, port, timeout):
-        self.port = port or REDIS_PORT
-        self.ip_address = ip_address
-        self.timeout = timeout
-        self.connection = self.get_connection()
+
+class RedisClient(PooledClient):
+    default_port = REDIS_PORT
+    errors = (redis.ConnectionError, redis.TimeoutError)
 
     def get_connection(self):
-        try:
-            return redis.StrictRedis(host=self.ip_address, port=self.port, db=0, socket_timeout=self.timeout)
-        except redis.ConnectionError:
-            return None
+        # borrowed by one caller at a time, so it holds a single socket
+        return redis.StrictRedis(host=self.ip_address, port=self.port, db=0, socket_timeout=self.timeout)
+
+    def check_connection(self, connection):
+        return connection.ping()
+
+    def close_connection(self, connection):
+        connection.connection_pool.disconnect()
 
-    @test_connection
     def get(self, key):
         try:
-            return self.connection.get(key)
-        except redis.ConnectionError:
-            return None
+            with self.pool.connection() as connection:
+                return connection.get(key)
+        except self.errors as e:
+            raise StoreUnavailable(str(e))
+
+    def get_many(self, keys):
+        try:
+            with self.pool.connection() as connection:
+                values = connection.mget(keys)
+        except self.errors as e:
+            raise StoreUnavailable(str(e))
+        return dict((key, value) for key, value in zip(keys, values) if value is not None)
 
-    @test_connection
     def set(self, key, value, time):
         try:
-            return self.connection.set(key, value, ex=time)
-        except redis.ConnectionError:
-            return 0
+            with self.pool.connection() as connection:
+                return connection.set(key, value, ex=time)
+        except self.errors as e:
+            raise StoreUnavailable(str(e))
+
+    def set_many(self, mapping, time):
+        try:
+            with self.pool.connection() as connection:
+                pipeline = connection.pipeline(transaction=False)
+                for key, value in mapping.items():
+                    pipeline.set(key, value, ex=time)
+                pipeline.execute()
+        except self.errors as e:
+            raise StoreUnavailable(str(e))
+        return True
+
+    def add(self, key, value, time):
+        try:
+            with self.pool.connection() as connection:
+                return bool(connection.set(key, value, ex=time, nx=True))
+        except self.errors as e:
+            raise StoreUnavailable(str(e))
+
+    def delete(self, key):
+        try:
+            with self.pool.connection() as connection:
+                connection.delete(key)
+        except self.errors as e:
+            raise StoreUnavailable(str(e))
+        return True
@@ -1,6 +1,21 @@
 import unittest
 import api
+import datetime
 import functools
+import hashlib
+import httplib
+import json
+import itertools
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from optparse import Values
+
+import profiling
+import scoring
 
 
 def cases(case_list):
@@ -242,6 +257,35 @@ class BirthDayFieldTestCase(unittest.TestCase):
         self.assertEquals(field.errors, [error])
 
 
+class ParseDateTestCase(unittest.TestCase):
+    values = [
+        '30.01.2017', '1.2.2017', ' 1.2.2017', u'01.01.2017', '29.02.2016', '29.02.2017', '31.04.2017',
+        '00.01.2017', '01.13.2017', '01.01.0000', '01.02.17', '011.01.2017', '1.1.20170', '01.01.2017\n',
+        '01.01.2017 ', ' 1. 1.2017', '01-01-2017', 'aa.bb.cccc', '', 20170101, None,
+    ]
+
+    def outcome(self, parse, value):
+        try:
+            return parse(value)
+        except (ValueError, TypeError) as e:
+            return type(e)
+
+    def test_same_as_strptime(self):
+        for value in self.values * 2:
+            expected = self.outcome(lambda value: datetime.datetime.strptime(value, '%d.%m.%Y').date(), value)
+            self.assertEqual(self.outcome(api.parse_date, value), expected, value)
+
+    def test_birthday_cutoff(self):
+        self.addCleanup(setattr, api.BirthDayField, 'cutoff', api.BirthDayField.cutoff)
+        api.BirthDayField.cutoff = (0, None)
+        today = datetime.date.today()
+        self.assertEqual(api.BirthDayField.get_cutoff(), today - datetime.timedelta(days=365 * 70))
+        expires_at, _ = api.BirthDayField.cutoff
+        self.assertEqual(datetime.date.fromtimestamp(expires_at), today + datetime.timedelta(days=1))
+        api.BirthDayField.cutoff = (expires_at, datetime.date(2000, 1, 1))
+        self.assertEqual(api.BirthDayField.get_cutoff(), datetime.date(2000, 1, 1))
+
+
 class GenderFieldTestCase(unittest.TestCase):
 
     @cases([
@@ -310,6 +354,41 @@ class ClientIDsFieldTestCase(unittest.TestCase):
         self.assertEquals(field.errors, [error])
 
 
+class CheckAuthTestCase(unittest.TestCase):
+    def setUp(self):
+        api.user_digests.clear()
+        self.addCleanup(setattr, api, 'admin_digest', api.admin_digest)
+
+    def request(self, login, token, account="horns&hoofs"):
+        return api.MethodRequest({"account": account, "login": login, "token": token})
+
+    def test_user(self):
+        token = hashlib.sha512("horns&hoofs" + "h&f" + api.SALT).hexdigest()
+        self.assertFalse(api.check_auth(self.request("h&f", "bad")))
+        self.assertEqual(api.user_digests, {})
+        self.assertTrue(api.check_auth(self.request("h&f", token)))
+        self.assertEqual(api.user_digests, {("horns&hoofs", "h&f"): token})
+        self.assertTrue(api.check_auth(self.request("h&f", token)))
+        self.assertFalse(api.check_auth(self.request("h&f", "bad")))
+        self.assertFalse(api.check_auth(self.request("h&f", token, account="other")))
+
+    def test_empty_unicode_token(self):
+        # json.loads gives unicode, empty values are not encoded by CharField
+        for login in ("h&f", "admin"):
+            self.assertFalse(api.check_auth(self.request(login, u"")))
+            self.assertFalse(api.check_auth(self.request(login, None)))
+
+    def test_admin_digest_rolls_over(self):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        self.assertTrue(api.check_auth(self.request("admin", token)))
+        expires_at, _ = api.admin_digest
+        self.assertTrue(0 < expires_at - time.time() <= 3600)
+        api.admin_digest = (time.time() + 60, "stale")
+        self.assertFalse(api.check_auth(self.request("admin", token)))
+        api.admin_digest = (time.time() - 1, "stale")
+        self.assertTrue(api.check_auth(self.request("admin", token)))
+
+
 class TestSuite(unittest.TestCase):
     def setUp(self):
         self.context = {}
@@ -338,6 +417,14 @@ class TestSuite(unittest.TestCase):
         _, code = self.get_response(request)
         self.assertEqual(api.FORBIDDEN, code)
 
+    @cases([
+        {"account": "horns&hoofs", "login": "h&f", "method": "online_score", "token": "", "arguments": {}},
+        {"account": "horns&hoofs", "login": "admin", "method": "online_score", "token": "", "arguments": {}},
+    ])
+    def test_bad_auth_json_body(self, request):
+        _, code = self.get_response(json.loads(json.dumps(request)))
+        self.assertEqual(api.FORBIDDEN, code)
+
     @cases([
         {"account": "horns&hoofs", "login": "user", "method": "clients_interests",
          "arguments": {"client_ids": [1, 2, 3, 4], "date": "20.07.2017"}},
@@ -360,6 +447,14 @@ class TestSuite(unittest.TestCase):
         _, code = self.get_response(request)
         self.assertEqual(api.NOT_FOUND, code)
 
+    def test_online_score_without_pairs(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"phone": "79175002040", "first_name": "TestName", "gender": 1}}
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+        self.assertEqual(self.context['has'], ['first_name', 'phone', 'gender'])
+
 
 class TestSuiteWithStore(unittest.TestCase):
     def setUp(self):
@@ -416,6 +511,357 @@ class TestSuiteWithStore(unittest.TestCase):
         _, code = self.get_response(request)
         self.assertEqual(api.INVALID_REQUEST, code)
 
+    def test_online_score_batch(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"items": [
+                       {"phone": "79175002040", "email": "test@otus.ru"},
+                       {"phone": "79175002040"},
+                       {"first_name": "TestName", "last_name": "TestSurname"},
+                       {"phone": "79175002040", "email": "test@otus.ru"},
+                   ]}}
+        for _ in range(2):
+            response, code = self.get_response(request)
+            self.assertEqual(api.OK, code)
+            items = response["items"]
+            self.assertEqual([item["code"] for item in items], [api.OK, api.INVALID_REQUEST, api.OK, api.OK])
+            self.assertEqual([item.get("response") for item in items],
+                             [{"score": 3.0}, None, {"score": 0.5}, {"score": 3.0}])
+        self.assertEqual(self.context["nitems"], 4)
+
+    def test_online_score_batch_bad_items(self):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": {"items": [
+                       {"first_name": "TestName", "last_name": "TestSurname"},
+                       {"first_name": u"\u0418\u0432\u0430\u043d", "last_name": "TestSurname"},
+                       {"account": None},
+                       {"phone": "79175002040", "email": "test@otus.ru"},
+                   ]}}
+        response, code = self.get_response(json.loads(json.dumps(request)))
+        self.assertEqual(api.OK, code)
+        items = response["items"]
+        self.assertEqual([item["code"] for item in items], [api.OK, api.INVALID_REQUEST, api.INVALID_REQUEST, api.OK])
+        self.assertEqual([item.get("response") for item in items], [{"score": 0.5}, None, None, {"score": 3.0}])
+
+    @cases([
+        {"items": {"phone": "79175002040"}},
+        {"items": [1, 2]},
+        {"items": [{}] * (api.MAX_BATCH_SIZE + 1)},
+    ])
+    def test_invalid_online_score_batch(self, arguments):
+        request = {"account": "horns&hoofs", "login": "h&f", "method": "online_score_batch",
+                   "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                   "arguments": arguments}
+        _, code = self.get_response(request)
+        self.assertEqual(api.INVALID_REQUEST, code)
+
+
+class ConcurrentRequestTestCase(unittest.TestCase):
+    def test_requests_do_not_share_values(self):
+        mismatches = []
+
+        def validate(n):
+            for i in range(200):
+                first_name = "name%s_%s" % (n, i)
+                request = api.OnlineScoreRequest({"first_name": first_name, "last_name": "surname"})
+                request.is_valid()
+                if request.get_data()['first_name'] != first_name:
+                    mismatches.append(first_name)
+
+        threads = [threading.Thread(target=validate, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(mismatches, [])
+
+
+class SingleThreadServerTestCase(unittest.TestCase):
+    def setUp(self):
+        opts = Values({"port": 0, "threads": 1, "cache_type": api.DEFAULT_CACHE_CLIENT,
+                       "cache_address": api.DEFAULT_CACHE_ADDRESS, "cache_port": 11211})
+        self.server = api.make_server(opts)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        # as serve() does on SIGTERM, the only thread may wait on an idle connection
+        self.server.closing = True
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def admin_score(self):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        self.addCleanup(connection.close)
+        connection.request("POST", "/method", json.dumps({"account": "horns&hoofs", "login": "admin",
+                                                          "method": "online_score", "token": token,
+                                                          "arguments": {}}))
+        response = connection.getresponse()
+        self.assertEqual(json.loads(response.read())["code"], api.OK)
+        return connection
+
+    def test_idle_connection_does_not_block_others(self):
+        idle = self.admin_score()
+        start = time.time()
+        self.admin_score()
+        self.assertLess(time.time() - start, 1)
+        # the idle connection was closed for the new client
+        idle.sock.settimeout(5)
+        self.assertEqual(idle.sock.recv(4096), "")
+
+    def test_idle_connection_is_closed_on_stop(self):
+        idle = self.admin_score()
+        self.server.closing = True
+        idle.sock.settimeout(5)
+        start = time.time()
+        self.assertEqual(idle.sock.recv(4096), "")
+        self.assertLess(time.time() - start, 1)
+
+
+class ThreadPoolServerTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.access_log = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.access_log)
+        fd, self.trace_file = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.trace_file)
+        opts = Values({"port": 0, "threads": 4, "cache_type": api.DEFAULT_CACHE_CLIENT,
+                       "cache_address": api.DEFAULT_CACHE_ADDRESS, "cache_port": 11211,
+                       "access_log": self.access_log, "trace_file": self.trace_file, "trace_sample": 1.0})
+        self.server = api.make_server(opts)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_admin_score(self):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        body = json.dumps({"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                           "token": token, "arguments": {}})
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        connection.request("POST", "/method", body)
+        response = json.loads(connection.getresponse().read())
+        self.assertEqual(response, {"code": api.OK, "response": {"score": 42}})
+        self.server.RequestHandlerClass.access_log.close()
+        with open(self.access_log) as f:
+            record = json.loads(f.read())
+        self.assertEqual((record["method"], record["code"], record["path"]), ("online_score", api.OK, "/method"))
+        self.assertNotIn("response", record)
+
+    def test_pool_size(self):
+        self.assertEqual(api.pool_size(Values({"threads": 4})), 4 + api.REFRESH_WORKERS)
+        self.assertEqual(api.pool_size(Values({"threads": 4, "cache_refresh_workers": 1,
+                                               "cache_write_behind": 100})), 6)
+
+    def test_trace(self):
+        body = json.dumps({"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                           "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95",
+                           "arguments": {"phone": "79175002040", "email": "test@otus.ru"}})
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        connection.request("POST", "/method", body, {"X-Request-ID": "trace-1"})
+        self.assertEqual(json.loads(connection.getresponse().read())["code"], api.OK)
+        self.server.RequestHandlerClass.tracer.close()
+        with open(self.trace_file) as f:
+            trace = json.loads(f.read())
+        self.assertEqual(trace["trace_id"], "trace-1")
+        spans = trace["spans"]
+        names = [span["name"] for span in spans]
+        for name in ("parse", "route", "validate", "check_auth", "online_score", "store.cache_fetch", "write"):
+            self.assertIn(name, names)
+        route = names.index("route")
+        self.assertIsNone(spans[route]["parent"])
+        self.assertEqual(spans[names.index("validate")]["parent"], route)
+        self.assertEqual(spans[names.index("store.cache_fetch")]["parent"], names.index("online_score"))
+        self.assertEqual(spans[names.index("get")]["parent"], names.index("store.cache_fetch"))
+
+    def test_profile_route(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(profiling.profiler.stop)
+        profiling.profiler.configure(directory)
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+
+        def post(path, body):
+            connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+            connection.request("POST", path, json.dumps(body))
+            return json.loads(connection.getresponse().read())
+
+        response = post("/profile", {"account": "horns&hoofs", "login": "h&f", "method": "start", "arguments": {},
+                                     "token": "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"})
+        self.assertEqual(response["code"], api.FORBIDDEN)
+        response = post("/profile", {"login": "admin", "token": token, "method": "start",
+                                     "arguments": {"mode": "cprofile", "requests": 2}})
+        self.assertEqual(response["code"], api.OK)
+        self.assertEqual(response["response"]["mode"], "cprofile")
+        for _ in range(2):
+            response = post("/method", {"login": "admin", "token": token, "method": "online_score",
+                                        "arguments": {}})
+            self.assertEqual(response["code"], api.OK)
+        # the session ends after the response of its last request is written
+        for _ in range(100):
+            response = post("/profile", {"login": "admin", "token": token, "method": "status", "arguments": {}})
+            if response["response"] is None:
+                break
+            time.sleep(0.01)
+        self.assertEqual(response, {"code": api.OK, "response": None})
+        name, = os.listdir(directory)
+        self.assertTrue(name.endswith(".prof"))
+
+    def admin_request(self):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        body = json.dumps({"account": "horns&hoofs", "login": "admin", "method": "online_score",
+                           "token": token, "arguments": {}})
+        return "POST /method HTTP/1.1\r\nHost: localhost\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+
+    def test_keep_alive(self):
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        self.addCleanup(connection.close)
+        socks = []
+        for body in ({"login": "h&f"}, {"login": "admin"}):
+            connection.request("POST", "/method", json.dumps(body))
+            response = connection.getresponse()
+            data = response.read()
+            self.assertEqual(response.version, 11)
+            self.assertEqual(int(response.getheader("Content-Length")), len(data))
+            self.assertEqual(json.loads(data)["code"], api.INVALID_REQUEST)
+            socks.append(connection.sock)
+        self.assertIsNotNone(socks[0])
+        self.assertIs(socks[0], socks[1])
+
+    def test_pipelining(self):
+        sock = socket.create_connection(("localhost", self.server.server_address[1]))
+        self.addCleanup(sock.close)
+        sock.sendall(self.admin_request() * 3)
+        responses = []
+        for _ in range(3):
+            response = httplib.HTTPResponse(sock)
+            response.begin()
+            responses.append(json.loads(response.read()))
+        self.assertEqual(responses, [{"code": api.OK, "response": {"score": 42}}] * 3)
+
+    def test_keep_alive_limits(self):
+        handler_class = self.server.RequestHandlerClass
+        handler_class.keepalive_requests = 2
+        sock = socket.create_connection(("localhost", self.server.server_address[1]))
+        self.addCleanup(sock.close)
+        sock.sendall(self.admin_request() * 3)
+        data = ""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        # the connection is closed after the second response
+        self.assertEqual(data.count("HTTP/1.1 200"), 2)
+        self.assertIn("Connection: close", data)
+
+        handler_class.keepalive_requests = api.KEEPALIVE_REQUESTS
+        handler_class.timeout = 0.1
+        sock = socket.create_connection(("localhost", self.server.server_address[1]))
+        self.addCleanup(sock.close)
+        sock.sendall(self.admin_request())
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        response.read()
+        sock.settimeout(5)
+        start = time.time()
+        self.assertEqual(sock.recv(4096), "")
+        self.assertLess(time.time() - start, 1)
+
+    def test_idle_connections_do_not_hold_workers(self):
+        connections = []
+        for _ in range(self.server.threads):
+            connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+            self.addCleanup(connection.close)
+            connection.request("POST", "/method", self.admin_request().split("\r\n\r\n", 1)[1])
+            connection.getresponse().read()
+            connections.append(connection)
+        # every worker has an idle keep-alive connection, a new client is still served
+        start = time.time()
+        sock = socket.create_connection(("localhost", self.server.server_address[1]))
+        self.addCleanup(sock.close)
+        sock.sendall(self.admin_request())
+        response = httplib.HTTPResponse(sock)
+        response.begin()
+        self.assertEqual(json.loads(response.read())["code"], api.OK)
+        self.assertLess(time.time() - start, 1)
+
+    def test_metrics(self):
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        connection.request("POST", "/method", json.dumps({"account": "horns&hoofs", "login": "h&f",
+                                                          "method": "online_score", "token": "bad",
+                                                          "arguments": {}}))
+        connection.getresponse().read()
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        connection.request("GET", "/metrics")
+        response = connection.getresponse()
+        self.assertEqual(response.status, api.OK)
+        lines = response.read().splitlines()
+        self.assertTrue(any(line.startswith('api_requests_total{method="online_score",code="403"} ')
+                            for line in lines))
+        for phase in ("parse", "validate", "auth", "request"):
+            self.assertTrue(any(line.startswith('api_phase_seconds_count{phase="%s"} ' % phase) for line in lines))
+        connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+        connection.request("GET", "/unknown")
+        self.assertEqual(connection.getresponse().status, api.NOT_FOUND)
+
+
+class DictStore(object):
+    def __init__(self):
+        self.data = {}
+
+    def cache_get(self, key):
+        return self.data.get(key)
+
+    def cache_get_many(self, keys):
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+    def cache_set(self, key, value, time):
+        self.data[key] = value
+
+    def cache_set_many(self, mapping, time):
+        self.data.update(mapping)
+
+    def cache_fetch(self, key, compute, time):
+        value = self.data.get(key)
+        if not value:
+            value = self.data[key] = compute()
+        return value
+
+    def cache_fetch_many(self, computes, time):
+        return dict((key, self.cache_fetch(key, compute, time)) for key, compute in computes.items())
+
+
+class ColumnScoringTestCase(unittest.TestCase):
+    rows = list(itertools.product(
+        [None, "79175002040"], [None, "test@otus.ru"], [None, datetime.date(1990, 1, 1)],
+        [None, 0, 1], [None, "", "TestName"], [None, "TestSurname"],
+    ))
+
+    def test_same_as_get_score(self):
+        columns = dict(zip(scoring.SCORE_FIELDS, zip(*self.rows)))
+        row_store, column_store = DictStore(), DictStore()
+        # the second pass is answered from the cache
+        for _ in range(2):
+            expected = [scoring.get_score(row_store, *row) for row in self.rows]
+            scores = scoring.get_column_scores(column_store, columns)
+            self.assertEqual(scores, expected)
+            self.assertEqual([type(score) for score in scores], [type(score) for score in expected])
+            self.assertEqual(column_store.data, row_store.data)
+
+    def test_score_keys(self):
+        birthdays = [datetime.date(1990, 1, 1), datetime.date(1990, 1, 1), datetime.date(2000, 12, 31)]
+        first_names, last_names = ["a", None, "b"], ["c", "d", None]
+        self.assertEqual(scoring.get_score_keys(first_names, last_names, birthdays),
+                         map(scoring.get_score_key, first_names, last_names, birthdays))
+
 
 if __name__ == "__main__":
     unittest.main()
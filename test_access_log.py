@@ -0,0 +1,44 @@
+import unittest
+import json
+import os
+import tempfile
+
+import access_log
+
+
+class AccessLogTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def read(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_write_on_close(self):
+        log = access_log.AccessLog(self.path, batch_size=3)
+        for i in range(10):
+            log.log({"request_id": i, "code": 200})
+        log.close()
+        self.assertEqual([record["request_id"] for record in self.read()], range(10))
+
+    def test_sampling_keeps_errors(self):
+        log = access_log.AccessLog(self.path, sample_rate=0)
+        log.log({"request_id": 1, "code": 200})
+        log.log({"request_id": 2, "code": 422})
+        log.log({"request_id": 3, "code": 500})
+        log.close()
+        self.assertEqual([record["request_id"] for record in self.read()], [2, 3])
+
+    def test_full_queue_drops(self):
+        log = access_log.AccessLog(self.path, queue_size=2)
+        # keep the writer from draining the queue
+        log.pid = os.getpid()
+        for i in range(5):
+            log.log({"request_id": i, "code": 200})
+        self.assertEqual(log.dropped, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import unittest
+import datetime
+import hashlib
+import httplib
+import json
+import threading
+import time
+from optparse import Values
+
+import api
+import async_api
+import fake_cache
+import scoring
+import store
+
+USER_TOKEN = "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"
+
+
+class AsyncServerTestCase(unittest.TestCase):
+    cache_type = 'memcache'
+    fake_server_class = fake_cache.FakeMemcacheServer
+
+    def setUp(self):
+        self.cache = self.fake_server_class().start()
+        host, port = self.cache.server_address
+        opts = Values({"port": 0, "cache_type": self.cache_type, "cache_address": host,
+                       "cache_port": port, "cache_timeout": 1})
+        self.server = async_api.make_server(opts)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05})
+        self.thread.start()
+        self.connection = httplib.HTTPConnection("localhost", self.server.server_address[1])
+
+    def tearDown(self):
+        self.connection.close()
+        self.server.stop()
+        self.thread.join()
+        self.cache.stop()
+
+    def post(self, body, path="/method"):
+        self.connection.request("POST", path, json.dumps(body))
+        response = self.connection.getresponse()
+        return json.loads(response.read())
+
+    def method(self, method, arguments, login="h&f", token=USER_TOKEN):
+        return self.post({"account": "horns&hoofs", "login": login, "method": method,
+                          "token": token, "arguments": arguments})
+
+    def test_online_score(self):
+        arguments = {"phone": "79175002040", "email": "test@otus.ru"}
+        self.assertEqual(self.method("online_score", arguments), {"code": api.OK, "response": {"score": 3.0}})
+        # second call is answered from the cache over the same keep-alive connection
+        self.assertEqual(self.method("online_score", arguments), {"code": api.OK, "response": {"score": 3.0}})
+
+    def test_score_cached_by_threaded_server(self):
+        threaded_store = store.Store(self.cache_type, *self.cache.server_address)
+        self.addCleanup(threaded_store.close)
+        self.assertEqual(scoring.get_score(threaded_store, "79175002040", "test@otus.ru", first_name="a"), 3.0)
+        arguments = {"phone": "79175002040", "email": "test@otus.ru", "first_name": "a"}
+        self.assertEqual(self.method("online_score", arguments), {"code": api.OK, "response": {"score": 3.0}})
+        # an expired score is recomputed and cached for the threaded server again
+        key = scoring.get_score_key("b", None, datetime.datetime.now())
+        self.cache.put(key, store.wrap_fresh(1.5, 0.001, time.time() - 1))
+        arguments["first_name"] = "b"
+        self.assertEqual(self.method("online_score", arguments), {"code": api.OK, "response": {"score": 3.0}})
+        # the write is not awaited before the response, wait until it lands
+        for _ in range(100):
+            if threaded_store.cache_get(key) == "3.0":
+                break
+            time.sleep(0.01)
+        self.assertEqual(threaded_store.cache_fetch(key, lambda: 0.5, 60), "3.0")
+
+    def test_broken_cached_score(self):
+        self.cache.put(scoring.get_score_key("a", None, datetime.datetime.now()), "xf1:broken")
+        arguments = {"phone": "79175002040", "email": "test@otus.ru", "first_name": "a"}
+        self.assertEqual(self.method("online_score", arguments)["code"], api.INTERNAL_ERROR)
+        # the keep-alive connection is answered and serves the next request
+        arguments["first_name"] = "b"
+        self.assertEqual(self.method("online_score", arguments), {"code": api.OK, "response": {"score": 3.0}})
+
+    def test_admin_score(self):
+        token = hashlib.sha512(datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT).hexdigest()
+        response = self.method("online_score", {}, login="admin", token=token)
+        self.assertEqual(response, {"code": api.OK, "response": {"score": 42}})
+
+    def test_invalid_request(self):
+        self.assertEqual(self.method("online_score", {"phone": "79175002040"})["code"], api.INVALID_REQUEST)
+        self.assertEqual(self.method("online_score", {}, token="bad")["code"], api.FORBIDDEN)
+        self.assertEqual(self.method("unknown", {})["code"], api.NOT_FOUND)
+        self.assertEqual(self.post({}, path="/unknown")["code"], api.OK)
+
+    def test_clients_interests(self):
+        self.cache.put("i:1", '["books", "cars"]')
+        self.cache.put("i:2", '["music"]')
+        response = self.method("clients_interests", {"client_ids": [1, 2]})
+        self.assertEqual(response, {"code": api.OK, "response": {"1": ["books", "cars"], "2": ["music"]}})
+
+    def test_clients_interests_missing(self):
+        response = self.method("clients_interests", {"client_ids": [100]})
+        self.assertEqual(response["code"], api.INTERNAL_ERROR)
+
+    def test_pipelined_requests(self):
+        body = json.dumps({"account": "horns&hoofs", "login": "h&f", "method": "online_score",
+                           "token": USER_TOKEN, "arguments": {"first_name": "a", "last_name": "b"}})
+        request = "POST /method HTTP/1.1\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+        self.connection.connect()
+        self.connection.sock.sendall(request * 3)
+        for _ in range(3):
+            response = httplib.HTTPResponse(self.connection.sock)
+            response.begin()
+            self.assertEqual(json.loads(response.read()), {"code": api.OK, "response": {"score": 0.5}})
+
+
+class AsyncRedisServerTestCase(AsyncServerTestCase):
+    cache_type = 'redis'
+    fake_server_class = fake_cache.FakeRedisServer
+
+
+class AsyncStoreUnavailableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.socket_map = {}
+        self.store = async_api.AsyncStore('memcache', '127.0.0.1', 1, timeout=1, socket_map=self.socket_map)
+
+    def test_get(self):
+        results = []
+        self.store.get('key', results.append)
+        while not results:
+            async_api.asyncore.loop(timeout=0.05, map=self.socket_map, count=1)
+        self.assertEqual(results, [None])
+
+
+if __name__ == "__main__":
+    unittest.main()
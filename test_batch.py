@@ -0,0 +1,58 @@
+import unittest
+import json
+import StringIO
+from optparse import Values
+
+import api
+import batch
+import fake_cache
+
+USER_TOKEN = "55cc9ce545bcd144300fe9efc28e65d415b923ebb6be1e19d2750a2c03e80dd209a27954dca045e5bb12418e7d89b6d718a9e35af34e14e1d5bcd5a08f21fc95"
+
+
+def method(arguments, method="online_score"):
+    return json.dumps({"account": "horns&hoofs", "login": "h&f", "method": method,
+                       "token": USER_TOKEN, "arguments": arguments})
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = fake_cache.FakeMemcacheServer().start()
+        host, port = self.cache.server_address
+        self.opts = Values({"cache_type": "memcache", "cache_address": host, "cache_port": port,
+                            "workers": 1, "chunksize": 2})
+
+    def tearDown(self):
+        self.cache.stop()
+
+    def run_batch(self, lines, workers=1):
+        self.opts.workers = workers
+        output = StringIO.StringIO()
+        count = batch.run(StringIO.StringIO("\n".join(lines) + "\n"), output, self.opts)
+        responses = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(count, len(responses))
+        return responses
+
+    def test_responses(self):
+        self.cache.put("i:1", '["books"]')
+        lines = [
+            method({"phone": "79175002040", "email": "test@otus.ru"}),
+            "",
+            method({"phone": "79175002040"}),
+            "not json",
+            method({"client_ids": [1]}, method="clients_interests"),
+        ]
+        responses = self.run_batch(lines)
+        self.assertEqual([response["code"] for response in responses],
+                         [api.OK, api.INVALID_REQUEST, api.BAD_REQUEST, api.OK])
+        self.assertEqual(responses[0]["response"], {"score": 3.0})
+        self.assertEqual(responses[3]["response"], {"1": ["books"]})
+
+    def test_process_pool_keeps_order(self):
+        lines = [method({"first_name": "name%d" % i, "last_name": "surname"}) if i % 3 else "{}"
+                 for i in range(50)]
+        self.assertEqual(self.run_batch(lines, workers=3), self.run_batch(lines))
+
+
+if __name__ == "__main__":
+    unittest.main()
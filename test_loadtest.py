@@ -0,0 +1,54 @@
+import unittest
+import json
+import os
+import tempfile
+from optparse import Values
+
+import loadtest
+
+
+class LoadTestTestCase(unittest.TestCase):
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(loadtest.percentile(values, 50), 50)
+        self.assertEqual(loadtest.percentile(values, 99), 99)
+        self.assertEqual(loadtest.percentile([7], 95), 7)
+        self.assertEqual(loadtest.percentile([], 95), 0)
+
+    def test_compare(self):
+        base = {"total": {"requests": 100, "errors": 0, "rps": 1000, "p50": 1, "p95": 2, "p99": 3}}
+        same = json.loads(json.dumps(base))
+        self.assertEqual(loadtest.compare(base, same), [])
+        slow = {"total": dict(base["total"], rps=700, p95=2.2, p99=5, errors=1)}
+        self.assertEqual(loadtest.compare(base, slow), [
+            "total: rps 700 < 1000", "total: p99 5.00 ms > 3.00 ms", "total: 1 errors",
+        ])
+
+    def test_run_with_baseline(self):
+        fd, baseline = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, baseline)
+        opts = Values({"cache_type": "redis", "concurrency": 2, "requests": 40, "duration": None, "threads": 2,
+                       "local_cache_size": 0, "mix": loadtest.DEFAULT_MIX, "ids": 3, "baseline": baseline,
+                       "save": True, "tolerance": 1000, "connection": "keepalive", "pipeline": 1, "write_behind": 0,
+                       "codec": None})
+        self.assertEqual(loadtest.main(opts), 0)
+        with open(baseline) as f:
+            summary = json.load(f)
+        self.assertEqual(summary["total"]["requests"], 40)
+        self.assertEqual(summary["total"]["errors"], 0)
+        opts.save = False
+        self.assertEqual(loadtest.main(opts), 0)
+
+    def test_connection_modes(self):
+        opts = Values({"cache_type": "memcache", "concurrency": 3, "requests": 60, "duration": None, "threads": 2,
+                       "local_cache_size": 0, "mix": loadtest.DEFAULT_MIX, "ids": 3, "baseline": None,
+                       "save": False, "tolerance": 0, "connection": "close", "pipeline": 1, "write_behind": 100,
+                       "codec": "msgpack"})
+        self.assertEqual(loadtest.main(opts), 0)
+        opts.connection, opts.pipeline = "keepalive", 7
+        self.assertEqual(loadtest.main(opts), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
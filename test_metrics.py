@@ -0,0 +1,44 @@
+import unittest
+
+import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter("requests_total", "Requests.", ("method", "code"))
+        counter.inc(("online_score", 200))
+        counter.inc(("online_score", 200), 2)
+        counter.inc(("clients_interests", 422))
+        self.assertEqual(counter.get(("online_score", 200)), 3)
+        self.assertEqual(list(counter.samples()), [
+            ("requests_total", '{method="clients_interests",code="422"}', 1),
+            ("requests_total", '{method="online_score",code="200"}', 3),
+        ])
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("latency_seconds", "Latency.", ("phase",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(("parse",), value)
+        self.assertEqual(histogram.get_count(("parse",)), 4)
+        self.assertEqual(list(histogram.samples()), [
+            ("latency_seconds_bucket", '{phase="parse",le="0.1"}', 2),
+            ("latency_seconds_bucket", '{phase="parse",le="1"}', 3),
+            ("latency_seconds_bucket", '{phase="parse",le="+Inf"}', 4),
+            ("latency_seconds_sum", '{phase="parse"}', 2.65),
+            ("latency_seconds_count", '{phase="parse"}', 4),
+        ])
+
+    def test_render(self):
+        registry = metrics.Registry()
+        registry.register(metrics.Counter("retries_total", "Retries.")).inc()
+        self.assertEqual(registry.render({"local_cache_size": 3}), "\n".join([
+            "# HELP retries_total Retries.",
+            "# TYPE retries_total counter",
+            "retries_total 1",
+            "# TYPE local_cache_size gauge",
+            "local_cache_size 3",
+        ]) + "\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
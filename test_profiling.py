@@ -0,0 +1,67 @@
+import os
+import pstats
+import shutil
+import tempfile
+import time
+import unittest
+
+import profiling
+
+
+def work():
+    return sum(i * i for i in range(1000))
+
+
+class ProfilerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.profiler = profiling.Profiler(self.directory)
+
+    def serve(self, requests):
+        for _ in range(requests):
+            profiled = self.profiler.begin()
+            work()
+            time.sleep(0.02)
+            self.profiler.end(profiled)
+
+    def test_cprofile_next_requests(self):
+        self.serve(1)
+        self.assertEqual(os.listdir(self.directory), [])
+        status = self.profiler.start("cprofile", requests=3)
+        self.assertEqual(status["mode"], "cprofile")
+        self.serve(5)
+        self.assertIsNone(self.profiler.status())
+        name, = os.listdir(self.directory)
+        self.assertTrue(name.endswith(".prof"))
+        stats = pstats.Stats(os.path.join(self.directory, name))
+        calls = dict((function[2], stat[1]) for function, stat in stats.stats.items())
+        self.assertEqual(calls["work"], 3)
+
+    def test_sample_time_window(self):
+        self.profiler.start("sample", seconds=0.3)
+        self.serve(5)
+        time.sleep(0.5)
+        self.assertIsNone(self.profiler.status())
+        name, = os.listdir(self.directory)
+        self.assertTrue(name.endswith(".collapsed"))
+        with open(os.path.join(self.directory, name)) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all("test_profiling.py:serve" in line for line in lines))
+
+    def test_running_session_is_kept(self):
+        self.profiler.start("cprofile", requests=10)
+        self.assertEqual(self.profiler.start("sample")["mode"], "cprofile")
+        self.assertIsNone(self.profiler.stop())
+        self.assertIsNone(self.profiler.stop())
+
+    def test_invalid_arguments(self):
+        self.assertRaises(ValueError, self.profiler.start, "gprof")
+        self.assertRaises(ValueError, self.profiler.start, "cprofile", requests=-1)
+        self.assertRaises(ValueError, self.profiler.start, "cprofile", seconds="10")
+        self.assertIsNone(self.profiler.status())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,4 +1,9 @@
+import collections
+import threading
+import time
 import unittest
+import fake_cache
+import scoring
 import store
 
 
@@ -88,5 +93,635 @@ class CloseConnectionRedisTestCase(unittest.TestCase):
         self.assertIsNone(self.wrong_store.cache_get('key_get'))
 
 
+class FakeMemcacheStoreTestCase(unittest.TestCase):
+    cache_type = 'memcache'
+    fake_server_class = fake_cache.FakeMemcacheServer
+
+    def setUp(self):
+        self.server = self.fake_server_class().start()
+        self.store = store.Store(self.cache_type, *self.server.server_address)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get_many(self):
+        self.store.cache_set('i:1', '[1]', 60)
+        self.store.cache_set('i:2', '[2]', 60)
+        self.assertEqual(self.store.get_many(['i:1', 'i:2']), {'i:1': '[1]', 'i:2': '[2]'})
+
+    def test_get_many_missing_key(self):
+        self.store.cache_set('i:1', '[1]', 60)
+        with self.assertRaises(IOError):
+            self.store.get_many(['i:1', 'i:none'])
+
+    def test_cache_get_many(self):
+        self.store.cache_set('i:1', '[1]', 60)
+        self.assertEqual(self.store.cache_get_many(['i:1', 'i:none']), {'i:1': '[1]'})
+
+    def test_cache_set_many(self):
+        self.assertTrue(self.store.cache_set_many({'uid:1': '1.5', 'uid:2': '3.0'}, 60))
+        self.assertEqual(self.store.get_many(['uid:1', 'uid:2']), {'uid:1': '1.5', 'uid:2': '3.0'})
+
+    def test_cache_add_delete(self):
+        self.assertIs(self.store.cache_add('lock:1', 1, 60), True)
+        self.assertIs(self.store.cache_add('lock:1', 1, 60), False)
+        self.assertTrue(self.store.cache_delete('lock:1'))
+        self.assertIs(self.store.cache_add('lock:1', 1, 60), True)
+
+    def test_cache_fetch_coalesces_misses(self):
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.1)
+            return '3.0'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(self.store.cache_fetch('uid:1', compute, 60)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ['3.0'] * 5)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(self.store.cache_fetch('uid:1', compute, 60), '3.0')
+        self.assertEqual(len(calls), 1)
+
+    def test_cache_fetch_waits_for_lock_holder(self):
+        other = store.Store(self.cache_type, *self.server.server_address, lock_timeout=1)
+        # another process computes the value
+        self.assertTrue(self.store.cache_add('lock:uid:1', 1, 60))
+        threading.Timer(0.05, self.store.cache_set, ('uid:1', '1.5', 60)).start()
+        self.assertEqual(other.cache_fetch('uid:1', lambda: '0.5', 60), '1.5')
+        # the lock holder is gone, the value is computed after the timeout
+        self.assertTrue(self.store.cache_add('lock:uid:2', 1, 60))
+        other.lock_timeout = 0.05
+        self.assertEqual(other.cache_fetch('uid:2', lambda: '0.5', 60), '0.5')
+        # no lock holder, the lock is taken and released
+        self.assertEqual(other.cache_fetch('uid:3', lambda: '2.0', 60), '2.0')
+        self.assertTrue(self.store.cache_add('lock:uid:3', 1, 60))
+
+    def test_interests_in_every_format(self):
+        self.store.cache_set('i:1', '["books", "music"]', 60)
+        self.store.cache_set('i:2', store.dumps([u'cars', u'\u043a\u0438\u043d\u043e'], 'json'), 60)
+        self.store.cache_set('i:3', store.dumps([u'geek', u'\u043a\u0438\u043d\u043e'], 'msgpack'), 60)
+        self.assertEqual(scoring.get_interests_many(self.store, [1, 2, 3]), {
+            1: ['books', 'music'], 2: ['cars', u'\u043a\u0438\u043d\u043e'],
+            3: ['geek', u'\u043a\u0438\u043d\u043e']})
+
+    def test_shared_by_threads(self):
+        errors = []
+
+        def work(n):
+            try:
+                for i in range(50):
+                    key = 'uid:%d:%d' % (n, i)
+                    self.store.cache_set(key, str(i), 60)
+                    if self.store.get(key) != str(i):
+                        errors.append(key)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+class FakeRedisStoreTestCase(FakeMemcacheStoreTestCase):
+    cache_type = 'redis'
+    fake_server_class = fake_cache.FakeRedisServer
+
+
+class CodecTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        value = [u'books', u'hi-tech', u'\u043a\u0438\u043d\u043e']
+        for codec in ('json', 'msgpack'):
+            data = store.dumps(value, codec)
+            self.assertEqual(data[:1], store.FORMAT_MARKER)
+            self.assertEqual(store.loads(data), value)
+        self.assertLess(len(store.dumps(value, 'msgpack')), len(store.dumps(value, 'json')))
+
+    def test_legacy_json(self):
+        self.assertEqual(store.loads('["books", "music"]'), ['books', 'music'])
+        self.assertEqual(store.loads('1.5'), 1.5)
+
+    def test_unknown_format(self):
+        self.assertRaises(ValueError, store.dumps, [], 'pickle')
+        self.assertRaises(ValueError, store.loads, store.FORMAT_MARKER + '\x7f[]')
+        self.assertRaises(ValueError, store.loads, store.FORMAT_MARKER)
+
+
+class EarlyRefreshTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = fake_cache.FakeMemcacheServer().start()
+        self.addCleanup(self.server.stop)
+        self.store = store.Store('memcache', *self.server.server_address, stale_ttl=60)
+
+    def test_envelope(self):
+        raw = store.wrap_fresh(1.5, 0.25, 1000.0)
+        self.assertEqual(store.unwrap_fresh(raw), ("1.5", 0.25, 1000.0))
+        self.assertEqual(store.unwrap_fresh("1.5"), ("1.5", None, None))
+        self.assertEqual(store.unwrap_fresh(None), (None, None, None))
+
+    def test_refresh_probability(self):
+        now = time.time()
+        self.assertTrue(self.store.should_refresh(0, now))
+        self.assertFalse(self.store.should_refresh(0.001, now + 60))
+        self.store.refresh_beta = 10 ** 9
+        self.assertTrue(self.store.should_refresh(0.001, now + 60))
+
+    def test_cached_values_have_no_envelope(self):
+        self.assertEqual(self.store.cache_fetch('uid:1', lambda: 1.5, 60), 1.5)
+        self.assertEqual(self.store.cache_get('uid:1'), "1.5")
+        self.assertEqual(self.store.cache_get_many(['uid:1']), {'uid:1': "1.5"})
+        self.assertEqual(self.store.cache_fetch('uid:1', lambda: 3.0, 60), "1.5")
+
+    def test_refresh_before_expiry(self):
+        def compute(score):
+            time.sleep(0.001)
+            return score
+
+        self.store.background_refresh = False
+        self.store.refresh_beta = 10 ** 9
+        self.assertEqual(self.store.cache_fetch('uid:1', lambda: compute(1.5), 60), 1.5)
+        self.assertEqual(self.store.cache_fetch('uid:1', lambda: compute(3.0), 60), 3.0)
+        self.store.refresh_beta = 0
+        self.assertEqual(self.store.cache_fetch('uid:1', lambda: 4.5, 60), "3.0")
+
+    def test_batch_refresh_before_expiry(self):
+        self.store.background_refresh = False
+        self.assertEqual(self.store.cache_fetch_many({'uid:1': lambda: 1.5, 'uid:2': lambda: 0.5}, 60),
+                         {'uid:1': 1.5, 'uid:2': 0.5})
+        # batch writes carry the freshness envelope and the stale window
+        value, delta, expires_at = store.unwrap_fresh(self.store._cache_get('uid:1'))
+        self.assertEqual(value, "1.5")
+        self.assertAlmostEqual(expires_at, time.time() + 60, delta=1)
+        self.assertEqual(self.store.cache_fetch_many({'uid:1': lambda: 3.0}, 60), {'uid:1': "1.5"})
+        # a key close to expiry is refreshed by the batch read
+        self.store.refresh_beta = 10 ** 9
+        self.store.cache_set('uid:1', store.wrap_fresh(1.5, 0.001, time.time() + 1), 60)
+        self.assertEqual(self.store.cache_fetch_many({'uid:1': lambda: 3.0, 'uid:3': lambda: 4.5}, 60),
+                         {'uid:1': 3.0, 'uid:3': 4.5})
+        self.assertEqual(self.store.cache_get('uid:1'), "3.0")
+
+    def test_batch_scores_are_refreshed(self):
+        item = {'phone': ['79175002040'], 'email': ['a@b.ru'], 'first_name': ['a'], 'last_name': ['b']}
+        self.assertEqual(scoring.get_column_scores(self.store, item), [3.5])
+        key = self.server.data.keys()[0]
+        self.store.cache_set(key, store.wrap_fresh(1.5, 0.001, time.time() - 1), 60)
+        self.assertEqual(scoring.get_column_scores(self.store, item), [1.5])
+        self.assertTrue(self.store.refresher.join(1))
+        self.assertEqual(self.store.cache_get(key), "3.5")
+
+    def test_stale_value_is_served_while_refreshed(self):
+        self.store.cache_set('uid:1', store.wrap_fresh(1.5, 0.001, time.time() - 1), 60)
+        refreshed = threading.Event()
+
+        def compute():
+            refreshed.wait(5)
+            return 3.0
+
+        self.assertEqual(self.store.cache_fetch('uid:1', compute, 60), "1.5")
+        # a second request does not start another refresh
+        self.assertEqual(self.store.cache_fetch('uid:1', lambda: 4.5, 60), "1.5")
+        refreshed.set()
+        self.assertTrue(self.store.refresher.join(1))
+        self.assertEqual(self.store.cache_get('uid:1'), "3.0")
+
+    def test_refreshes_run_on_bounded_workers(self):
+        self.store.refresher = store.Refresher(workers=2, max_size=10)
+        self.addCleanup(self.store.refresher.close)
+        release = threading.Event()
+        computed = []
+
+        def compute(i):
+            release.wait(5)
+            computed.append(i)
+            return 3.0
+
+        def fetch(i):
+            self.store.cache_set('uid:%d' % i, store.wrap_fresh(1.5, 0.001, time.time() - 1), 60)
+            self.assertEqual(self.store.cache_fetch('uid:%d' % i, lambda: compute(i), 60), "1.5")
+
+        # the first store call starts the connection pool maintainer
+        self.store.cache_get('uid:0')
+        threads = threading.active_count()
+        fetch(0)
+        fetch(1)
+        for _ in range(100):
+            if len(self.store.refresher.running) == 2:
+                break
+            time.sleep(0.01)
+        for i in range(2, 50):
+            fetch(i)
+        self.assertEqual(threading.active_count() - threads, 2)
+        release.set()
+        self.assertTrue(self.store.refresher.join(1))
+        # two were running, ten were queued, the rest was dropped and served stale
+        self.assertEqual(sorted(computed), range(12))
+        self.assertEqual(self.store.cache_get('uid:0'), "3.0")
+        self.assertEqual(self.store.cache_get('uid:49'), "1.5")
+
+    def test_refresher_restarts_in_forked_process(self):
+        refresher = store.Refresher(workers=2)
+        self.addCleanup(refresher.close)
+        refresher.start()
+        threads = refresher.threads
+        refresher.start()
+        self.assertIs(refresher.threads, threads)
+        # a forked worker sees another pid and starts its own threads
+        refresher.pid = -1
+        refresher.start()
+        self.assertEqual(len(refresher.threads), 2)
+        self.assertFalse(set(refresher.threads) & set(threads))
+        self.assertTrue(all(thread.is_alive() for thread in refresher.threads))
+
+
+class WriteBehindTestCase(unittest.TestCase):
+    def test_batches_and_coalesces_writes(self):
+        batches = []
+        release = threading.Event()
+
+        def write_many(mapping, time):
+            release.wait(5)
+            batches.append((mapping, time))
+            return True
+
+        queue = store.WriteBehind(write_many, 10, batch_size=3)
+        self.assertTrue(queue.put('a', 1, 60))
+        # the worker is blocked on the first batch
+        time.sleep(0.05)
+        for key, value in (('b', 2), ('c', 3), ('b', 4), ('d', 5), ('e', 6)):
+            self.assertTrue(queue.put(key, value, 60))
+        self.assertTrue(queue.put('f', 7, 30))
+        release.set()
+        queue.close()
+        written = {}
+        for mapping, ttl in batches:
+            self.assertLessEqual(len(mapping), 3)
+            written.update((key, (value, ttl)) for key, value in mapping.items())
+        self.assertEqual(written, {'a': (1, 60), 'b': (4, 60), 'c': (3, 60), 'd': (5, 60), 'e': (6, 60),
+                                   'f': (7, 30)})
+
+    def test_drop_policies(self):
+        release = threading.Event()
+        written = {}
+
+        def write_many(mapping, time):
+            release.wait(5)
+            written.update(mapping)
+            return True
+
+        for policy, kept in (("drop_new", ['k0', 'k1', 'k2']), ("drop_old", ['k0', 'k3', 'k4'])):
+            release.clear()
+            written.clear()
+            queue = store.WriteBehind(write_many, 2, batch_size=1, policy=policy)
+            queue.put('k0', 0, 60)
+            time.sleep(0.05)
+            results = [queue.put('k%d' % i, i, 60) for i in range(1, 5)]
+            self.assertEqual(results, [True, True, False, False] if policy == "drop_new" else [True] * 4)
+            release.set()
+            queue.close()
+            self.assertEqual(sorted(written), kept)
+        self.assertRaises(ValueError, store.WriteBehind, write_many, 2, policy="block")
+
+    def test_store_flushes_on_close(self):
+        server = fake_cache.FakeRedisServer().start()
+        self.addCleanup(server.stop)
+        test_store = store.Store('redis', *server.server_address, write_behind=100)
+        self.assertTrue(test_store.cache_set('uid:1', '1.5', 60))
+        self.assertTrue(test_store.cache_set_many({'uid:2': '3.0', 'uid:3': '0.5'}, 60))
+        test_store.close()
+        reader = store.Store('redis', *server.server_address)
+        self.assertEqual(reader.get_many(['uid:1', 'uid:2', 'uid:3']),
+                         {'uid:1': '1.5', 'uid:2': '3.0', 'uid:3': '0.5'})
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_followers_share_result_and_error(self):
+        flights = store.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+
+        def leader():
+            started.set()
+            release.wait()
+            raise ValueError("compute failed")
+
+        errors = []
+
+        def call(func):
+            try:
+                flights.do('key', func)
+            except ValueError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call, args=(leader,))]
+        threads[0].start()
+        started.wait()
+        threads += [threading.Thread(target=call, args=(lambda: 1,)) for _ in range(3)]
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 4)
+        self.assertEqual(len(set(map(id, errors))), 1)
+        # the next call runs again
+        self.assertEqual(flights.do('key', lambda: 2), (2, True))
+
+    def test_do_many_shares_keys_in_flight(self):
+        flights = store.SingleFlight()
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def leader(keys):
+            calls.append(sorted(keys))
+            started.set()
+            release.wait()
+            return dict((key, 1) for key in keys)
+
+        thread = threading.Thread(target=flights.do_many, args=(['a', 'b'], leader))
+        thread.start()
+        started.wait()
+        results = []
+        follower = threading.Thread(target=lambda: results.append(flights.do_many(
+            ['b', 'c'], lambda keys: calls.append(sorted(keys)) or dict((key, 2) for key in keys))))
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        thread.join()
+        follower.join()
+        self.assertEqual(calls, [['a', 'b'], ['c']])
+        self.assertEqual(results, [({'b': 1, 'c': 2}, ['c'])])
+
+
+class RecordingClient(object):
+    def __init__(self, data):
+        self.data = data
+        self.requests = []
+
+    def get(self, key):
+        self.requests.append(key)
+        return self.data.get(key)
+
+    def set(self, key, value, time):
+        self.data[key] = value
+        return True
+
+    def set_many(self, mapping, time):
+        self.data.update(mapping)
+        return True
+
+    def get_many(self, keys):
+        self.requests.append(list(keys))
+        return dict((key, self.data[key]) for key in keys if key in self.data)
+
+
+class GetManyRetryTestCase(unittest.TestCase):
+    def test_retry_missing_keys_only(self):
+        test_store = store.Store('memcache')
+        test_store.nodes[0].client = RecordingClient({'i:1': '[1]'})
+        with self.assertRaises(IOError):
+            test_store.get_many(['i:1', 'i:2'])
+        self.assertEqual(test_store.client.requests, [['i:1', 'i:2']] + [['i:2']] * store.RETRY_COUNT)
+
+    def test_cache_miss_is_not_retried(self):
+        test_store = store.Store('memcache')
+        test_store.nodes[0].client = RecordingClient({'i:1': '[1]'})
+        self.assertEqual(test_store.cache_get_many(['i:1', 'i:2']), {'i:1': '[1]'})
+        self.assertEqual(test_store.cache_get('i:2'), None)
+        self.assertEqual(test_store.client.requests, [['i:1', 'i:2'], 'i:2'])
+
+
+class FailingClient(object):
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, key):
+        self.calls += 1
+        raise store.StoreUnavailable('down')
+
+    get_many = set = get
+
+
+class RetryPolicyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = store.Store('memcache', retry_policy=store.RetryPolicy(retries=4, backoff=0.001),
+                                 breaker_factory=lambda: store.CircuitBreaker(3, reset_timeout=60))
+        self.store.nodes[0].client = FailingClient()
+
+    def test_breaker_opens(self):
+        errors = store.STORE_CALLS.get(('get', 'error'))
+        retries = store.STORE_RETRIES.get()
+        self.assertIsNone(self.store.cache_get('uid:1'))
+        self.assertEqual(store.STORE_CALLS.get(('get', 'error')) - errors, 3)
+        self.assertEqual(store.STORE_RETRIES.get() - retries, 2)
+        self.assertEqual(self.store.client.calls, 3)
+        self.assertEqual(self.store.nodes[0].breaker.state, store.CircuitBreaker.OPEN)
+        self.assertEqual(self.store.cache_set('uid:1', 1, 60), 0)
+        with self.assertRaises(IOError):
+            self.store.get('i:1')
+        self.assertEqual(self.store.client.calls, 3)
+
+    def test_breaker_half_open(self):
+        self.store.cache_get('uid:1')
+        self.store.nodes[0].breaker.opened_at -= 60
+        self.store.nodes[0].client = RecordingClient({'uid:1': 1.5})
+        self.assertEqual(self.store.cache_get('uid:1'), 1.5)
+        self.assertEqual(self.store.nodes[0].breaker.state, store.CircuitBreaker.CLOSED)
+
+    def test_breaker_half_open_unexpected_error(self):
+        self.store.cache_get('uid:1')
+        breaker = self.store.nodes[0].breaker
+        breaker.opened_at -= 60
+
+        def get(key):
+            raise ValueError('unexpected reply')
+        self.store.nodes[0].client.get = get
+        with self.assertRaises(ValueError):
+            self.store.cache_get('uid:1')
+        self.assertEqual(breaker.state, store.CircuitBreaker.OPEN)
+        breaker.opened_at -= 60
+        self.store.nodes[0].client = RecordingClient({'uid:1': 1.5})
+        self.assertEqual(self.store.cache_get('uid:1'), 1.5)
+        self.assertEqual(breaker.state, store.CircuitBreaker.CLOSED)
+
+    def test_pool_exhausted_is_not_a_failure(self):
+        breaker = self.store.nodes[0].breaker
+
+        def get(key):
+            raise store.PoolExhausted('No free store connection')
+        self.store.nodes[0].client.get = get
+        for _ in range(3):
+            self.assertIsNone(self.store.cache_get('uid:1'))
+        self.assertEqual(breaker.state, store.CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.failures, 0)
+        # a trial call without a connection leaves its turn to the next call
+        self.store.nodes[0].client = FailingClient()
+        self.store.cache_get('uid:1')
+        breaker.opened_at -= 60
+        self.store.nodes[0].client.get = get
+        self.assertIsNone(self.store.cache_get('uid:1'))
+        self.store.nodes[0].client = RecordingClient({'uid:1': 1.5})
+        self.assertEqual(self.store.cache_get('uid:1'), 1.5)
+        self.assertEqual(breaker.state, store.CircuitBreaker.CLOSED)
+
+    def test_deadline(self):
+        self.store.retry_policy = store.RetryPolicy(retries=100, backoff=0.01, max_backoff=0.01, deadline=0.05)
+        self.store.nodes[0].breaker = store.CircuitBreaker(failure_threshold=1000)
+        start = store.timer.time()
+        self.assertIsNone(self.store.cache_get('uid:1'))
+        self.assertLess(store.timer.time() - start, 0.1)
+        self.assertLess(self.store.client.calls, 100)
+
+
+class HashRingTestCase(unittest.TestCase):
+    keys = ['uid:%d' % i for i in range(10000)]
+
+    def make_ring(self, count):
+        return store.HashRing([store.StoreNode('node%d' % i, None, None) for i in range(count)])
+
+    def owners(self, ring):
+        return dict((key, ring.get_node(key).name) for key in self.keys)
+
+    def test_balance(self):
+        counts = collections.Counter(self.owners(self.make_ring(4)).values())
+        self.assertEqual(len(counts), 4)
+        for count in counts.values():
+            self.assertTrue(1500 < count < 3500, counts)
+
+    def test_add_node_moves_few_keys(self):
+        ring = self.make_ring(4)
+        before = self.owners(ring)
+        ring.add(store.StoreNode('node4', None, None))
+        after = self.owners(ring)
+        moved = [key for key in self.keys if before[key] != after[key]]
+        # only keys taken over by the new node move, about 1/5 of them
+        self.assertTrue(all(after[key] == 'node4' for key in moved))
+        self.assertTrue(len(moved) < len(self.keys) * 0.3, len(moved))
+
+    def test_replicas_are_distinct(self):
+        nodes = self.make_ring(3).get_nodes('uid:1', 5)
+        self.assertEqual(len(set(node.name for node in nodes)), 3)
+
+
+class ShardedStoreTestCase(unittest.TestCase):
+    def make_store(self, replicas=1):
+        test_store = store.Store('memcache', nodes=['127.0.0.1:1', '127.0.0.1:2', '127.0.0.1:3'],
+                                 replicas=replicas, retry_policy=store.RetryPolicy(retries=0))
+        for node in test_store.nodes:
+            node.client = RecordingClient({})
+        return test_store
+
+    def test_routing(self):
+        test_store = self.make_store()
+        keys = ['i:%d' % i for i in range(30)]
+        test_store.cache_set_many(dict((key, key) for key in keys), 60)
+        self.assertEqual(sum(len(node.client.data) for node in test_store.nodes), 30)
+        self.assertEqual(test_store.get_many(keys), dict((key, key) for key in keys))
+        # one multi-get per node
+        self.assertEqual([len(node.client.requests) for node in test_store.nodes], [1, 1, 1])
+
+    def test_replica_read(self):
+        test_store = self.make_store(replicas=2)
+        test_store.cache_set('uid:1', 1.5, 60)
+        owner = test_store.ring.get_node('uid:1')
+        owner.client = FailingClient()
+        self.assertEqual(test_store.cache_get('uid:1'), 1.5)
+        self.assertEqual(test_store.get_many(['uid:1']), {'uid:1': 1.5})
+
+
+class LocalCacheTestCase(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = store.LocalCache(max_size=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_ttl(self):
+        cache = store.LocalCache(max_size=2, ttl=60)
+        cache.set('a', 1, 0)
+        self.assertEqual(cache.get('a'), None)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations']), (0, 1, 1))
+
+    def test_store_serves_hot_keys_locally(self):
+        test_store = store.Store('memcache', local_cache=store.LocalCache())
+        test_store.nodes[0].client = RecordingClient({'uid:1': 1.5})
+        self.assertEqual(test_store.cache_get('uid:1'), 1.5)
+        self.assertEqual(test_store.cache_get('uid:1'), 1.5)
+        test_store.cache_set('uid:2', 3.0, 60)
+        self.assertEqual(test_store.cache_get('uid:2'), 3.0)
+        self.assertEqual(test_store.client.requests, ['uid:1'])
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.created = []
+        self.closed = []
+        self.healthy = set()
+
+    def make_pool(self, **options):
+        def factory():
+            connection = len(self.created)
+            self.created.append(connection)
+            self.healthy.add(connection)
+            return connection
+        options.setdefault('check_interval', 0)
+        return store.ConnectionPool(factory, lambda c: c in self.healthy, self.closed.append, **options)
+
+    def test_min_size(self):
+        pool = self.make_pool(min_size=2, max_size=4)
+        self.assertEqual((pool.size, len(pool.idle)), (2, 2))
+
+    def test_reuse_and_grow(self):
+        pool = self.make_pool(min_size=1, max_size=2)
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertNotEqual(first, second)
+        pool.release(first)
+        self.assertEqual(pool.acquire(), first)
+        self.assertEqual(len(self.created), 2)
+
+    def test_exhausted(self):
+        pool = self.make_pool(min_size=0, max_size=1, wait_timeout=0.01)
+        pool.acquire()
+        with self.assertRaises(store.PoolExhausted):
+            pool.acquire()
+
+    def test_broken_connection_is_replaced(self):
+        pool = self.make_pool(min_size=1, max_size=1)
+        with self.assertRaises(ValueError):
+            with pool.connection():
+                raise ValueError()
+        self.assertEqual(self.closed, [0])
+        with pool.connection() as connection:
+            self.assertEqual(connection, 1)
+
+    def test_maintain(self):
+        pool = self.make_pool(min_size=1, max_size=3, idle_timeout=10)
+        pool.check_interval = 5
+        connections = [pool.acquire() for _ in range(3)]
+        for connection in connections:
+            pool.release(connection)
+        now = store.timer.time()
+        # 0 and 1 are idle for too long, 2 is due for a health check and is dead
+        pool.idle = store.collections.deque([(0, now - 20), (1, now - 20), (2, now - 6)])
+        self.healthy.discard(2)
+        pool.maintain()
+        self.assertEqual(sorted(self.closed), [0, 1, 2])
+        self.assertEqual((pool.size, [c for c, _ in pool.idle]), (1, [3]))
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+
+import tracing
+
+
+class ListWriter(object):
+    def __init__(self):
+        self.records = []
+
+    def log(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class TracingTestCase(unittest.TestCase):
+    def make_tracer(self, sample_rate=1.0, slow_threshold=None):
+        writer = ListWriter()
+        return tracing.Tracer(sample_rate=sample_rate, slow_threshold=slow_threshold, writer=writer), writer
+
+    def test_nested_spans(self):
+        tracer, writer = self.make_tracer()
+
+        @tracing.traced("store.get")
+        def get(key):
+            with tracing.span("get", node="n1"):
+                return key
+
+        trace = tracer.start("id-1")
+        with tracing.span("route", path="method"):
+            with tracing.span("validate"):
+                pass
+            self.assertEqual(get("k"), "k")
+        try:
+            with tracing.span("write"):
+                raise IOError()
+        except IOError:
+            pass
+        tracer.finish(trace)
+        record, = writer.records
+        self.assertEqual(record["trace_id"], "id-1")
+        spans = [(span["name"], span["parent"]) for span in record["spans"]]
+        self.assertEqual(spans, [("route", None), ("validate", 0), ("store.get", 0), ("get", 2), ("write", None)])
+        self.assertEqual(record["spans"][0]["path"], "method")
+        self.assertEqual(record["spans"][3]["node"], "n1")
+        self.assertEqual(record["spans"][4]["error"], "IOError")
+
+    def test_noop_outside_trace(self):
+        tracer, writer = self.make_tracer(sample_rate=0.0)
+        self.assertIsNone(tracer.start("id-1"))
+        self.assertIs(tracing.span("route"), tracing.NOOP_SPAN)
+        tracer.finish(None)
+        self.assertEqual(writer.records, [])
+
+    def test_disabled_without_output(self):
+        tracer = tracing.Tracer(sample_rate=1.0)
+        self.assertIsNone(tracer.start("id-1"))
+
+    def test_slow_threshold(self):
+        tracer, writer = self.make_tracer(sample_rate=0.0, slow_threshold=0.0)
+        trace = tracer.start("slow")
+        with tracing.span("route"):
+            pass
+        tracer.finish(trace)
+        tracer, fast_writer = self.make_tracer(sample_rate=0.0, slow_threshold=60.0)
+        trace = tracer.start("fast")
+        tracer.finish(trace)
+        self.assertEqual([record["trace_id"] for record in writer.records], ["slow"])
+        self.assertEqual(fast_writer.records, [])
+        self.assertIs(tracing.span("route"), tracing.NOOP_SPAN)
+
+
+if __name__ == "__main__":
+    unittest.main()
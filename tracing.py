@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Lightweight request tracing.
+
+A trace is started per request in the thread that serves it; ``span()``
+and ``@traced`` record nested timings into the current trace, and are a
+no-op when the thread has none. Finished traces are exported as JSON
+lines by a background writer: a ``sample_rate`` share of all requests,
+and every request slower than ``slow_threshold`` seconds, which are
+recorded in full but only exported when they turn out slow.
+
+    tracer = Tracer("traces.jsonl", sample_rate=0.01, slow_threshold=0.1)
+    trace = tracer.start(request_id)
+    with span("parse"):
+        ...
+    tracer.finish(trace)
+"""
+
+import functools
+import random
+import threading
+import time
+
+from access_log import JsonLinesWriter
+
+local = threading.local()
+
+
+class Span(object):
+    __slots__ = ("trace", "name", "attrs", "parent", "start", "duration")
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.parent = None
+        self.start = None
+        self.duration = None
+
+    def __enter__(self):
+        trace = self.trace
+        self.parent = trace.stack[-1] if trace.stack else None
+        trace.stack.append(len(trace.spans))
+        trace.spans.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.duration = time.time() - self.start
+        self.trace.stack.pop()
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        return False
+
+    def set(self, name, value):
+        self.attrs[name] = value
+
+
+class NoopSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def set(self, name, value):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Trace(object):
+    def __init__(self, trace_id, sampled):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.start = time.time()
+        self.spans = []
+        self.stack = []
+
+    def export(self, duration):
+        return {
+            "trace_id": self.trace_id,
+            "start": self.start,
+            "duration_ms": round(duration * 1000, 3),
+            "spans": [
+                dict(span.attrs, name=span.name, parent=span.parent,
+                     start_ms=round((span.start - self.start) * 1000, 3),
+                     duration_ms=round(span.duration * 1000, 3) if span.duration is not None else None)
+                for span in self.spans
+            ],
+        }
+
+
+def span(name, **attrs):
+    trace = getattr(local, "trace", None)
+    if trace is None:
+        return NOOP_SPAN
+    return Span(trace, name, attrs)
+
+
+def traced(name):
+    """Decorator running the function inside a span."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = getattr(local, "trace", None)
+            if trace is None:
+                return func(*args, **kwargs)
+            with Span(trace, name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class Tracer(object):
+    def __init__(self, path=None, sample_rate=0.0, slow_threshold=None, writer=None):
+        self.enabled = bool(path or writer) and (sample_rate > 0 or slow_threshold is not None)
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.writer = writer or JsonLinesWriter(path)
+
+    def start(self, trace_id):
+        """Start recording the requests of this thread, None when it is not traced."""
+        if not self.enabled:
+            return None
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow_threshold is None:
+            local.trace = None
+            return None
+        trace = local.trace = Trace(trace_id, sampled)
+        return trace
+
+    def finish(self, trace):
+        if trace is None:
+            return
+        local.trace = None
+        duration = time.time() - trace.start
+        if trace.sampled or duration >= self.slow_threshold:
+            self.writer.log(trace.export(duration))
+
+    def close(self):
+        self.writer.close()